@@ -0,0 +1,152 @@
+'''
+Benchmark console refreshes at 500 servers and 500 validators.
+
+The previous console output deep copied both tables, formatted every row, and built
+PrettyTables from scratch, all inside the response processor's event loop (after forking a
+shell to clear the screen). With the ConsoleRenderer, the event loop only takes a snapshot,
+and formatting and drawing happen in the renderer's thread. Refreshes are timed with every
+row changed (e.g., each server closed a ledger since the last refresh) and with a share of
+rows changed.
+
+Run from the repository root: `python3 -m benchmarks.bench_console`
+'''
+import io
+import os
+import random
+import shutil
+import subprocess
+import time
+from copy import deepcopy
+
+from prettytable import PrettyTable
+
+from misc.table_rows import StockRow, ValidatorRow
+from process_responses import console_output
+
+SERVER_COUNT = 500
+VALIDATOR_COUNT = 500
+CHANGED_SHARE = 0.05
+REFRESHES = 20
+
+
+def create_tables():
+    '''
+    :return: Stock server and validator rows
+    :rtype: (list, list)
+    '''
+    table_stock = []
+    for i in range(SERVER_COUNT):
+        table_stock.append(StockRow({
+            'server_name': f"server {i}", 'server_status': 'full', 'load_factor': 256,
+            'load_base': 256, 'fee_base': 10, 'load_factor_fee_escalation': 256,
+            'load_factor_fee_queue': 256, 'ledger_hash': 'ABCDEF0123', 'ledger_index': 80000000,
+            'validated_ledgers': '32570-80000000', 'txn_count': 50, 'forked': False,
+            'time_updated': '24-01-01 00:00:00',
+        }))
+    table_validator = []
+    for i in range(VALIDATOR_COUNT):
+        table_validator.append(ValidatorRow({
+            'server_name': f"validator {i}", 'master_key': f"nH{i:050d}",
+            'validation_public_key': f"n9{i:050d}", 'version': 'rippled 1.7.4',
+            'base_fee': 10, 'load_fee': 256, 'ledger_hash': 'ABCDEF0123',
+            'ledger_index': 80000000, 'full': True, 'forked': False,
+            'time_updated': '24-01-01 00:00:00',
+        }))
+    return table_stock, table_validator
+
+
+def update_rows(tables, share, refresh):
+    '''
+    Report a new ledger for a share of the rows.
+    '''
+    for table in tables:
+        for row in random.sample(table, int(len(table) * share)):
+            row['ledger_index'] = 80000000 + refresh
+            row['time_updated'] = f"24-01-01 00:{refresh // 60:02d}:{refresh % 60:02d}"
+
+
+def previous_refresh(table_stock, table_validator, stream):
+    '''
+    Copy, format, and print every row in new PrettyTables.
+    '''
+    for table, fields, header, format_row, sortby in (
+            (table_stock, console_output.SERVER_FIELDS, console_output.SERVER_HEADER,
+             console_output.format_server, "Server Name"),
+            (table_validator, console_output.VALIDATOR_FIELDS, console_output.VALIDATOR_HEADER,
+             console_output.format_validator, "Validator Name"),
+    ):
+        pretty_table = PrettyTable()
+        pretty_table.field_names = header
+        for row in deepcopy(table):
+            pretty_table.add_row(format_row(tuple(row[field] for field in fields)))
+        pretty_table.sortby = sortby
+        stream.write(pretty_table.get_string() + '\n')
+
+
+def time_refreshes(refresh, tables, share):
+    '''
+    :return: Mean milliseconds per refresh
+    :rtype: float
+    '''
+    elapsed = 0
+    for number in range(REFRESHES):
+        update_rows(tables, share, number)
+        start = time.perf_counter()
+        refresh()
+        elapsed += time.perf_counter() - start
+    return elapsed / REFRESHES * 1000
+
+
+def main():
+    '''
+    Time each approach with all rows changed and with CHANGED_SHARE of rows changed.
+    '''
+    random.seed(1)
+    # Size the terminal so the whole frame fits, and redraws can be differential
+    os.environ['COLUMNS'], os.environ['LINES'] = '300', '2000'
+    table_stock, table_validator = create_tables()
+    tables = (table_stock, table_validator)
+    stream = io.StringIO()
+    renderer = console_output.ConsoleRenderer(stream)
+
+    def snapshot():
+        return console_output.take_snapshot(table_stock, table_validator)
+
+    def draw():
+        renderer.draw(renderer.render(snapshot()))
+
+    renderer.draw(renderer.render(snapshot()))
+    print(f"{SERVER_COUNT} servers and {VALIDATOR_COUNT} validators, ms per refresh:")
+    print(f"{'approach':>30} {'all rows changed':>18} {f'{CHANGED_SHARE:.0%} changed':>14}")
+    for name, refresh in (
+            ('previous (event loop)', lambda: previous_refresh(*tables, stream)),
+            ('snapshot (event loop)', snapshot),
+            ('render + draw (renderer)', draw),
+    ):
+        all_changed = time_refreshes(refresh, tables, 1)
+        some_changed = time_refreshes(refresh, tables, CHANGED_SHARE)
+        print(f"{name:>30} {all_changed:15.2f} ms {some_changed:11.2f} ms")
+
+    if shutil.which('clear'):
+        start = time.perf_counter()
+        for _ in range(REFRESHES):
+            subprocess.run(['clear'], stdout=subprocess.DEVNULL, check=False)
+        clear_ms = (time.perf_counter() - start) / REFRESHES * 1000
+        print(f"Previous refreshes also forked a shell to clear the screen: {clear_ms:.2f} ms")
+
+    stream.seek(0)
+    stream.truncate()
+    update_rows(tables, CHANGED_SHARE, REFRESHES)
+    draw()
+    written = stream.tell()
+    stream.seek(0)
+    stream.truncate()
+    previous_refresh(*tables, stream)
+    print(
+        f"Bytes written per refresh with {CHANGED_SHARE:.0%} of rows changed: "
+        f"{written:,} (previously {stream.tell():,})"
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+'''
+Benchmark fork checks at 100, 1,000, and 10,000 monitored nodes.
+
+Each fork check finds the consensus mode and the nodes outside of LL_FORK_CUTOFF. This is
+timed for a full scan of every row (the approach used before the ledger histogram) and the
+ledger histogram. The cost of keeping the histogram current as a node reports a new ledger is
+timed separately.
+
+Run from the repository root: `python3 -m benchmarks.bench_forks`
+'''
+import random
+import time
+from collections import Counter
+
+from misc.table_rows import StockRow
+from process_responses.ledger_histogram import LedgerHistogram
+
+NODE_COUNTS = (100, 1000, 10000)
+FORKED_SHARE = 0.01
+LL_FORK_CUTOFF = 25
+MODE = 80000000
+CHECKS = 50
+
+
+def create_rows(count):
+    '''
+    :return: Rows near the mode, with a share of forked rows
+    :rtype: list
+    '''
+    rows = []
+    for i in range(count):
+        row = StockRow({'server_name': f"node {i}"})
+        if random.random() < FORKED_SHARE:
+            row['ledger_index'] = MODE - random.randint(LL_FORK_CUTOFF + 1, 1000)
+        else:
+            row['ledger_index'] = MODE - random.choice((0, 0, 0, 1))
+        rows.append(row)
+    return rows
+
+
+def full_scan(rows):
+    '''
+    Count every row's ledger index, then compare every row to the mode.
+    '''
+    counts = Counter(int(row['ledger_index']) for row in rows if row['ledger_index'])
+    top = max(counts.values())
+    modes = sorted(index for index, count in counts.items() if count == top)
+    return [
+        row for row in rows
+        if row['ledger_index'] and abs(int(row['ledger_index']) - modes[0]) > LL_FORK_CUTOFF
+    ]
+
+
+def sweep(index):
+    '''
+    Fork check using the modes() and outliers() interface.
+    '''
+    modes = index.modes()
+    return index.outliers(modes[0], LL_FORK_CUTOFF)
+
+
+def time_per_call(function, calls):
+    '''
+    :return: Milliseconds per call
+    :rtype: float
+    '''
+    start = time.perf_counter()
+    for _ in range(calls):
+        function()
+    return (time.perf_counter() - start) / calls * 1000
+
+
+def main():
+    '''
+    Time each approach at each node count.
+    '''
+    random.seed(1)
+    print(f"{'nodes':>7} {'approach':>14} {'fork check':>12} {'per update':>12}")
+    for count in NODE_COUNTS:
+        rows = create_rows(count)
+        histogram = LedgerHistogram()
+        for row in rows:
+            histogram.update(row)
+        approaches = {
+            'full scan': (lambda: full_scan(rows), None),
+            'histogram': (lambda: sweep(histogram), histogram),
+        }
+        expected = len(full_scan(rows))
+
+        for name, (check, index) in approaches.items():
+            if len(check()) != expected:
+                raise RuntimeError(f"{name} found a different number of forked nodes")
+            check_ms = time_per_call(check, CHECKS)
+            if index is None:
+                update = "-"
+            else:
+                update_us = time_per_call(
+                    lambda: update_row(index, random.choice(rows)), 10000
+                ) * 1000
+                update = f"{update_us:9.2f} us"
+            print(f"{count:>7,} {name:>14} {check_ms:9.3f} ms {update:>12}")
+
+
+def update_row(index, row):
+    '''
+    Report a new ledger for a row and keep the index current.
+    '''
+    row['ledger_index'] = MODE + 1 if row['ledger_index'] == MODE else MODE
+    index.update(row)
+
+
+if __name__ == '__main__':
+    main()
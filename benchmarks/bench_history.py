@@ -0,0 +1,93 @@
+'''
+Benchmark the history store.
+
+Every server and validator reports a new ledger each round. For each node count, the time
+the response processor spends snapshotting a round (HistoryStore.record, the only work on the
+event loop), the time the writer thread spends comparing and inserting a round, and the
+database size per sample are reported.
+Downsampling is then timed with every sample past the raw retention period.
+
+Run from the repository root: `python3 -m benchmarks.bench_history`
+'''
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+
+from misc.table_rows import StockRow, ValidatorRow
+from process_responses.history_store import HistoryStore
+
+NODE_COUNTS = (100, 1000)
+ROUNDS = 100
+SETTINGS = {
+    'HISTORY_RAW_RETENTION': 0,
+    'HISTORY_ROLLUP_PERIOD': 60,
+    'HISTORY_RETENTION': 7776000,
+}
+
+
+def create_tables(count):
+    '''
+    :return: count stock servers and count validators
+    :rtype: (list, list)
+    '''
+    table_stock = [
+        StockRow({
+            'url': f"wss://server{i}.example:443", 'server_name': f"server {i}",
+            'load_factor': 256, 'load_base': 256, 'load_factor_fee_escalation': 256,
+            'fee_base': 10, 'server_status': 'full', 'forked': False,
+        })
+        for i in range(count)
+    ]
+    table_validator = [
+        ValidatorRow({
+            'server_name': f"validator {i}", 'master_key': f"nH{i:050d}", 'full': True,
+            'forked': False,
+        })
+        for i in range(count)
+    ]
+    return table_stock, table_validator
+
+
+def main():
+    '''
+    Time recording, writing, and downsampling at each node count.
+    '''
+    print(f"{'nodes':>7} {'record':>14} {'write':>14} {'bytes/sample':>13} {'downsample':>12}")
+    for count in NODE_COUNTS:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'history.db')
+            store = HistoryStore(SimpleNamespace(HISTORY_DB=path, **SETTINGS))
+            store.connect()
+            table_stock, table_validator = create_tables(count)
+            record = write = 0
+            for ledger_index in range(80000000, 80000000 + ROUNDS):
+                for row in table_stock + table_validator:
+                    row['ledger_index'] = ledger_index
+
+                start = time.perf_counter()
+                store.record(table_stock, table_validator)
+                record += time.perf_counter() - start
+
+                start = time.perf_counter()
+                store.write(*store.batches.get())
+                write += time.perf_counter() - start
+
+            store.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            size = os.path.getsize(path)
+            # Move the downsampling cutoff past the current bucket, so every sample is included
+            store.settings.HISTORY_RAW_RETENTION = -store.settings.HISTORY_ROLLUP_PERIOD
+            start = time.perf_counter()
+            store.maintain()
+            downsample = time.perf_counter() - start
+            store.connection.close()
+
+        samples = count * 2 * ROUNDS
+        print(
+            f"{count * 2:>7,} {record / ROUNDS * 1000:8.3f} ms/rd {write / ROUNDS * 1000:8.3f} ms/rd"
+            f" {size / samples:13.1f} {downsample * 1000:9.1f} ms"
+        )
+
+
+if __name__ == '__main__':
+    main()
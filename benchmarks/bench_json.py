@@ -0,0 +1,145 @@
+'''
+Compare JSON decoders on websocket frames.
+
+Frames are read from a file (one frame per line) if a path is given, otherwise a corpus of
+frames shaped like rippled's validation, ledger, and server streams is generated. Every
+installed backend is timed, plus typed structs when msgspec is installed.
+
+Run from the repository root: `python3 -m benchmarks.bench_json [frames.jsonl]`
+'''
+import json
+import random
+import sys
+import time
+
+from misc.json_decoder import FrameDecoder, available_backends, msgspec
+
+FRAME_COUNT = 20000
+ROUNDS = 3
+AMENDMENT_COUNT = 40
+VALIDATIONS_PER_LEDGER = 35
+
+
+def random_hex(length):
+    '''
+    :rtype: str
+    '''
+    return ''.join(random.choice('0123456789ABCDEF') for _ in range(length))
+
+
+def validation_frame(ledger_index, amendments):
+    '''
+    :rtype: bytes
+    '''
+    return json.dumps({
+        'type': 'validationReceived',
+        'amendments': amendments,
+        'base_fee': 10,
+        'cookie': str(random.getrandbits(63)),
+        'flags': 2147483649,
+        'full': True,
+        'ledger_hash': random_hex(64),
+        'ledger_index': str(ledger_index),
+        'load_fee': 256,
+        'master_key': 'nH' + random_hex(50),
+        'reserve_base': 1000000,
+        'reserve_inc': 200000,
+        'server_version': '1745990410196353024',
+        'signature': random_hex(142),
+        'signing_time': 769000000 + ledger_index,
+        'validated_hash': random_hex(64),
+        'validation_public_key': 'n9' + random_hex(50),
+    }).encode()
+
+
+def ledger_frame(ledger_index):
+    '''
+    :rtype: bytes
+    '''
+    return json.dumps({
+        'type': 'ledgerClosed',
+        'fee_base': 10,
+        'fee_ref': 10,
+        'ledger_hash': random_hex(64),
+        'ledger_index': ledger_index,
+        'ledger_time': 769000000 + ledger_index,
+        'reserve_base': 1000000,
+        'reserve_inc': 200000,
+        'txn_count': random.randint(0, 200),
+        'validated_ledgers': f"32570-{ledger_index}",
+    }).encode()
+
+
+def server_frame():
+    '''
+    :rtype: bytes
+    '''
+    return json.dumps({
+        'type': 'serverStatus',
+        'base_fee': 10,
+        'load_base': 256,
+        'load_factor': 256,
+        'load_factor_fee_escalation': 256,
+        'load_factor_fee_queue': 256,
+        'load_factor_fee_reference': 256,
+        'load_factor_server': 256,
+        'server_status': 'full',
+    }).encode()
+
+
+def generate_corpus():
+    '''
+    :rtype: list
+    '''
+    amendments = [random_hex(64) for _ in range(AMENDMENT_COUNT)]
+    frames = []
+    ledger_index = 80000000
+    while len(frames) < FRAME_COUNT:
+        ledger_index += 1
+        frames.extend(
+            validation_frame(ledger_index, amendments) for _ in range(VALIDATIONS_PER_LEDGER)
+        )
+        frames.extend(ledger_frame(ledger_index) for _ in range(10))
+        frames.append(server_frame())
+    return frames[:FRAME_COUNT]
+
+
+def load_corpus(path):
+    '''
+    :rtype: list
+    '''
+    with open(path, 'rb') as corpus_file:
+        return [line.strip() for line in corpus_file if line.strip()]
+
+
+def bench(decoder, frames):
+    '''
+    :return: Best frames per second over ROUNDS
+    :rtype: float
+    '''
+    best = 0
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        for frame in frames:
+            decoder.decode(frame)
+        best = max(best, len(frames) / (time.perf_counter() - start))
+    return best
+
+
+def main():
+    '''
+    Time each available decoder.
+    '''
+    frames = load_corpus(sys.argv[1]) if len(sys.argv) > 1 else generate_corpus()
+    size = sum(len(i) for i in frames) / len(frames)
+    print(f"{len(frames)} frames, mean size {size:,.0f} bytes")
+
+    decoders = {backend: FrameDecoder(backend) for backend in available_backends()}
+    if msgspec is not None:
+        decoders['msgspec (typed)'] = FrameDecoder('msgspec', typed=True)
+    for name, decoder in decoders.items():
+        print(f"{name:>16}: {bench(decoder, frames):12,.0f} frames/sec")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,385 @@
+'''
+Benchmark the whole monitor with replayed websocket traffic.
+
+A replay server (benchmarks/replay_server.py) serves a capture to SERVER_COUNT simulated
+servers, and the monitor's processes are started the way main.py starts them: websocket
+shards (start_websocket_loop), the response processor (start_output_processing), and the
+notification watcher (start_notifications). Hooks in each process measure:
+- received: replay server send -> websocket shard receive
+- dequeued: replay server send -> response processor reads the message
+- processed: response processor time spent on each message
+- notified: response processor queues a notification -> notification watcher reads it
+Messages/sec through the response processor and each process's peak RSS are also reported.
+
+Without --capture, a synthetic capture is generated from bench_processor's message stream
+(and its validators are monitored). With --capture, the validators in settings_ex.py are
+monitored. The run ends once the response processor has been idle for IDLE_TIMEOUT seconds.
+
+Run from the repository root: `python3 -m benchmarks.bench_pipeline --servers 100 --speed 0`
+'''
+import argparse
+import json
+import os
+import random
+import signal
+import socket
+import tempfile
+import threading
+import time
+from multiprocessing import Process, Queue
+
+import asyncio
+
+import settings_ex as settings
+from benchmarks import bench_processor
+from benchmarks.replay_server import ReplayServer, load_streams, read_stamp
+from misc import generate_tables
+from misc.message_transport import create_message_transport
+from notifications.notification_watcher import NotificationDispatcher, start_notifications
+from process_responses.process_output import ResponseProcessor, start_output_processing
+from ws_connection.frame_capture import FrameRecorder
+from ws_connection.initialize_ws import assign_commands, start_websocket_loop
+from ws_connection.sharding import partition_servers
+from ws_connection.validation_fanin import ValidationFanIn
+
+HOST = '127.0.0.1'
+LEDGER_INTERVAL = 3.5 # Seconds between ledgers in synthetic captures
+RESERVOIR = 100000 # Latency samples kept per stage for percentiles
+REPORT_INTERVAL = 0.5
+IDLE_TIMEOUT = 3
+STAGES = ('received', 'dequeued', 'processed', 'notified')
+
+
+class LatencyStats:
+    '''
+    Count latencies, and keep a uniform sample of them for percentiles.
+    '''
+    def __init__(self):
+        self.count = 0
+        self.max = 0.0
+        self.first = None
+        self.last = None
+        self.samples = []
+
+    def add(self, seconds):
+        '''
+        :param float seconds: Latency
+        '''
+        self.count += 1
+        self.last = time.time()
+        if self.first is None:
+            self.first = self.last
+        self.max = max(self.max, seconds)
+        if len(self.samples) < RESERVOIR:
+            self.samples.append(seconds)
+        else:
+            position = random.randrange(self.count)
+            if position < RESERVOIR:
+                self.samples[position] = seconds
+
+    def summary(self):
+        '''
+        :rtype: dict
+        '''
+        samples = sorted(self.samples)
+        summary = {'count': self.count, 'max': self.max, 'first': self.first, 'last': self.last}
+        for percentile in (50, 90, 99):
+            summary[f"p{percentile}"] = \
+                    samples[int(len(samples) * percentile / 100)] if samples else None
+        return summary
+
+
+def start_reporter(results, stages):
+    '''
+    Send stage summaries to the benchmark process every REPORT_INTERVAL.
+
+    :param results: multiprocessing Queue
+    :param dict stages: Stage names mapped to LatencyStats
+    '''
+    def report():
+        while True:
+            time.sleep(REPORT_INTERVAL)
+            results.put((
+                os.getpid(), {stage: stats.summary() for stage, stats in stages.items()}
+            ))
+    threading.Thread(target=report, daemon=True).start()
+
+
+def run_websocket_shard(args_d, shard, results):
+    '''
+    start_websocket_loop, timing each frame from the replay server.
+    '''
+    received = LatencyStats()
+    accept = ValidationFanIn.accept
+
+    def timed_accept(self, server, frame):
+        sent = read_stamp(frame)
+        if sent is not None:
+            received.add(time.time() - sent)
+        return accept(self, server, frame)
+
+    ValidationFanIn.accept = timed_accept
+    start_reporter(results, {'received': received})
+    start_websocket_loop(args_d, shard)
+
+
+def run_response_processor(args_d, results):
+    '''
+    start_output_processing, timing each message.
+    '''
+    dequeued = LatencyStats()
+    processed = LatencyStats()
+    process_message = ResponseProcessor.process_message
+
+    async def timed_process_message(self, message):
+        start = time.time()
+        sent = message['data'].get('replay_sent')
+        if sent is not None:
+            dequeued.add(start - sent)
+        await process_message(self, message)
+        processed.add(time.time() - start)
+
+    ResponseProcessor.process_message = timed_process_message
+    start_reporter(results, {'dequeued': dequeued, 'processed': processed})
+    start_output_processing(args_d)
+
+
+def run_notifications(args_d, results):
+    '''
+    start_notifications, timing each notification from its trace (see misc/tracing.py).
+    '''
+    notified = LatencyStats()
+    enqueue = NotificationDispatcher.enqueue
+
+    async def timed_enqueue(self, notification):
+        trace = notification.get('trace', {})
+        if 'dequeued' in trace:
+            notified.add(trace['dequeued'] - trace['queued'])
+        await enqueue(self, notification)
+
+    NotificationDispatcher.enqueue = timed_enqueue
+    start_reporter(results, {'notified': notified})
+    start_notifications(args_d)
+
+
+def run_replay_server(streams, speed, port):
+    '''
+    Serve the capture with send time stamps.
+    '''
+    server = ReplayServer(streams, speed, stamped=True)
+    try:
+        asyncio.run(server.serve(HOST, port))
+    except KeyboardInterrupt:
+        pass
+
+
+def write_synthetic_capture(path):
+    '''
+    Capture bench_processor's messages, spacing ledgers LEDGER_INTERVAL seconds apart.
+
+    :param str path: Capture file
+    '''
+    random.seed(1)
+    bench_processor.configure()
+    messages = bench_processor.generate_messages()
+    recorder = FrameRecorder(path)
+    received = time.time()
+    first_url = settings.SERVERS[0]['url']
+    for message in messages:
+        if message['data'].get('type') == 'ledgerClosed' and message['server_url'] == first_url:
+            received += LEDGER_INTERVAL
+        recorder.record({'url': message['server_url']}, json.dumps(message['data']), received)
+    recorder.close()
+    return len(messages)
+
+
+def free_port():
+    '''
+    :rtype: int
+    '''
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def rss_mb(pid):
+    '''
+    :return: Resident set size in MB (None if /proc isn't available)
+    :rtype: float
+    '''
+    try:
+        with open(f"/proc/{pid}/status", encoding='utf-8') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def configure(args, port):
+    '''
+    Point the monitor at the replay server, and turn off output that isn't benchmarked.
+    '''
+    settings.SERVERS = [
+        {
+            'url': f"ws://{HOST}:{port}/{i}", 'server_name': f"replay {i}", 'ssl_verify': False,
+            'notifications': {},
+        }
+        for i in range(args.servers)
+    ]
+    for validator in settings.VALIDATORS:
+        validator.setdefault('notifications', {})
+    settings.CONSOLE_OUT = False
+    settings.HISTORY_DB = None
+    settings.WS_CAPTURE_FILE = None
+    settings.ADMIN_HEARTBEAT = False
+    settings.WS_SHARDS = args.shards
+    settings.MESSAGE_TRANSPORT = args.transport
+    for channel in settings.KNOWN_NOTIFICATIONS:
+        setattr(settings, f"SEND_{channel.upper()}", False)
+
+
+def start_monitor(results):
+    '''
+    Start the monitor's processes like main.start_bot.
+
+    :return: Process names mapped to processes
+    :rtype: dict
+    '''
+    table_stock = generate_tables.create_table_stock(settings)
+    table_validator = generate_tables.create_table_validation(settings)
+    args_d = {
+        'settings': settings,
+        'table_stock': table_stock,
+        'table_validator': table_validator,
+        'message_queue': create_message_transport(settings, table_stock),
+        'notification_queue': Queue(),
+    }
+    assign_commands(settings, table_stock)
+    processes = {}
+    for shard, servers in enumerate(partition_servers(settings, table_stock)):
+        processes[f"websocket shard {shard}"] = Process(
+            target=run_websocket_shard, args=(dict(args_d, table_stock=servers), shard, results)
+        )
+    processes['response processor'] = Process(
+        target=run_response_processor, args=(args_d, results)
+    )
+    processes['notifications'] = Process(target=run_notifications, args=(args_d, results))
+    for process in processes.values():
+        process.start()
+    return processes
+
+
+def watch(processes, results, duration):
+    '''
+    Collect stage summaries and RSS until the response processor goes idle.
+
+    :return: Latest summaries for each process, and peak RSS for each process
+    :rtype: (dict, dict)
+    '''
+    summaries = {}
+    peak_rss = {name: 0.0 for name in processes}
+    start = time.monotonic()
+    idle_since = time.monotonic()
+    processed = 0
+    while time.monotonic() - start < duration:
+        while not results.empty():
+            pid, summary = results.get()
+            summaries[pid] = summary
+        count = sum(
+            summary['processed']['count'] for summary in summaries.values()
+            if 'processed' in summary
+        )
+        if count != processed:
+            processed = count
+            idle_since = time.monotonic()
+        elif processed and time.monotonic() - idle_since > IDLE_TIMEOUT:
+            break
+        for name, process in processes.items():
+            peak_rss[name] = max(peak_rss[name], rss_mb(process.pid) or 0.0)
+        time.sleep(REPORT_INTERVAL)
+    return summaries, peak_rss
+
+
+def stop(processes):
+    '''
+    Interrupt each process like a keyboard interrupt, then terminate stragglers.
+    '''
+    for process in processes:
+        if process.is_alive():
+            os.kill(process.pid, signal.SIGINT)
+    for process in processes:
+        process.join(int(settings.SHUTDOWN_TIMEOUT))
+        if process.is_alive():
+            process.terminate()
+            process.join()
+
+
+def print_report(processes, summaries, peak_rss):
+    '''
+    Print throughput, latency percentiles for each stage, and peak RSS.
+    '''
+    names = {process.pid: name for name, process in processes.items()}
+    processor = summaries.get(processes['response processor'].pid, {}).get('processed')
+    if processor and processor['count'] and processor['last'] > processor['first']:
+        elapsed = processor['last'] - processor['first']
+        print(
+            f"Response processor: {processor['count']:,} messages in {elapsed:.2f} s: "
+            f"{processor['count'] / elapsed:,.0f} messages/sec"
+        )
+    print(f"{'stage':>10} {'process':>20} {'count':>10} {'p50 ms':>9} {'p90 ms':>9} "
+          f"{'p99 ms':>9} {'max ms':>9}")
+    for stage in STAGES:
+        for pid, summary in summaries.items():
+            if stage not in summary or not summary[stage]['count']:
+                continue
+            stats = summary[stage]
+            percentiles = ' '.join(
+                f"{stats[key] * 1000:9.2f}" for key in ('p50', 'p90', 'p99', 'max')
+            )
+            print(f"{stage:>10} {names.get(pid, pid):>20} {stats['count']:>10,} {percentiles}")
+    print("Peak RSS: " + ', '.join(f"{name}: {rss:.1f} MB" for name, rss in peak_rss.items()))
+
+
+def main():
+    '''
+    Replay a capture through the monitor and report.
+    '''
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n', maxsplit=1)[0])
+    parser.add_argument('--capture', nargs='*', help="Capture files (default: synthetic)")
+    parser.add_argument('--servers', type=int, default=20, help="Simulated servers")
+    parser.add_argument('--speed', type=float, default=0, help="Replay speed (0 for max)")
+    parser.add_argument('--shards', type=int, default=1, help="WS_SHARDS")
+    parser.add_argument('--transport', default='pipe', help="MESSAGE_TRANSPORT")
+    parser.add_argument('--duration', type=float, default=300, help="Max seconds to run")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        captures = args.capture
+        if not captures:
+            captures = [os.path.join(directory, 'capture.0.gz')]
+            frames = write_synthetic_capture(captures[0])
+            print(f"Generated a synthetic capture with {frames:,} frames.")
+        streams = load_streams(captures)
+
+    port = free_port()
+    configure(args, port)
+    replay = Process(target=run_replay_server, args=(streams, args.speed, port))
+    replay.start()
+    time.sleep(1)
+    results = Queue()
+    processes = start_monitor(results)
+    try:
+        summaries, peak_rss = watch(processes, results, args.duration)
+    finally:
+        stop(list(processes.values()) + [replay])
+    print(
+        f"Replayed {len(streams)} captured servers to {args.servers} simulated servers "
+        f"at speed: {args.speed or 'max'}."
+    )
+    print_report(processes, summaries, peak_rss)
+
+
+if __name__ == '__main__':
+    main()
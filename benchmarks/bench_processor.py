@@ -0,0 +1,155 @@
+'''
+Profile the response processor under a replayed validation load.
+
+A stream of messages shaped like those from the validation, ledger, and server streams is
+generated for VALIDATOR_COUNT validators seen through VAL_STREAMS validation streams, then
+replayed through ResponseProcessor.process_message. Throughput and the functions with
+the most time spent in them are printed.
+
+Run from the repository root: `python3 -m benchmarks.bench_processor`
+'''
+import asyncio
+import cProfile
+import pstats
+import queue
+import random
+import time
+
+import settings_ex as settings
+from misc import generate_tables
+from process_responses.process_output import ResponseProcessor
+
+SERVER_COUNT = 20
+VALIDATOR_COUNT = 35
+VAL_STREAMS = 5
+LEDGER_COUNT = 300
+AMENDMENT_COUNT = 40
+PROFILE_LINES = 15
+
+
+def random_hex(length):
+    '''
+    :rtype: str
+    '''
+    return ''.join(random.choice('0123456789ABCDEF') for _ in range(length))
+
+
+def configure():
+    '''
+    Replace the monitored servers and validators in the settings.
+    '''
+    settings.CONSOLE_OUT = False
+    settings.SERVERS = [
+        {'url': f"wss://server{i}.example:443", 'server_name': f"server {i}", 'ssl_verify': True}
+        for i in range(SERVER_COUNT)
+    ]
+    settings.VALIDATORS = [
+        {
+            'server_name': f"validator {i}",
+            'master_key': 'nH' + random_hex(50),
+            'validation_public_key': 'n9' + random_hex(50),
+        }
+        for i in range(VALIDATOR_COUNT)
+    ]
+
+
+def generate_messages():
+    '''
+    :return: Decoded messages, in the order they would arrive
+    :rtype: list
+    '''
+    amendments = [random_hex(64) for _ in range(AMENDMENT_COUNT)]
+    messages = []
+    for i, server in enumerate(settings.SERVERS):
+        messages.append({
+            'server_url': server['url'],
+            'data': {'result': {
+                'fee_base': 10, 'fee_ref': 10, 'hostid': f"HOST{i}", 'ledger_hash': random_hex(64),
+                'ledger_index': 80000000, 'ledger_time': 769000000, 'load_base': 256,
+                'load_factor': 256, 'pubkey_node': 'n9' + random_hex(50), 'random': random_hex(64),
+                'reserve_base': 1000000, 'reserve_inc': 200000, 'server_status': 'full',
+                'validated_ledgers': '32570-80000000',
+            }},
+        })
+    for ledger_index in range(80000001, 80000001 + LEDGER_COUNT):
+        ledger_hash = random_hex(64)
+        for validator in settings.VALIDATORS:
+            data = {
+                'type': 'validationReceived',
+                'cookie': '1234567890', 'flags': 2147483649, 'full': True,
+                'ledger_hash': ledger_hash, 'ledger_index': str(ledger_index),
+                'master_key': validator['master_key'], 'server_version': '1745990410196353024',
+                'signature': random_hex(142), 'signing_time': 769000000 + ledger_index,
+                'validated_hash': random_hex(64),
+                'validation_public_key': validator['validation_public_key'],
+            }
+            if (ledger_index + 1) % 256 == 0:
+                data.update({
+                    'amendments': amendments, 'base_fee': 10, 'load_fee': 256,
+                    'reserve_base': 1000000, 'reserve_inc': 200000,
+                })
+            for server in settings.SERVERS[:VAL_STREAMS]:
+                messages.append({'server_url': server['url'], 'data': data})
+        for server in settings.SERVERS:
+            messages.append({
+                'server_url': server['url'],
+                'data': {
+                    'type': 'ledgerClosed', 'fee_base': 10, 'fee_ref': 10,
+                    'ledger_hash': ledger_hash, 'ledger_index': ledger_index,
+                    'ledger_time': 769000000 + ledger_index, 'reserve_base': 1000000,
+                    'reserve_inc': 200000, 'txn_count': 50,
+                    'validated_ledgers': f"32570-{ledger_index}",
+                },
+            })
+            if ledger_index % 10 == 0:
+                messages.append({
+                    'server_url': server['url'],
+                    'data': {
+                        'type': 'serverStatus', 'base_fee': 10, 'load_base': 256,
+                        'load_factor': 256, 'load_factor_fee_escalation': 256,
+                        'load_factor_fee_queue': 256, 'load_factor_fee_reference': 256,
+                        'load_factor_server': 256, 'server_status': 'full',
+                    },
+                })
+    return messages
+
+
+async def replay(messages):
+    '''
+    :return: Seconds taken to process the messages
+    :rtype: float
+    '''
+    processor = ResponseProcessor({
+        'settings': settings,
+        'table_stock': generate_tables.create_table_stock(settings),
+        'table_validator': generate_tables.create_table_validation(settings),
+        'message_queue': None,
+        'notification_queue': queue.SimpleQueue(),
+    })
+    await processor.generate_val_keys()
+    await processor.generate_url_index()
+    start = time.perf_counter()
+    for message in messages:
+        await processor.process_message(message)
+    return time.perf_counter() - start
+
+
+def main():
+    '''
+    Replay the messages once for timing, then again under the profiler.
+    '''
+    random.seed(1)
+    configure()
+    messages = generate_messages()
+    elapsed = asyncio.run(replay(messages))
+    print(f"{len(messages):,} messages in {elapsed:.2f} s: {len(messages) / elapsed:,.0f} messages/sec")
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    asyncio.run(replay(messages))
+    profiler.disable()
+    pstats.Stats(profiler).sort_stats('tottime').print_stats(PROFILE_LINES)
+
+
+if __name__ == '__main__':
+    main()
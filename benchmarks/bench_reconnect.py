@@ -0,0 +1,258 @@
+'''
+Measure how long it takes to reconnect to websocket servers that go down and come back.
+
+Local websocket servers are started, killed, then restarted after DOWN_TIME seconds. The
+time from restart until each client is subscribed again is recorded for the done-callback
+ReconnectScheduler and for the previous approach of polling every WS_RETRY seconds.
+
+Then servers that accept each connection and drop it right away ('flapping') are run for
+FLAP_TIME seconds, checking that the ReconnectScheduler backs off rather than reconnecting
+in a tight loop.
+
+Run from the repository root: `python3 -m benchmarks.bench_reconnect`
+'''
+import asyncio
+import json
+import random
+import statistics
+import time
+from types import SimpleNamespace
+
+import websockets
+
+from misc.message_transport import QueueTransport
+from ws_connection.validation_fanin import ValidationFanIn, subscribe_command
+from ws_connection.ws_listen import websocket_subscribe
+from ws_connection.ws_minder import ReconnectScheduler
+
+SERVER_COUNT = 50
+DOWN_TIME = 1
+TRIALS = 5
+HOST = '127.0.0.1'
+FIRST_PORT = 9100
+FLAP_TIME = 5
+
+SETTINGS = SimpleNamespace(
+    VALIDATORS=[],
+    MAX_VAL_STREAMS=0,
+    FANIN_LEDGER_WINDOW=5,
+    WS_RETRY=2,
+    WS_RETRY_BASE=0.1,
+    WS_CIRCUIT_THRESHOLD=10,
+    WS_CIRCUIT_RESET=300,
+    MAX_CONNECT_ATTEMPTS=999999,
+)
+
+
+async def stub_rippled(websocket):
+    '''
+    Answer the subscribe command, then stay connected.
+    '''
+    async for _ in websocket:
+        await websocket.send(json.dumps({'result': {'server_status': 'full'}}))
+
+
+async def start_servers(handler=stub_rippled):
+    '''
+    :rtype: list
+    '''
+    return [
+        await websockets.serve(handler, HOST, FIRST_PORT + i)
+        for i in range(SERVER_COUNT)
+    ]
+
+
+async def stop_servers(servers):
+    '''
+    Close the servers and drop their client connections.
+    '''
+    for server in servers:
+        server.close()
+    await asyncio.gather(*(server.wait_closed() for server in servers))
+
+
+def create_table():
+    '''
+    :rtype: list
+    '''
+    return [
+        {
+            'server_id': i,
+            'server_name': f"stub {i}",
+            'url': f"ws://{HOST}:{FIRST_PORT + i}",
+            'ssl_verify': False,
+            'command': subscribe_command(False),
+            'ws_retry_count': 0,
+            'ws_failures': 0,
+            'ws_circuit': 'closed',
+            'ws_connected': False,
+            'ws_connected_time': None,
+            'ws_connection_task': None,
+        }
+        for i in range(SERVER_COUNT)
+    ]
+
+
+async def poll_connections(table, message_queue, fan_in):
+    '''
+    The previous reconnection approach: check every task once per WS_RETRY seconds.
+    '''
+    while True:
+        await asyncio.sleep(SETTINGS.WS_RETRY)
+        for server in table:
+            if server['ws_connection_task'].done():
+                server['ws_connected'] = False
+                server['ws_connection_task'] = asyncio.create_task(
+                    websocket_subscribe(server, message_queue, fan_in)
+                )
+
+
+async def wait_connected(table, since):
+    '''
+    :return: Seconds from 'since' until each server reconnected
+    :rtype: list
+    '''
+    recovered = {}
+    while len(recovered) < len(table):
+        for server in table:
+            if server['ws_connected'] and server['server_id'] not in recovered:
+                recovered[server['server_id']] = time.monotonic() - since
+        await asyncio.sleep(0.005)
+    return list(recovered.values())
+
+
+async def outage(table, servers):
+    '''
+    Kill the servers, then restart them after DOWN_TIME.
+
+    :return: Restarted servers, and seconds until each client reconnected
+    :rtype: (list, list)
+    '''
+    await stop_servers(servers)
+    # Nothing can reconnect while the servers are down
+    await asyncio.sleep(0.1)
+    for server in table:
+        server['ws_connected'] = False
+    await asyncio.sleep(DOWN_TIME)
+    restarted = time.monotonic()
+    servers = await start_servers()
+    return servers, await wait_connected(table, restarted)
+
+
+async def bench(name):
+    '''
+    Connect, kill the servers, restart them, and time recovery.
+    '''
+    message_queue = QueueTransport(1000)
+    table = create_table()
+    fan_in = ValidationFanIn(SETTINGS, table)
+    servers = await start_servers()
+
+    if name == 'polling':
+        for server in table:
+            server['ws_connection_task'] = asyncio.create_task(
+                websocket_subscribe(server, message_queue, fan_in)
+            )
+        minder = asyncio.create_task(poll_connections(table, message_queue, fan_in))
+    else:
+        minder = ReconnectScheduler(SETTINGS, message_queue, fan_in, asyncio.get_running_loop())
+        for server in table:
+            minder.connect(server)
+    await wait_connected(table, time.monotonic())
+
+    latencies = []
+    for _ in range(TRIALS):
+        # Outages don't line up with the polling interval
+        await asyncio.sleep(random.uniform(0, SETTINGS.WS_RETRY))
+        servers, trial = await outage(table, servers)
+        latencies.extend(trial)
+    latencies.sort()
+
+    if name == 'polling':
+        minder.cancel()
+    else:
+        minder.stop()
+    for server in table:
+        server['ws_connection_task'].cancel()
+    await asyncio.gather(*(server['ws_connection_task'] for server in table),
+                         return_exceptions=True)
+    await stop_servers(servers)
+    # Drain the (unused) disconnect notices so the queue's feeder thread can exit
+    while message_queue.queue.qsize():
+        message_queue.queue.get()
+
+    print(
+        f"{name:>10}: time to recover mean {statistics.mean(latencies):6.3f} s  "
+        f"p50 {latencies[len(latencies) // 2]:6.3f} s  max {latencies[-1]:6.3f} s"
+    )
+
+
+def max_flap_connections():
+    '''
+    :return: Most connections one client can make in FLAP_TIME if every retry waits the
+        shortest jittered delay
+    :rtype: int
+    '''
+    connections = 0
+    elapsed = 0.0
+    while elapsed < FLAP_TIME:
+        connections += 1
+        delay = min(SETTINGS.WS_RETRY, SETTINGS.WS_RETRY_BASE * 2 ** max(0, connections - 1))
+        elapsed += delay / 2
+    return connections
+
+
+async def bench_flapping():
+    '''
+    Run servers that drop every connection once subscribed, and count connections.
+    '''
+    connections = {}
+
+    async def flapping_rippled(websocket):
+        port = websocket.local_address[1]
+        connections[port] = connections.get(port, 0) + 1
+        await websocket.recv()
+
+    message_queue = QueueTransport(1000)
+    table = create_table()
+    fan_in = ValidationFanIn(SETTINGS, table)
+    servers = await start_servers(flapping_rippled)
+    minder = ReconnectScheduler(SETTINGS, message_queue, fan_in, asyncio.get_running_loop())
+    for server in table:
+        minder.connect(server)
+    await asyncio.sleep(FLAP_TIME)
+
+    minder.stop()
+    for server in table:
+        server['ws_connection_task'].cancel()
+    await asyncio.gather(*(server['ws_connection_task'] for server in table),
+                         return_exceptions=True)
+    await stop_servers(servers)
+    while message_queue.queue.qsize():
+        message_queue.queue.get()
+
+    limit = max_flap_connections()
+    most = max(connections.values())
+    print(
+        f"  flapping: {sum(connections.values())} connections to {SERVER_COUNT} servers in "
+        f"{FLAP_TIME} s, at most {most} to one server (backoff allows {limit})"
+    )
+    assert most <= limit, f"'{most}' connections to one flapping server"
+    assert all(server['ws_failures'] for server in table), "Flapping connections reset backoff"
+
+
+async def main():
+    '''
+    Compare both approaches, then check backoff for flapping servers.
+    '''
+    print(
+        f"{SERVER_COUNT} servers down for {DOWN_TIME} s, {TRIALS} times. "
+        f"WS_RETRY = {SETTINGS.WS_RETRY} s"
+    )
+    await bench('polling')
+    await bench('scheduler')
+    await bench_flapping()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,72 @@
+'''
+Report memory used per tracked server for dict rows with per-server notification settings
+(the previous table layout) and __slots__ rows with shared notification settings.
+
+Run from the repository root: `python3 -m benchmarks.bench_rows`
+'''
+import tracemalloc
+from copy import deepcopy
+
+from misc.table_rows import StockRow, ValidatorRow, share_notifications, SHARED_NOTIFICATIONS
+import settings_ex as settings
+
+ROW_COUNTS = (1000, 10000)
+
+
+def dict_rows(row_class, count, notifications):
+    '''
+    Rows built the previous way: a deep copied default dict per row, with the notification
+    settings each server declares in the settings file.
+    '''
+    rows = []
+    for i in range(count):
+        row = deepcopy(row_class.DEFAULTS)
+        row['server_name'] = f"server {i}"
+        row['notifications'] = deepcopy(notifications)
+        rows.append(row)
+    return rows
+
+
+def slot_rows(row_class, count, notifications):
+    '''
+    __slots__ rows sharing identical notification settings.
+    '''
+    rows = []
+    for i in range(count):
+        row = row_class({'server_name': f"server {i}"})
+        row['notifications'] = share_notifications(deepcopy(notifications))
+        rows.append(row)
+    return rows
+
+
+def measure(build, row_class, count, notifications):
+    '''
+    :return: Bytes allocated per row
+    :rtype: float
+    '''
+    SHARED_NOTIFICATIONS.clear()
+    tracemalloc.start()
+    rows = build(row_class, count, notifications)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del rows
+    return current / count
+
+
+def main():
+    '''
+    Compare both layouts for each table and row count.
+    '''
+    notifications = settings.SERVERS[0]['notifications']
+    for row_class in (StockRow, ValidatorRow):
+        for count in ROW_COUNTS:
+            before = measure(dict_rows, row_class, count, notifications)
+            after = measure(slot_rows, row_class, count, notifications)
+            print(
+                f"{row_class.__name__:>12} x {count:>6,}: dict {before:8,.0f} B/row  "
+                f"slots {after:8,.0f} B/row  ({before / after:4.1f}x smaller)"
+            )
+
+
+if __name__ == '__main__':
+    main()
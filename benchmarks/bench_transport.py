@@ -0,0 +1,88 @@
+'''
+Compare messages/sec between the 'queue' and 'pipe' message transports.
+
+A producer process pushes recorded-style validation frames through the transport
+and a consumer process decodes them, just like the websocket process and
+response processor do.
+
+Run from the repository root: `python3 -m benchmarks.bench_transport`
+'''
+import asyncio
+import json
+import time
+from multiprocessing import Process
+
+from misc.message_transport import QueueTransport, PipeTransport
+
+MESSAGE_COUNT = 100000
+SERVER_COUNT = 5
+
+TABLE_STOCK = [
+    {'server_id': i, 'url': f"wss://server{i}.example.com:443", 'server_name': f"server{i}"}
+    for i in range(SERVER_COUNT)
+]
+
+FRAME = json.dumps({
+    'type': 'validationReceived',
+    'amendments': ['8CC0774A3BF66D1D22E76BBDA8E8A232E6B6313834301B3B23E8601196AE6455'] * 40,
+    'base_fee': 10,
+    'cookie': '1234567890123456789',
+    'flags': 2147483649,
+    'full': True,
+    'ledger_hash': 'ABCDEF0123456789' * 4,
+    'ledger_index': '80000000',
+    'load_fee': 256,
+    'master_key': 'nHU4bLE3EmSqNwfL4AP1UZeTNPrSPPP6FXLKXo2uqfHuvBQxDVKd',
+    'reserve_base': 10000000,
+    'reserve_inc': 2000000,
+    'server_version': '1745990418548031488',
+    'signature': '3045022100' + 'AB' * 64,
+    'signing_time': 750000000,
+    'validated_hash': 'ABCDEF0123456789' * 4,
+    'validation_public_key': 'n9KDJnMxfjH5Ez8DeWzWoE9ath3PnsmkUy3GAHiVjE7tn7Q7KhQ2',
+})
+
+
+def produce(transport, count):
+    '''
+    Push frames into the transport, as the websocket process would.
+    '''
+    async def run():
+        frame = FRAME.encode() if transport.raw_frames else FRAME
+        for i in range(count):
+            await transport.put_frame(TABLE_STOCK[i % SERVER_COUNT], frame)
+        transport.close()
+    asyncio.run(run())
+
+
+def consume(transport, count):
+    '''
+    Read messages until the expected count arrives.
+    '''
+    received = 0
+    while received < count:
+        received += len(transport.get_messages())
+
+
+def bench(transport, count):
+    '''
+    :return: Messages per second
+    :rtype: float
+    '''
+    producer = Process(target=produce, args=(transport, count))
+    start = time.perf_counter()
+    producer.start()
+    consume(transport, count)
+    elapsed = time.perf_counter() - start
+    producer.join()
+    return count / elapsed
+
+
+if __name__ == '__main__':
+    results = {
+        'queue': bench(QueueTransport(100), MESSAGE_COUNT),
+        'pipe (batch 100)': bench(PipeTransport(TABLE_STOCK, 100, 50), MESSAGE_COUNT),
+        'pipe (batch 1000)': bench(PipeTransport(TABLE_STOCK, 1000, 50), MESSAGE_COUNT),
+    }
+    for name, rate in results.items():
+        print(f"{name:>20}: {rate:>12,.0f} messages/sec")
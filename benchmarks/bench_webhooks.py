@@ -0,0 +1,109 @@
+'''
+Compare webhook POST latency between opening a new aiohttp session for every message
+(the previous behavior) and the shared, pooled notification session.
+
+A local stub HTTP server stands in for Discord/Mattermost/Twilio.
+
+Run from the repository root: `python3 -m benchmarks.bench_webhooks`
+'''
+import asyncio
+import statistics
+import time
+from types import SimpleNamespace
+
+import aiohttp
+from aiohttp import web
+
+from notifications.http_session import open_session, close_session
+
+MESSAGE_COUNT = 500
+CONCURRENCY = 20
+HOST = '127.0.0.1'
+PORT = 8765
+
+SETTINGS = SimpleNamespace(
+    HTTP_MAX_CONNECTIONS=100,
+    HTTP_MAX_CONNECTIONS_PER_HOST=10,
+    HTTP_DNS_CACHE_TIME=300,
+    HTTP_KEEPALIVE_TIME=60,
+    HTTP_TIMEOUT=30,
+)
+
+
+async def stub_webhook(request):
+    '''
+    Accept a webhook POST like Discord does.
+    '''
+    await request.read()
+    return web.Response(status=204)
+
+
+async def post_new_session(url, message):
+    '''
+    POST using a new session (and connection) per message.
+    '''
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, json=message) as response:
+            return response.status
+
+
+async def post_shared_session(url, message):
+    '''
+    POST using the shared notification session.
+    '''
+    session = await open_session(SETTINGS)
+    async with session.post(url, json=message) as response:
+        return response.status
+
+
+async def bench(post, url):
+    '''
+    :return: Per-message latencies in milliseconds
+    :rtype: list
+    '''
+    latencies = []
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def timed_post(i):
+        async with semaphore:
+            start = time.perf_counter()
+            await post(url, {'content': f"Benchmark message {i}"})
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    await asyncio.gather(*(timed_post(i) for i in range(MESSAGE_COUNT)))
+    return latencies
+
+
+def summarize(name, latencies):
+    '''
+    Print latency percentiles.
+    '''
+    latencies.sort()
+    print(
+        f"{name:>16}: mean {statistics.mean(latencies):7.2f} ms  "
+        f"p50 {latencies[len(latencies) // 2]:7.2f} ms  "
+        f"p95 {latencies[int(len(latencies) * 0.95)]:7.2f} ms"
+    )
+
+
+async def main():
+    '''
+    Start the stub server and compare both approaches.
+    '''
+    app = web.Application()
+    app.router.add_post('/hooks/{key}', stub_webhook)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, HOST, PORT).start()
+    url = f"http://{HOST}:{PORT}/hooks/benchmark"
+
+    try:
+        summarize('new session', await bench(post_new_session, url))
+        summarize('shared session', await bench(post_shared_session, url))
+    finally:
+        await close_session()
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,135 @@
+'''
+Check the SMTP sender against a local aiosmtpd server standing in for a mail provider.
+
+Asserts that:
+- Several notifications are sent over one SMTP connection.
+- A connection that sat idle longer than SMTP_IDLE_TIMEOUT is replaced.
+- With SMTP_DIGEST_WINDOW set, notifications to one recipient within the window are merged
+  into a single digest email.
+- Each notification's future reports it as sent.
+
+Requires aiosmtpd (`pip install aiosmtpd`), which the monitor itself doesn't need.
+
+Run from the repository root: `python3 -m benchmarks.check_smtp`
+'''
+import asyncio
+import logging
+import time
+from types import SimpleNamespace
+
+from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import AuthResult
+
+from notifications.notify_smtp import SMTPSender
+
+HOST = '127.0.0.1'
+PORT = 8025
+MESSAGE_COUNT = 5
+IDLE_TIMEOUT = 1
+DIGEST_WINDOW = 0.5
+RECIPIENT = {'smtp_to': 'operator@example.com', 'smtp_subject': 'Livenet monitor'}
+
+
+class RecordingHandler:
+    '''
+    Keep every message received, with the connection (session) it arrived on.
+    '''
+    def __init__(self):
+        self.messages = []
+
+    async def handle_DATA(self, server, session, envelope):
+        # Keep the session itself, so its id can't be reused by a later connection
+        self.messages.append((session, envelope.content.decode()))
+        return '250 Message accepted for delivery'
+
+    def sessions(self):
+        '''
+        :return: Number of connections messages arrived on
+        :rtype: int
+        '''
+        return len({id(session) for session, _ in self.messages})
+
+
+def accept_login(server, session, envelope, mechanism, auth_data):
+    '''
+    Accept any username and password.
+    '''
+    return AuthResult(success=True)
+
+
+def create_settings(digest_window=0):
+    '''
+    :rtype: SimpleNamespace
+    '''
+    return SimpleNamespace(
+        SMTP_USERNAME='monitor@example.com',
+        SMTP_PASSWORD='secret',
+        SMTP_SERVER=HOST,
+        SMTP_SUBMISSION_PORT=PORT,
+        SMTP_START_TLS=False,
+        SMTP_IDLE_TIMEOUT=IDLE_TIMEOUT,
+        SMTP_DIGEST_WINDOW=digest_window,
+    )
+
+
+async def check_connection_reuse(handler):
+    '''
+    Send several notifications, wait past the idle timeout, then send another.
+    '''
+    sender = SMTPSender(create_settings())
+    start = time.perf_counter()
+    for i in range(MESSAGE_COUNT):
+        future = await sender.submit(RECIPIENT, f"Notification {i}.")
+        assert future.result() is True, f"Notification {i} wasn't reported as sent"
+    elapsed = time.perf_counter() - start
+    assert len(handler.messages) == MESSAGE_COUNT, handler.messages
+    assert handler.sessions() == 1, f"'{handler.sessions()}' connections for one burst"
+    print(f"{MESSAGE_COUNT} messages over 1 connection in {elapsed * 1000:.1f} ms.")
+
+    await asyncio.sleep(IDLE_TIMEOUT + 0.5)
+    await sender.submit(RECIPIENT, "Notification after idling.")
+    assert handler.sessions() == 2, f"'{handler.sessions()}' connections after idling"
+    print(f"Reconnected after sitting idle for more than {IDLE_TIMEOUT} s.")
+    await sender.close()
+
+
+async def check_digest(handler):
+    '''
+    Send several notifications to one recipient within the digest window.
+    '''
+    sender = SMTPSender(create_settings(DIGEST_WINDOW))
+    bodies = [f"Digest notification {i}." for i in range(MESSAGE_COUNT)]
+    futures = [await sender.submit(RECIPIENT, body) for body in bodies]
+    assert not handler.messages, "Digest sent before the window closed"
+    await asyncio.sleep(DIGEST_WINDOW + 0.5)
+    assert all(future.result() is True for future in futures), futures
+    assert len(handler.messages) == 1, f"'{len(handler.messages)}' emails for one digest"
+    content = handler.messages[0][1]
+    assert f"({MESSAGE_COUNT} notifications)" in content, content
+    assert all(body in content for body in bodies), content
+    print(f"{MESSAGE_COUNT} notifications merged into 1 digest email.")
+    await sender.close()
+
+
+async def main():
+    '''
+    Run each check against a fresh server.
+    '''
+    # aiosmtpd warns about its own use of a deprecated attribute on every login
+    logging.getLogger('mail.log').setLevel(logging.ERROR)
+    for check in (check_connection_reuse, check_digest):
+        handler = RecordingHandler()
+        controller = Controller(
+            handler, hostname=HOST, port=PORT, authenticator=accept_login,
+            auth_require_tls=False,
+        )
+        controller.start()
+        try:
+            await check(handler)
+        finally:
+            controller.stop()
+    print("All SMTP checks passed.")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
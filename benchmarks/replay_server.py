@@ -0,0 +1,164 @@
+'''
+Serve websocket captures (see ws_connection/frame_capture.py) to the monitor, simulating
+many rippled servers.
+
+Simulated server n is at ws://HOST:PORT/n. After a client sends its subscribe command, the
+server replays the frames captured from one of the captured servers (n modulo the number of
+captured servers) with the captured timing, divided by the speed. A speed of 0 replays as
+fast as the client reads. Later commands (e.g., validation stream changes) are ignored.
+
+Run from the repository root: `python3 -m benchmarks.replay_server capture.0.gz --speed 10`
+Then add as many simulated servers to SERVERS in settings.py as needed (e.g.,
+ws://127.0.0.1:9000/0 through ws://127.0.0.1:9000/99, with 'ssl_verify': False).
+'''
+import argparse
+import asyncio
+import logging
+import time
+
+import websockets
+
+from ws_connection.frame_capture import read_capture
+
+STAMP_KEY = b'"replay_sent":'
+
+
+def load_streams(paths):
+    '''
+    :param list paths: Capture files
+    :return: Receive time and frame for every frame, for each captured server
+    :rtype: list
+    '''
+    streams = {}
+    for path in paths:
+        for received, server, frame in read_capture(path):
+            streams.setdefault(server['url'], []).append((received, frame))
+    for frames in streams.values():
+        frames.sort(key=lambda record: record[0])
+    return list(streams.values())
+
+
+def stamp(frame, sent):
+    '''
+    Add the time a frame was sent to a JSON object frame, so clients can measure latency.
+
+    :param bytes frame: JSON object
+    :param float sent: Time the frame was sent
+    :rtype: bytes
+    '''
+    frame = frame.rstrip()
+    return b'%s,%s%.6f}' % (frame[:-1], STAMP_KEY, sent)
+
+
+def read_stamp(frame):
+    '''
+    :param frame: Frame (str or bytes) stamped by the replay server
+    :return: The time the frame was sent, or None if the frame isn't stamped
+    :rtype: float
+    '''
+    if isinstance(frame, str):
+        frame = frame.encode()
+    position = frame.rfind(STAMP_KEY)
+    if position < 0:
+        return None
+    return float(frame[position + len(STAMP_KEY):].rstrip(b'} \n'))
+
+
+class ReplayServer:
+    '''
+    Replay captured frames to every client.
+
+    :param list streams: Frames for each captured server (from load_streams)
+    :param float speed: Replay speed multiple (0 for as fast as possible)
+    :param bool repeat: Start over at the end of the capture
+    :param bool stamped: Add the send time to each frame (see stamp)
+    '''
+    def __init__(self, streams, speed=1, repeat=False, stamped=False):
+        self.streams = streams
+        self.speed = float(speed)
+        self.repeat = repeat
+        self.stamped = stamped
+        self.sent = 0
+
+    async def drain(self, websocket):
+        '''
+        Read and ignore commands from the client.
+        '''
+        async for _ in websocket:
+            pass
+
+    async def handler(self, websocket):
+        '''
+        Wait for the subscribe command, then replay a captured server's frames.
+        '''
+        try:
+            number = int(websocket.request.path.strip('/') or 0)
+        except ValueError:
+            number = 0
+        frames = self.streams[number % len(self.streams)]
+        await websocket.recv()
+        drain = asyncio.create_task(self.drain(websocket))
+        try:
+            while True:
+                await self.replay(websocket, frames)
+                if not self.repeat:
+                    break
+            await drain
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            drain.cancel()
+
+    async def replay(self, websocket, frames):
+        '''
+        Send frames with their captured spacing, adjusted for speed.
+
+        :param list frames: Receive time and frame
+        '''
+        start = time.monotonic()
+        first = frames[0][0]
+        for received, frame in frames:
+            if self.speed:
+                delay = start + (received - first) / self.speed - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            if self.stamped:
+                frame = stamp(frame, time.time())
+            await websocket.send(frame, text=True)
+            self.sent += 1
+
+    async def serve(self, host, port):
+        '''
+        Serve until cancelled.
+        '''
+        async with websockets.serve(self.handler, host, port, max_size=None):
+            logging.warning(
+                "Replaying: '%d' captured servers on: 'ws://%s:%d/<n>'.",
+                len(self.streams), host, port
+            )
+            await asyncio.Future()
+
+
+def main():
+    '''
+    Parse arguments and serve captures.
+    '''
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n', maxsplit=1)[0])
+    parser.add_argument('captures', nargs='+', help="Capture files")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    parser.add_argument('--speed', type=float, default=1, help="Speed multiple (0 for max)")
+    parser.add_argument('--repeat', action='store_true', help="Loop the capture")
+    parser.add_argument('--stamp', action='store_true', help="Add send times to frames")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    server = ReplayServer(load_streams(args.captures), args.speed, args.repeat, args.stamp)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        logging.warning("Sent: '%d' frames.", server.sent)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,22 +8,43 @@ from sys import exit
 from multiprocessing import Process, Queue
 import logging
 
-from ws_connection.initialize_ws import start_websocket_loop
+from ws_connection.initialize_ws import start_websocket_loop, assign_commands
+from ws_connection.sharding import partition_servers
 from process_responses.process_output import start_output_processing
 from notifications.notification_watcher import start_notifications
 from misc import generate_tables
+from misc.message_transport import create_message_transport
+from misc.metrics import MetricsServer
+from misc import log_setup
 
 
+def stop_processes(processes):
+    '''
+    Wait for every process (including each websocket shard) to shut itself down after
+    a keyboard interrupt, then terminate any that didn't.
+
+    :param list processes: multiprocessing processes
+    '''
+    for process in processes:
+        if process.pid is None:
+            continue
+        process.join(timeout=int(settings.SHUTDOWN_TIMEOUT))
+        if process.is_alive():
+            logging.critical("Terminating process: '%s'.", process.name)
+            process.terminate()
+            process.join()
+
 def start_bot():
     '''
     Start multiprocessing processes.
     '''
     processes = []
-    message_queue = Queue()
     notification_queue = Queue()
+    metrics_queue = Queue() if settings.METRICS_PORT else None
 
     table_stock = generate_tables.create_table_stock(settings)
     table_validator = generate_tables.create_table_validation(settings)
+    message_queue = create_message_transport(settings, table_stock)
 
     args_d = {
         'settings': settings,
@@ -31,11 +52,27 @@ def start_bot():
         'table_validator': table_validator,
         'message_queue': message_queue,
         'notification_queue': notification_queue,
+        'metrics_queue': metrics_queue,
     }
 
-    processes.append(Process(target=start_websocket_loop, args=(args_d,)))
-    processes.append(Process(target=start_output_processing, args=(args_d,)))
-    processes.append(Process(target=start_notifications, args=(args_d,)))
+    assign_commands(settings, table_stock)
+    for shard, servers in enumerate(partition_servers(settings, table_stock)):
+        processes.append(
+            Process(
+                target=start_websocket_loop,
+                args=(dict(args_d, table_stock=servers), shard),
+                name=f"websocket-shard-{shard}",
+            )
+        )
+    processes.append(
+        Process(target=start_output_processing, args=(args_d,), name="response-processor")
+    )
+    processes.append(Process(target=start_notifications, args=(args_d,), name="notifications"))
+
+    metrics_server = None
+    if metrics_queue is not None:
+        metrics_server = MetricsServer(settings, metrics_queue)
+        metrics_server.start()
 
     while True:
         try:
@@ -48,8 +85,12 @@ def start_bot():
         except KeyboardInterrupt:
             logging.critical("Keyboard interrupt detected, exiting.")
             logging.critical("Final multiprocessing cleanup is running.")
+            stop_processes(processes)
         finally:
+            if metrics_server is not None:
+                metrics_server.stop()
             logging.critical("All threads have been closed.")
+            log_setup.stop_log_thread()
             exit(0)
 
 def set_logging():
@@ -60,8 +101,9 @@ def set_logging():
         filename=settings.LOG_FILE,
         level=settings.LOG_LEVEL,
         datefmt="%Y-%m-%d %H:%M:%S",
-        format='%(asctime)s %(levelname)s: %(module)s - %(funcName)s (%(lineno)d): %(message)s',
+        format='%(asctime)s %(levelname)s: %(processName)s %(module)s - %(funcName)s (%(lineno)d): %(message)s',
     )
+    log_setup.start_log_thread(settings)
 
 if __name__ == '__main__':
     set_logging()
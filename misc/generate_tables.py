@@ -2,57 +2,26 @@
 Generate the tables used for tracking stock servers and validators.
 '''
 import logging
-from copy import deepcopy
+
+from .table_rows import StockRow, ValidatorRow, share_notifications
 
 def create_table_stock(settings):
     '''
     Create a table representing each server in the settings file.
+    Servers with identical notification settings share one notification dict.
     ### This will have to be updated so the table is not created from settings.####
 
     :param settings: Config file
     :rtype: list
     '''
     table = []
-    default_dict = {
-        'server_name': None,
-        'url': None,
-        'ssl_verify': None,
-        'command': None,
-        'ws_retry_count': 0,
-        'ws_connection_task': None,
-        'notifications': None,
-        'pubkey_node': None,
-        'hostid': None,
-        'fee_base': None, # Someone should file an issue on Git to have the first
-        'base_fee': None, # 'server' response be more consistent with subsequent responses.
-        'fee_ref': None,
-        'load_base': None,
-        'reserve_base': None,
-        'reserve_inc': None,
-        'load_factor': None,
-        'load_factor_fee_escalation': None,
-        'load_factor_fee_queue': None,
-        'load_factor_fee_reference': None,
-        'load_factor_server': None,
-        'server_status': None,
-        'validated_ledgers': None,
-        'ledger_index': None,
-        'ledger_hash': None,
-        'ledger_time':None,
-        'forked': None,
-        'time_forked': None,
-        'txn_count': None,
-        'random': None,
-        'time_updated': None,
-    }
 
     logging.debug("Preparing to create initial server list.")
-    for server in settings.SERVERS:
-        server_dict = deepcopy(default_dict)
-        for key in server_dict:
-            if key in server:
-                server_dict[key] = server.get(key)
-        table.append(server_dict)
+    for server_id, server in enumerate(settings.SERVERS):
+        server_row = StockRow(server)
+        server_row['server_id'] = server_id
+        server_row['notifications'] = share_notifications(server_row['notifications'])
+        table.append(server_row)
     logging.warning("Initial server list created with '%d' items.", len(table))
     return table
 
@@ -69,37 +38,11 @@ def create_table_validation(settings):
     '''
     table = []
 
-    default_dict = {
-        'cookie': None,
-        'server_version': None,
-        'amendments': None,
-        'flags': None,
-        'base_fee': None,
-        'reserve_base': None,
-        'reserve_inc': None,
-        'full': None,
-        'ledger_hash': None,
-        'validated_hash': None,
-        'ledger_index': None,
-        'signature': None,
-        'signing_time': None,
-        'load_fee': None,
-        'forked': None,
-        'time_forked': None,
-        'time_updated': None,
-        'server_name': None,
-        'notifications': None,
-        'master_key': None,
-        'validation_public_key': None,
-    }
-
     logging.debug("Preparing to build validator dictionaries.")
     for validator in settings.VALIDATORS:
-        val_dict = deepcopy(default_dict)
-        for key in val_dict:
-            if key in validator:
-                val_dict[key] = validator.get(key)
-        table.append(val_dict)
+        val_row = ValidatorRow(validator)
+        val_row['notifications'] = share_notifications(val_row['notifications'])
+        table.append(val_row)
     logging.warning("Initial validator list created with: '%d' items.", len(table))
 
     return table
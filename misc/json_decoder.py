@@ -0,0 +1,195 @@
+'''
+Decode websocket frames using the fastest JSON library available.
+
+JSON_DECODER in settings.py selects 'orjson', 'msgspec', 'json' (the standard library), or
+'auto' (the first of those that is installed). With JSON_TYPED_STRUCTS (msgspec only),
+serverStatus, ledgerClosed, and validationReceived messages are decoded into typed structs
+that only contain the fields the monitor uses, then handed on as plain dicts so the
+response processor works the same either way.
+'''
+import json
+import logging
+import re
+from typing import Any, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+BACKENDS = ('orjson', 'msgspec', 'json')
+
+TYPE_RE = re.compile(rb'"type"\s*:\s*"(\w+)"')
+
+if msgspec is not None:
+    UnsetType = msgspec.UnsetType
+    UNSET = msgspec.UNSET
+
+    class ServerStatus(msgspec.Struct):
+        '''
+        Fields used from the server stream.
+        '''
+        type: str
+        server_status: Union[str, UnsetType] = UNSET
+        base_fee: Union[int, UnsetType] = UNSET
+        load_base: Union[int, UnsetType] = UNSET
+        load_factor: Union[int, float, UnsetType] = UNSET
+        load_factor_fee_escalation: Union[int, UnsetType] = UNSET
+        load_factor_fee_queue: Union[int, UnsetType] = UNSET
+        load_factor_fee_reference: Union[int, UnsetType] = UNSET
+        load_factor_server: Union[int, UnsetType] = UNSET
+        reserve_base: Union[int, UnsetType] = UNSET
+        reserve_inc: Union[int, UnsetType] = UNSET
+        hostid: Union[str, UnsetType] = UNSET
+        pubkey_node: Union[str, UnsetType] = UNSET
+
+    class LedgerClosed(msgspec.Struct):
+        '''
+        Fields used from the ledger stream.
+        '''
+        type: str
+        ledger_index: int
+        ledger_hash: str
+        ledger_time: Union[int, UnsetType] = UNSET
+        txn_count: Union[int, UnsetType] = UNSET
+        fee_base: Union[int, UnsetType] = UNSET
+        fee_ref: Union[int, UnsetType] = UNSET
+        reserve_base: Union[int, UnsetType] = UNSET
+        reserve_inc: Union[int, UnsetType] = UNSET
+        validated_ledgers: Union[str, UnsetType] = UNSET
+
+    class ValidationReceived(msgspec.Struct):
+        '''
+        Fields used from the validation stream.
+        '''
+        type: str
+        ledger_index: Any
+        ledger_hash: str
+        signature: str
+        validation_public_key: str
+        master_key: Union[str, UnsetType] = UNSET
+        amendments: Union[list, UnsetType] = UNSET
+        cookie: Union[str, UnsetType] = UNSET
+        server_version: Union[str, UnsetType] = UNSET
+        flags: Union[int, UnsetType] = UNSET
+        full: Union[bool, UnsetType] = UNSET
+        base_fee: Union[int, UnsetType] = UNSET
+        reserve_base: Union[int, UnsetType] = UNSET
+        reserve_inc: Union[int, UnsetType] = UNSET
+        validated_hash: Union[str, UnsetType] = UNSET
+        signing_time: Union[int, UnsetType] = UNSET
+        load_fee: Union[int, UnsetType] = UNSET
+
+    STRUCTS = {
+        b'serverStatus': ServerStatus,
+        b'ledgerClosed': LedgerClosed,
+        b'validationReceived': ValidationReceived,
+    }
+
+
+def available_backends():
+    '''
+    :return: Installed JSON libraries, fastest first
+    :rtype: list
+    '''
+    installed = {'orjson': orjson, 'msgspec': msgspec, 'json': json}
+    return [i for i in BACKENDS if installed[i] is not None]
+
+
+class FrameDecoder:
+    '''
+    Decode JSON websocket frames. Decoding errors are raised as ValueError for every backend.
+
+    :param str backend: 'auto', 'orjson', 'msgspec', or 'json'
+    :param bool typed: Decode known message types via typed structs (requires msgspec)
+    '''
+    def __init__(self, backend='auto', typed=False):
+        if backend == 'auto':
+            backend = available_backends()[0]
+        elif backend not in available_backends():
+            logging.error("JSON decoder: '%s' is not available. Using 'json'.", backend)
+            backend = 'json'
+        if typed and msgspec is None:
+            logging.error("JSON_TYPED_STRUCTS requires msgspec, which is not installed.")
+            typed = False
+        self.backend = backend
+        self.typed = typed
+        self.setup()
+
+    def __getstate__(self):
+        return {'backend': self.backend, 'typed': self.typed}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.setup()
+
+    def setup(self):
+        '''
+        Create the backend's decoders. These are rebuilt after pickling into another process.
+        '''
+        if self.backend == 'orjson':
+            self.loads = orjson.loads
+        elif self.backend == 'msgspec':
+            self.loads = msgspec.json.Decoder().decode
+        else:
+            self.loads = json.loads
+        self.struct_decoders = {}
+        if self.typed:
+            self.struct_decoders = {
+                name: msgspec.json.Decoder(struct) for name, struct in STRUCTS.items()
+            }
+
+    def decode_typed(self, frame):
+        '''
+        Decode known message types via their struct. Returns None for other messages,
+        or messages that don't match the struct.
+
+        :param bytes frame: Websocket frame
+        :rtype: dict
+        '''
+        message_type = TYPE_RE.search(frame)
+        if message_type is None or message_type.group(1) not in self.struct_decoders:
+            return None
+        try:
+            return msgspec.to_builtins(self.struct_decoders[message_type.group(1)].decode(frame))
+        except msgspec.ValidationError as error:
+            logging.info("Frame did not match its struct: '%s'.", error)
+            return None
+
+    def decode(self, frame):
+        '''
+        :param frame: Websocket frame (str or bytes)
+        :rtype: dict
+        '''
+        try:
+            if self.struct_decoders:
+                if isinstance(frame, str):
+                    frame = frame.encode()
+                data = self.decode_typed(frame)
+                if data is not None:
+                    return data
+            return self.loads(frame)
+        except ValueError:
+            raise
+        except Exception as error:
+            # msgspec.DecodeError is not a ValueError
+            raise ValueError(str(error)) from error
+
+
+def create_decoder(settings):
+    '''
+    Create the decoder specified in the settings.
+
+    :param settings: Config file
+    :rtype: FrameDecoder
+    '''
+    decoder = FrameDecoder(settings.JSON_DECODER, settings.JSON_TYPED_STRUCTS)
+    logging.warning(
+        "Using JSON decoder: '%s'. Typed structs: '%s'.", decoder.backend, decoder.typed
+    )
+    return decoder
@@ -0,0 +1,108 @@
+'''
+Keep logging off the per-message hot path.
+
+Each process hands log records to a queue, and a thread writes them to the configured
+handlers, so formatting and file I/O don't happen on the event loop. Call start_log_thread at
+the start of each process (handlers are moved to the thread, including those inherited from
+the main process), and stop_log_thread before the process exits so queued records are written.
+
+Per-message log calls are guarded by module level flags rather than calling logging.debug,
+etc. on every message, as even a disabled log call adds up at thousands of messages per
+second. Per-message log calls are debug traces, so check DEBUG (cached by start_log_thread),
+or SAMPLED for tracing: with DEBUG enabled, sample() marks one in every LOG_SAMPLE_RATE
+messages to be traced through the response processor.
+'''
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+DEBUG = False
+SAMPLED = False
+SAMPLE_RATE = 1
+
+LISTENER = None
+sample_count = 0
+
+
+class BackgroundHandler(QueueHandler):
+    '''
+    Queue records for handlers running in a thread.
+
+    The message is formatted with its arguments before the record is queued, so the logging
+    thread never reads rows or messages that the event loop has since changed. The rest of
+    the formatting (handler formatters and file I/O) is left to the logging thread.
+
+    :param list handlers: Handlers that write records
+    '''
+    def __init__(self, handlers):
+        super().__init__(queue.SimpleQueue())
+        self.handlers = handlers
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def refresh_levels(settings=None):
+    '''
+    Cache whether the root logger is enabled for debug messages.
+
+    :param settings: Config file (for LOG_SAMPLE_RATE)
+    '''
+    global DEBUG, SAMPLE_RATE
+    DEBUG = logging.getLogger().isEnabledFor(logging.DEBUG)
+    if settings is not None:
+        SAMPLE_RATE = max(1, int(getattr(settings, 'LOG_SAMPLE_RATE', 1)))
+
+def sample():
+    '''
+    Decide whether to trace the next message. Call once per message.
+
+    :rtype: bool
+    '''
+    global SAMPLED, sample_count
+    if DEBUG:
+        sample_count += 1
+        SAMPLED = sample_count % SAMPLE_RATE == 0
+    return SAMPLED
+
+def start_log_thread(settings=None):
+    '''
+    Write this process's log records from a thread.
+
+    :param settings: Config file
+    '''
+    global LISTENER
+    root = logging.getLogger()
+    handlers = []
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+        if isinstance(handler, BackgroundHandler):
+            # Inherited from the main process, whose logging thread doesn't exist here
+            handlers.extend(handler.handlers)
+        else:
+            handlers.append(handler)
+    refresh_levels(settings)
+    if not handlers:
+        # Logging isn't configured, so records go to logging.lastResort
+        return
+    background = BackgroundHandler(handlers)
+    root.addHandler(background)
+    LISTENER = QueueListener(background.queue, *handlers, respect_handler_level=True)
+    LISTENER.start()
+
+def stop_log_thread():
+    '''
+    Write queued records and stop the logging thread. Later records are written directly.
+    '''
+    global LISTENER
+    if LISTENER is not None:
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            if isinstance(handler, BackgroundHandler):
+                root.removeHandler(handler)
+        for handler in LISTENER.handlers:
+            root.addHandler(handler)
+        LISTENER.stop()
+        LISTENER = None
@@ -0,0 +1,302 @@
+'''
+Move websocket messages from the websocket process to the response processor.
+
+Two transports are available, selected with MESSAGE_TRANSPORT in settings.py:
+'queue' - Frames are JSON decoded in the websocket process and each message is pickled
+    through a multiprocessing Queue.
+'pipe' - Raw frames are tagged with a small server ID, batched into length prefixed
+    records, and written to a pipe. The response processor decodes the frames.
+
+Messages from remote servers carry the monotonic time their frame was received ('received'),
+for latency tracing (see misc/tracing.py).
+
+With multiple websocket shards, every shard puts messages into the same Queue, or writes to
+its own pipe (so batches from different shards can't interleave).
+'''
+import asyncio
+import json
+import logging
+import queue
+import struct
+import threading
+import time
+from multiprocessing import Pipe, Queue
+from multiprocessing.connection import wait
+
+from . import metrics
+from .json_decoder import FrameDecoder, create_decoder
+
+# Each record in a batch is: server ID (uint16), receive time (double, 0 for messages
+# generated by the monitor), frame length (uint32), frame bytes
+RECORD_HEADER = struct.Struct('!HdI')
+
+
+class QueueTransport:
+    '''
+    Pass decoded messages one at a time through a multiprocessing Queue.
+
+    :param int batch_size: Max number of messages to read from the queue at once
+    :param FrameDecoder decoder: JSON decoder for websocket frames
+    '''
+    raw_frames = False
+
+    def __init__(self, batch_size, decoder=None):
+        self.queue = Queue()
+        self.batch_size = int(batch_size)
+        self.decoder = decoder or FrameDecoder()
+
+    def select_shard(self, shard):
+        '''
+        All shards share the queue.
+
+        :param int shard: Websocket shard number
+        '''
+
+    async def put_frame(self, server, frame, received=None):
+        '''
+        Decode a websocket frame and pass it to the response processor.
+
+        :param dict server: The server the frame was received from
+        :param str frame: Websocket frame
+        :param float received: Monotonic time the frame was received
+        '''
+        try:
+            start = time.perf_counter()
+            data = self.decoder.decode(frame)
+            metrics.observe('monitor_decode_seconds', time.perf_counter() - start)
+        except ValueError as error:
+            logging.warning(
+                "Server: '%s'. Unable to decode JSON: '%s'. Error: '%s'.",
+                server.get('server_name'), frame, error
+            )
+            return
+        self.queue.put({"server_url": server.get('url'), "data": data, "received": received})
+
+    async def put_message(self, server, data):
+        '''
+        Pass a message generated by the monitor (rather than a remote server) to the
+        response processor.
+
+        :param dict server: The server the message describes
+        :param dict data: Message content
+        '''
+        self.queue.put({"server_url": server.get('url'), "data": data})
+
+    async def flush_forever(self):
+        '''
+        Messages are not buffered, so there is nothing to flush.
+        '''
+
+    def depth(self):
+        '''
+        :return: Messages waiting in the queue
+        :rtype: int
+        '''
+        return self.queue.qsize()
+
+    def close(self):
+        '''
+        Messages are not buffered, so there is nothing to close.
+        '''
+
+    def get_messages(self, timeout=None):
+        '''
+        Wait for the next message, then drain any others that are already waiting.
+
+        :param float timeout: Seconds to wait before giving up and returning no messages
+        :rtype: list
+        '''
+        try:
+            messages = [self.queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(messages) < self.batch_size:
+            try:
+                messages.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return messages
+
+
+class PipeTransport:
+    '''
+    Pass batches of raw websocket frames through a pipe.
+
+    :param list table_stock: Servers being monitored, with their 'server_id'
+    :param int batch_size: Flush after this many frames are buffered
+    :param int flush_ms: Flush buffered frames at least this often (milliseconds)
+    :param int shards: Number of websocket processes writing to the transport
+    :param FrameDecoder decoder: JSON decoder for websocket frames
+    '''
+    raw_frames = True
+
+    def __init__(self, table_stock, batch_size, flush_ms, shards=1, decoder=None):
+        self.decoder = decoder or FrameDecoder()
+        self.pipes = [Pipe(duplex=False) for _ in range(int(shards))]
+        self.readers = [reader for reader, _ in self.pipes]
+        self.writer = self.pipes[0][1]
+        self.server_urls = {server['server_id']: server['url'] for server in table_stock}
+        self.batch_size = int(batch_size)
+        self.flush_interval = int(flush_ms) / 1000
+        self.buffer = []
+        self.buffered = 0
+        self.outbox = None
+        self.writer_thread = None
+
+    def select_shard(self, shard):
+        '''
+        Write to the pipe belonging to a websocket shard. Call from the shard's process.
+
+        :param int shard: Websocket shard number
+        '''
+        self.writer = self.pipes[shard][1]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['outbox'] = None
+        state['writer_thread'] = None
+        return state
+
+    async def put_frame(self, server, frame, received=None):
+        '''
+        Buffer a raw websocket frame.
+
+        :param dict server: The server the frame was received from
+        :param bytes frame: Websocket frame
+        :param float received: Monotonic time the frame was received
+        '''
+        if isinstance(frame, str):
+            frame = frame.encode()
+        self.buffer.append(
+            RECORD_HEADER.pack(server['server_id'], received or 0.0, len(frame))
+        )
+        self.buffer.append(frame)
+        self.buffered += 1
+        if self.buffered >= self.batch_size:
+            self.flush()
+
+    async def put_message(self, server, data):
+        '''
+        Buffer a message generated by the monitor (rather than a remote server).
+
+        :param dict server: The server the message describes
+        :param dict data: Message content
+        '''
+        await self.put_frame(server, json.dumps(data).encode())
+
+    def write_batches(self):
+        '''
+        Write batches to the pipe from a thread, so a slow reader can't block the event loop.
+        '''
+        while True:
+            payload = self.outbox.get()
+            if payload is None:
+                break
+            self.writer.send_bytes(payload)
+
+    def flush(self):
+        '''
+        Hand all buffered frames to the writer thread as a single batch.
+        '''
+        if not self.buffered:
+            return
+        if self.writer_thread is None:
+            self.outbox = queue.SimpleQueue()
+            self.writer_thread = threading.Thread(target=self.write_batches, daemon=True)
+            self.writer_thread.start()
+        self.outbox.put(b''.join(self.buffer))
+        self.buffer = []
+        self.buffered = 0
+
+    def close(self):
+        '''
+        Flush remaining frames and wait for the writer thread to finish.
+        '''
+        self.flush()
+        if self.writer_thread is not None:
+            self.outbox.put(None)
+            self.writer_thread.join()
+            self.writer_thread = None
+
+    def depth(self):
+        '''
+        :return: Frames this websocket shard hasn't written to its pipe yet (approximate)
+        :rtype: int
+        '''
+        waiting = self.outbox.qsize() if self.outbox is not None else 0
+        return self.buffered + waiting * self.batch_size
+
+    async def flush_forever(self):
+        '''
+        Periodically flush partially filled batches.
+        '''
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            self.flush()
+
+    def get_messages(self, timeout=None):
+        '''
+        Wait for the next batches and decode the frames they contain.
+
+        :param float timeout: Seconds to wait before giving up and returning no messages
+        :rtype: list
+        '''
+        messages = []
+        for reader in wait(self.readers, timeout):
+            try:
+                self.decode_batch(reader.recv_bytes(), messages)
+            except EOFError:
+                logging.critical("A websocket shard closed its pipe.")
+                self.readers.remove(reader)
+        return messages
+
+    def decode_batch(self, payload, messages):
+        '''
+        Decode the frames in a batch.
+
+        :param bytes payload: Batch of records
+        :param list messages: Decoded messages are appended here
+        '''
+        offset = 0
+        while offset < len(payload):
+            server_id, received, length = RECORD_HEADER.unpack_from(payload, offset)
+            offset += RECORD_HEADER.size
+            frame = payload[offset:offset + length]
+            offset += length
+            try:
+                start = time.perf_counter()
+                data = self.decoder.decode(frame)
+                metrics.observe('monitor_decode_seconds', time.perf_counter() - start)
+            except ValueError as error:
+                logging.warning(
+                    "Server: '%s'. Unable to decode JSON: '%s'. Error: '%s'.",
+                    self.server_urls.get(server_id), frame, error
+                )
+                continue
+            messages.append({
+                "server_url": self.server_urls.get(server_id), "data": data,
+                "received": received or None,
+            })
+
+
+def create_message_transport(settings, table_stock):
+    '''
+    Create the transport specified in the settings.
+
+    :param settings: Config file
+    :param list table_stock: Servers being monitored
+    '''
+    decoder = create_decoder(settings)
+    if settings.MESSAGE_TRANSPORT == 'pipe':
+        transport = PipeTransport(
+            table_stock, settings.TRANSPORT_BATCH_SIZE, settings.TRANSPORT_FLUSH_MS,
+            settings.WS_SHARDS, decoder
+        )
+    else:
+        if settings.MESSAGE_TRANSPORT != 'queue':
+            logging.error(
+                "Unknown MESSAGE_TRANSPORT: '%s'. Using 'queue'.", settings.MESSAGE_TRANSPORT
+            )
+        transport = QueueTransport(settings.TRANSPORT_BATCH_SIZE, decoder)
+    logging.warning("Using message transport: '%s'.", type(transport).__name__)
+    return transport
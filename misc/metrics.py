@@ -0,0 +1,288 @@
+'''
+Collect pipeline metrics in every process, and serve them from the main process in the
+Prometheus text exposition format.
+
+With METRICS_PORT set, each process records counters, gauges, and histograms in its own
+registry (recording is a few dict operations, and nothing when metrics are disabled). Every
+METRICS_INTERVAL seconds, each process sends a snapshot of its registry to the main process,
+which serves the latest snapshot from every process at http://METRICS_HOST:METRICS_PORT/metrics
+with a 'process' label.
+'''
+import asyncio
+import bisect
+import logging
+import multiprocessing
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Name: (type, help, label names)
+METRICS = {
+    'monitor_frames_total': (
+        'counter', "Websocket frames received.", ('server',)
+    ),
+    'monitor_reconnects_total': (
+        'counter', "Websocket reconnection attempts.", ('server',)
+    ),
+    'monitor_message_queue_depth': (
+        'gauge', "Messages waiting for the response processor ('queue' transport), or frames "
+        "a websocket shard hasn't written to its pipe yet ('pipe' transport).", ()
+    ),
+    'monitor_decode_seconds': (
+        'histogram', "Time spent JSON decoding each websocket frame.", ()
+    ),
+    'monitor_message_ingest_seconds': (
+        'histogram', "Time from receiving a websocket frame to the response processor starting "
+        "on its message.", ()
+    ),
+    'monitor_process_seconds': (
+        'histogram', "Time the response processor spent on each message.", ('type',)
+    ),
+    'monitor_fork_check_seconds': (
+        'histogram', "Time spent checking for forked servers.", ()
+    ),
+    'monitor_console_render_seconds': (
+        'histogram', "Time spent drawing the console.", ()
+    ),
+    'monitor_notification_queue_depth': (
+        'gauge', "Notifications waiting for the notification process.", ()
+    ),
+    'monitor_notification_backlog': (
+        'gauge', "Notifications waiting for a notification worker.", ('channel',)
+    ),
+    'monitor_notification_seconds': (
+        'histogram', "Time spent sending each notification.", ('channel',)
+    ),
+    'monitor_notification_failures_total': (
+        'counter', "Notifications that failed to send.", ('channel',)
+    ),
+    'monitor_alert_stage_seconds': (
+        'histogram', "Time notifications spent in each stage before being dispatched "
+        "(see misc/tracing.py).", ('stage',)
+    ),
+    'monitor_alert_seconds': (
+        'histogram', "Time from receiving the websocket frame that raised a notification (or "
+        "from the start of the check that raised it) to a channel sending it.",
+        ('source', 'channel')
+    ),
+}
+BUCKETS = (0.00001, 0.0001, 0.001, 0.01, 0.1, 1, 10) # Histogram bucket upper bounds (seconds)
+
+REGISTRY = None
+
+
+class Registry:
+    '''
+    Metric values for one process.
+
+    Counters and gauges are floats. Histograms are a list holding the count in each bucket
+    (the last bucket is +Inf), followed by the sum of observations.
+    '''
+    def __init__(self):
+        self.values = {} # (name, label values): value
+        self.gauges = {} # (name, label values): function returning the value
+
+    def snapshot(self):
+        '''
+        :return: Current values, with gauge functions evaluated
+        :rtype: dict
+        '''
+        values = {
+            key: list(value) if isinstance(value, list) else value
+            for key, value in list(self.values.items())
+        }
+        for key, function in self.gauges.items():
+            try:
+                values[key] = function()
+            except (NotImplementedError, OSError, ValueError):
+                # multiprocessing Queue.qsize() isn't implemented on macOS
+                pass
+        return values
+
+
+def enable():
+    '''
+    Start recording metrics in this process.
+    '''
+    global REGISTRY
+    if REGISTRY is None:
+        REGISTRY = Registry()
+
+def inc(name, labels=(), amount=1):
+    '''
+    :param str name: Counter name
+    :param tuple labels: Label values
+    :param float amount: Amount to increase the counter by
+    '''
+    if REGISTRY is not None:
+        key = (name, labels)
+        REGISTRY.values[key] = REGISTRY.values.get(key, 0) + amount
+
+def observe(name, seconds, labels=()):
+    '''
+    :param str name: Histogram name
+    :param float seconds: Observed duration
+    :param tuple labels: Label values
+    '''
+    if REGISTRY is not None:
+        key = (name, labels)
+        histogram = REGISTRY.values.get(key)
+        if histogram is None:
+            histogram = REGISTRY.values[key] = [0] * (len(BUCKETS) + 2)
+        histogram[bisect.bisect_left(BUCKETS, seconds)] += 1
+        histogram[-1] += seconds
+
+def register_gauge(name, function, labels=()):
+    '''
+    Read a gauge when a snapshot is taken, rather than updating it as it changes.
+
+    :param str name: Gauge name
+    :param function: Function returning the gauge's value
+    :param tuple labels: Label values
+    '''
+    if REGISTRY is not None:
+        REGISTRY.gauges[(name, labels)] = function
+
+async def publish_forever(metrics_queue, interval):
+    '''
+    Send a snapshot of this process's metrics to the main process every interval.
+
+    :param metrics_queue: multiprocessing Queue read by the MetricsServer
+    :param float interval: Seconds between snapshots
+    '''
+    name = multiprocessing.current_process().name
+    while True:
+        try:
+            await asyncio.sleep(float(interval))
+            metrics_queue.put((name, REGISTRY.snapshot()))
+        except (asyncio.CancelledError, KeyboardInterrupt):
+            break
+        except Exception as error:
+            logging.critical("Otherwise uncaught exception publishing metrics: '%s'.", error)
+
+
+def escape(value):
+    '''
+    :rtype: str
+    '''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values):
+    '''
+    :rtype: str
+    '''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + '}'
+
+def render(snapshots):
+    '''
+    :param dict snapshots: Process names mapped to their latest snapshot
+    :return: Prometheus text exposition
+    :rtype: str
+    '''
+    series = {name: [] for name in METRICS}
+    for process, snapshot in sorted(snapshots.items()):
+        for (name, labels), value in snapshot.items():
+            if name in series:
+                series[name].append(((process,) + tuple(labels), value))
+
+    lines = []
+    for name, (kind, description, label_names) in METRICS.items():
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        label_names = ('process',) + label_names
+        for labels, value in sorted(series[name], key=lambda item: item[0]):
+            if kind != 'histogram':
+                lines.append(f"{name}{format_labels(label_names, labels)} {value}")
+                continue
+            count = 0
+            for bound, bucket in zip(BUCKETS + ('+Inf',), value):
+                count += bucket
+                bucket_labels = format_labels(label_names + ('le',), labels + (bound,))
+                lines.append(f"{name}_bucket{bucket_labels} {count}")
+            lines.append(f"{name}_sum{format_labels(label_names, labels)} {value[-1]}")
+            lines.append(f"{name}_count{format_labels(label_names, labels)} {count}")
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    '''
+    Serve the metrics page.
+    '''
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug("Metrics request: '%s'.", format % args)
+
+
+class MetricsServer:
+    '''
+    Collect snapshots from every process, and serve them over HTTP. Runs in the main process.
+
+    :param settings: Config file
+    :param metrics_queue: multiprocessing Queue each process sends snapshots through
+    '''
+    def __init__(self, settings, metrics_queue):
+        self.settings = settings
+        self.metrics_queue = metrics_queue
+        self.snapshots = {} # Process name: latest snapshot
+        self.lock = threading.Lock()
+        self.http = None
+        self.threads = []
+
+    def render(self):
+        '''
+        :rtype: str
+        '''
+        with self.lock:
+            snapshots = dict(self.snapshots)
+        return render(snapshots)
+
+    def collect(self):
+        '''
+        Keep the latest snapshot from each process.
+        '''
+        while True:
+            item = self.metrics_queue.get()
+            if item is None:
+                break
+            with self.lock:
+                self.snapshots[item[0]] = item[1]
+
+    def start(self):
+        '''
+        Start collecting snapshots and serving HTTP requests.
+        '''
+        self.http = ThreadingHTTPServer(
+            (self.settings.METRICS_HOST, int(self.settings.METRICS_PORT)), MetricsHandler
+        )
+        self.http.daemon_threads = True
+        self.http.metrics = self
+        self.threads = [
+            threading.Thread(target=self.collect, name='MetricsCollector', daemon=True),
+            threading.Thread(target=self.http.serve_forever, name='MetricsServer', daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+        logging.warning(
+            "Serving metrics at: 'http://%s:%s/metrics'.",
+            self.settings.METRICS_HOST, self.settings.METRICS_PORT
+        )
+
+    def stop(self):
+        '''
+        Stop serving and collecting.
+        '''
+        if self.http is not None:
+            self.http.shutdown()
+            self.http.server_close()
+        self.metrics_queue.put(None)
+        for thread in self.threads:
+            thread.join(1)
@@ -0,0 +1,170 @@
+'''
+Compact row objects for the stock server and validator tables.
+
+Rows store a fixed set of fields in __slots__ instead of a per-row dict, but keep dict style
+access (row['key'], row.get('key'), 'key' in row, iteration, etc.), so code that treats rows as
+dictionaries keeps working. Setting a key that is not a field raises KeyError.
+'''
+import json
+from collections.abc import Mapping, MutableMapping
+from copy import deepcopy
+
+SHARED_NOTIFICATIONS = {}
+
+def share_notifications(notifications):
+    '''
+    Return a single shared copy of a notification config, so rows with identical
+    notification settings reference one dict. Shared configs must not be modified.
+
+    :param dict notifications: Notification settings for a server or validator
+    :rtype: dict
+    '''
+    if notifications is None:
+        return None
+    key = json.dumps(notifications, sort_keys=True, default=str)
+    return SHARED_NOTIFICATIONS.setdefault(key, notifications)
+
+def json_default(value):
+    '''
+    json.dumps default that serializes rows as dicts.
+    '''
+    if isinstance(value, Mapping):
+        return dict(value)
+    return str(value)
+
+
+class TableRow(MutableMapping):
+    '''
+    Base class for table rows. Subclasses list their fields and default values in DEFAULTS.
+    '''
+    __slots__ = ()
+    DEFAULTS = {}
+    FIELDS = ()
+    FIELD_SET = frozenset()
+    # Fields that are shared by reference (not deep copied) when a row is copied
+    SHARED = frozenset(['notifications', 'ws_connection_task'])
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.FIELDS = tuple(cls.DEFAULTS)
+        cls.FIELD_SET = frozenset(cls.FIELDS)
+
+    def __init__(self, values=None):
+        for field, default in self.DEFAULTS.items():
+            setattr(self, field, default)
+        if values:
+            for field in self.FIELDS:
+                if field in values:
+                    setattr(self, field, values[field])
+
+    def __getitem__(self, key):
+        if key not in self.FIELD_SET:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.FIELD_SET:
+            raise KeyError(f"'{key}' is not a field of {type(self).__name__}")
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        raise TypeError(f"Fields can't be deleted from {type(self).__name__}")
+
+    def __contains__(self, key):
+        return key in self.FIELD_SET
+
+    def __iter__(self):
+        return iter(self.FIELDS)
+
+    def __len__(self):
+        return len(self.FIELDS)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self)!r})"
+
+    def __deepcopy__(self, memo):
+        row = type(self).__new__(type(self))
+        for field in self.FIELDS:
+            value = getattr(self, field)
+            setattr(row, field, value if field in self.SHARED else deepcopy(value, memo))
+        return row
+
+    def get(self, key, default=None):
+        if key not in self.FIELD_SET:
+            return default
+        return getattr(self, key)
+
+
+class StockRow(TableRow):
+    '''
+    A stock server being monitored.
+    '''
+    DEFAULTS = {
+        'server_id': None,
+        'server_name': None,
+        'url': None,
+        'ssl_verify': None,
+        'command': None,
+        'ws_retry_count': 0,
+        'ws_failures': 0, # Consecutive failed connection attempts
+        'ws_circuit': 'closed', # Reconnection circuit breaker state
+        'ws_connected': False,
+        'ws_connected_time': None, # Monotonic time the current connection subscribed
+        'ws_connection_task': None,
+        'notifications': None,
+        'pubkey_node': None,
+        'hostid': None,
+        'fee_base': None, # Someone should file an issue on Git to have the first
+        'base_fee': None, # 'server' response be more consistent with subsequent responses.
+        'fee_ref': None,
+        'load_base': None,
+        'reserve_base': None,
+        'reserve_inc': None,
+        'load_factor': None,
+        'load_factor_fee_escalation': None,
+        'load_factor_fee_queue': None,
+        'load_factor_fee_reference': None,
+        'load_factor_server': None,
+        'server_status': None,
+        'validated_ledgers': None,
+        'ledger_index': None,
+        'ledger_hash': None,
+        'ledger_time':None,
+        'forked': None,
+        'time_forked': None,
+        'txn_count': None,
+        'random': None,
+        'time_updated': None,
+    }
+    __slots__ = tuple(DEFAULTS)
+
+
+class ValidatorRow(TableRow):
+    '''
+    A validator being monitored.
+    '''
+    DEFAULTS = {
+        'cookie': None,
+        'server_version': None,
+        'version': None, # Human readable server_version
+        'amendments': None,
+        'flags': None,
+        'base_fee': None,
+        'reserve_base': None,
+        'reserve_inc': None,
+        'full': None,
+        'ledger_hash': None,
+        'validated_hash': None,
+        'ledger_index': None,
+        'signature': None,
+        'signing_time': None,
+        'load_fee': None,
+        'forked': None,
+        'time_forked': None,
+        'time_updated': None,
+        'server_name': None,
+        'notifications': None,
+        'master_key': None,
+        'validation_public_key': None,
+    }
+    __slots__ = tuple(DEFAULTS)
@@ -0,0 +1,127 @@
+'''
+Trace how long alerts take to get from a websocket frame to each notification channel.
+
+Websocket shards stamp each message with the monotonic time its frame was received (the
+monotonic clock is shared by every process on a host). The response processor stamps each
+notification with a trace: the source that raised it ('message', 'fork_check', or
+'heartbeat'), when the frame was received (for 'message'), when the processor started on the
+message or check ('started'), and when the notification was queued ('queued'). The
+notification process adds when it read the notification ('dequeued'), and when a worker
+started dispatching it ('dispatched'). Each notifier stamps the time of its service's
+HTTP/SMTP response under the channel's name (for SMTP digests, when the digest was sent).
+
+Stage durations and end-to-end latency are recorded as metrics. With ALERT_TRACE set, each
+notification's trace is also logged.
+'''
+import logging
+import time
+
+from . import metrics
+
+# Stage name, start stamp, end stamp
+STAGES = (
+    ('ingest', 'received', 'started'),
+    ('processing', 'started', 'queued'),
+    ('notification_queue', 'queued', 'dequeued'),
+    ('backlog', 'dequeued', 'dispatched'),
+)
+STAMPS = ('received', 'started', 'queued', 'dequeued', 'dispatched')
+
+
+class TracedQueue:
+    '''
+    Stamp each notification put into the notification queue with a trace.
+
+    :param notification_queue: Outbound notification queue
+    '''
+    def __init__(self, notification_queue):
+        self.notification_queue = notification_queue
+        self.source = None
+        self.started = None
+        self.received = None
+
+    def begin(self, source, started, received=None):
+        '''
+        Set the trace for notifications raised until the next call.
+
+        :param str source: What is being processed ('message', 'fork_check', etc.)
+        :param float started: Monotonic time processing started
+        :param float received: Monotonic time the message's frame was received
+        '''
+        self.source = source
+        self.started = started
+        self.received = received
+
+    def put(self, notification):
+        '''
+        :param dict notification: Message and notification information
+        '''
+        trace = {'source': self.source, 'started': self.started, 'queued': time.monotonic()}
+        if self.received is not None:
+            trace['received'] = self.received
+        self.notification_queue.put(dict(notification, trace=trace))
+
+
+def stamp(notification, name):
+    '''
+    Add the current time to a notification's trace.
+
+    :param dict notification: Message and notification information
+    :param str name: Stamp name
+    '''
+    trace = notification.get('trace')
+    if trace is not None:
+        trace[name] = time.monotonic()
+
+def record_dispatch(notification):
+    '''
+    Record how long the notification spent in each stage before it was dispatched.
+
+    :param dict notification: Message and notification information
+    '''
+    trace = notification.get('trace')
+    if trace is None:
+        return
+    for stage, start, end in STAGES:
+        if start in trace and end in trace:
+            metrics.observe('monitor_alert_stage_seconds', trace[end] - trace[start], (stage,))
+
+def record_delivery(settings, notification, channel, sent):
+    '''
+    Record the end-to-end latency of a notification sent through a channel, up to the
+    notifier's last response from its service (or now, if there was no response). How long
+    the send itself took is recorded by the notification dispatcher.
+
+    :param settings: Config file
+    :param dict notification: Message and notification information
+    :param str channel: Notification channel name (e.g., 'discord')
+    :param bool sent: Whether the channel sent the notification
+    '''
+    trace = notification.get('trace')
+    if trace is None:
+        return
+    done = trace.setdefault(channel, time.monotonic())
+    if sent:
+        origin = trace.get('received', trace['started'])
+        metrics.observe('monitor_alert_seconds', done - origin, (trace['source'], channel))
+    if settings.ALERT_TRACE:
+        logging.warning(
+            "Alert trace: '%s'. %s sent: '%s'. Message: '%s'.",
+            format_trace(trace), channel, sent, notification.get('message')
+        )
+
+def format_trace(trace):
+    '''
+    :param dict trace: Notification trace
+    :return: Each stamp, in milliseconds since the first stamp
+    :rtype: str
+    '''
+    stamps = [(name, trace[name]) for name in STAMPS if name in trace]
+    stamps.extend(
+        (name, value) for name, value in trace.items()
+        if name not in STAMPS and name != 'source'
+    )
+    origin = stamps[0][1]
+    return f"source: {trace['source']}, " + ', '.join(
+        f"{name}: {(value - origin) * 1000:.1f} ms" for name, value in stamps
+    )
@@ -0,0 +1,31 @@
+'''
+Helpers for notifiers reporting what happened to a notification.
+
+Each send_<channel> function returns (sent, retry):
+- sent: True if every destination that isn't being retried accepted the notification,
+  otherwise False. Channels that send later (SMTP digests) return a future that resolves to
+  this instead.
+- retry: None, or (notification, delay) to send again: a copy of the notification holding only
+  the destinations that failed with an error worth retrying, and the seconds to wait first
+  (None for the dispatcher's exponential backoff).
+
+Retries are scheduled by the notification dispatcher, so a notifier never sleeps while it
+holds one of its channel's workers.
+'''
+
+def limit_destinations(notification, channel, key, destinations):
+    '''
+    Copy a notification, keeping only some of a channel's destinations.
+
+    :param dict notification: Message and notification information
+    :param str channel: Notification channel name (e.g., 'mattermost')
+    :param str key: Channel setting holding the destinations (e.g., 'mattermost_servers')
+    :param list destinations: Destinations to keep
+    :rtype: dict
+    '''
+    notifications = notification['server']['notifications']
+    channel_settings = dict(notifications[channel], **{key: destinations})
+    server = dict(
+        notification['server'], notifications=dict(notifications, **{channel: channel_settings})
+    )
+    return dict(notification, server=server)
@@ -0,0 +1,52 @@
+'''
+Share a single pooled HTTP session between all webhook notifiers in the notification process,
+so connections (and their TLS handshakes) are reused across notifications.
+'''
+import logging
+
+import aiohttp
+
+SESSION = None
+
+async def open_session(settings):
+    '''
+    Create the shared session. This must be called from inside the notification event loop.
+
+    :param settings: Config file
+    :rtype: aiohttp.ClientSession
+    '''
+    global SESSION
+    if SESSION is None or SESSION.closed:
+        connector = aiohttp.TCPConnector(
+            limit=int(settings.HTTP_MAX_CONNECTIONS),
+            limit_per_host=int(settings.HTTP_MAX_CONNECTIONS_PER_HOST),
+            ttl_dns_cache=int(settings.HTTP_DNS_CACHE_TIME),
+            keepalive_timeout=int(settings.HTTP_KEEPALIVE_TIME),
+        )
+        SESSION = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(total=int(settings.HTTP_TIMEOUT)),
+        )
+        logging.info("Opened shared HTTP session for notifications.")
+    return SESSION
+
+async def get_session(settings):
+    '''
+    Return the shared session, opening it if needed.
+
+    :param settings: Config file
+    :rtype: aiohttp.ClientSession
+    '''
+    if SESSION is None or SESSION.closed:
+        return await open_session(settings)
+    return SESSION
+
+async def close_session():
+    '''
+    Close the shared session and its pooled connections.
+    '''
+    global SESSION
+    if SESSION is not None and not SESSION.closed:
+        await SESSION.close()
+        logging.warning("Closed shared HTTP session for notifications.")
+    SESSION = None
@@ -5,54 +5,401 @@ Notifications should be sent here to be dispatched, not to individual messaging
 '''
 import logging
 import asyncio
+import json
+import os
+import time
+from collections import deque
 
+from misc import log_setup, metrics, tracing
+from misc.table_rows import json_default
 from .notify_twilio import send_twilio
 from .notify_discord import send_discord
 from .notify_slack import send_slack
 from .notify_mattermost import send_mattermost
-from .notify_smtp import send_smtp
+from .notify_smtp import send_smtp, close_sender
+from .http_session import open_session, close_session
 
-async def dispatch_notification(settings, notification):
+def spill_path(path, channel):
     '''
-    Determine where to send the message, and dispatch it.
+    :param str path: NOTIFY_SPILL_FILE
+    :param str channel: Notification channel name (e.g., 'discord')
+    :return: The spill file for a channel
+    :rtype: str
+    '''
+    root, extension = os.path.splitext(path)
+    return f"{root}.{channel}{extension}"
+
+class ChannelBacklog:
+    '''
+    A bounded backlog of notifications waiting to be sent through one notification channel.
+
+    When the backlog is full, NOTIFY_OVERFLOW_POLICY decides what happens to new notifications:
+    'drop_oldest' discards the oldest queued notification, 'coalesce' merges the new notification
+    into one already queued for the same recipients (or drops the oldest if there isn't one),
+    and 'spill' writes it to the channel's spill file (NOTIFY_SPILL_FILE with the channel name
+    added, e.g., 'notification_spill.discord.jsonl') until the backlog drains.
 
     :param settings: Config file
-    :param dict notification: Message and notification information
+    :param str channel: Notification channel name (e.g., 'discord')
     '''
-    recipients = notification['server']['notifications']
-
-    tasks = []
-    for i in settings.KNOWN_NOTIFICATIONS:
-        if i in recipients.keys():
-            # Check if the individual recipient enabled a given notification type
-            allowed = recipients.get(str(i)).get('notify_' + str(i))
-            # Check if the admin has enabled a given notification type
-            allowed_global = getattr(settings, f"SEND_{i.upper()}", None)
-
-        if allowed is True and allowed_global is True:
-            notification_function = "send_" + str(i)
-            logging.info("Preparing to send notification via '%s'", i)
-
-            possibles = globals().copy()
-            possibles.update(locals())
-            method = possibles.get(notification_function)
-            if method:
-                tasks.append(
-                    asyncio.create_task(method(settings, notification))
+    def __init__(self, settings, channel):
+        self.settings = settings
+        self.channel = channel
+        self.backlog = deque()
+        self.backlog_max = int(settings.NOTIFY_BACKLOG_MAX)
+        self.spill_file = spill_path(settings.NOTIFY_SPILL_FILE, channel)
+        self.ready = asyncio.Event()
+        self.dropped = 0
+        self.coalesced = 0
+        self.spilled = 0
+        # Pick up notifications that were spilled to disk before a restart
+        self.spill_pending = settings.NOTIFY_OVERFLOW_POLICY == 'spill'
+
+    def __len__(self):
+        return len(self.backlog)
+
+    async def put(self, notification):
+        '''
+        Add a notification to the backlog, applying the overflow policy if the backlog is full.
+
+        :param dict notification: Message and notification information
+        '''
+        if len(self.backlog) < self.backlog_max:
+            self.backlog.append(notification)
+        elif self.settings.NOTIFY_OVERFLOW_POLICY == 'spill':
+            await self.spill(notification)
+        elif self.settings.NOTIFY_OVERFLOW_POLICY == 'coalesce' \
+                and await self.coalesce(notification):
+            pass
+        else:
+            dropped = self.backlog.popleft()
+            self.dropped += 1
+            logging.error(
+                "Notification backlog for: '%s' is full. Dropped notification: '%s'.",
+                self.channel, dropped.get('message')
+            )
+            self.backlog.append(notification)
+        self.ready.set()
+
+    async def coalesce(self, notification):
+        '''
+        Merge a notification into the newest queued notification for the same recipients.
+
+        :param dict notification: Message and notification information
+        :return: True if the notification was merged
+        :rtype: bool
+        '''
+        recipients = notification['server']['notifications']
+        for queued in reversed(self.backlog):
+            if queued['server']['notifications'] == recipients:
+                queued['message'] = f"{queued['message']}\n{notification['message']}"
+                self.coalesced += 1
+                logging.warning(
+                    "Notification backlog for: '%s' is full. Merged notification: '%s'.",
+                    self.channel, notification.get('message')
                 )
+                return True
+        return False
+
+    async def spill(self, notification):
+        '''
+        Write a notification to disk until there is room in the backlog.
+
+        :param dict notification: Message and notification information
+        '''
+        with open(self.spill_file, 'a', encoding='utf-8') as spill_file:
+            spill_file.write(json.dumps(notification, default=json_default) + "\n")
+        self.spilled += 1
+        self.spill_pending = True
+        logging.warning(
+            "Notification backlog for: '%s' is full. Spilled notification to disk: '%s'.",
+            self.channel, notification.get('message')
+        )
+
+    async def load_spilled(self):
+        '''
+        Move notifications that were spilled to disk back into the (empty) backlog.
+        '''
+        self.spill_pending = False
+        try:
+            with open(self.spill_file, 'r+', encoding='utf-8') as spill_file:
+                spilled = spill_file.readlines()
+                spill_file.truncate(0)
+        except FileNotFoundError:
+            return
+        logging.warning(
+            "Loading: '%d' notifications for: '%s' spilled to disk.", len(spilled), self.channel
+        )
+        for line in spilled:
+            await self.put(json.loads(line))
+
+    async def get(self):
+        '''
+        Wait for a notification to be available in the backlog.
+
+        :rtype: dict
+        '''
+        while not self.backlog:
+            if self.spill_pending:
+                await self.load_spilled()
+                continue
+            self.ready.clear()
+            await self.ready.wait()
+        return self.backlog.popleft()
+
+class NotificationDispatcher:
+    '''
+    Give each notification channel its own bounded backlog (see ChannelBacklog) and its own
+    workers: NOTIFY_CHANNEL_CONCURRENCY caps how many sends can be in flight at once through
+    each channel. A channel that is down or rate limited only holds up its own notifications.
+
+    Notifiers don't retry (see delivery.py). Destinations that should be retried are put back
+    into the channel's backlog after a delay, so waiting doesn't hold one of the channel's
+    workers. The delay doubles from NOTIFY_RETRY_SLEEP_TIME (unless the service asked for a
+    specific delay), and a notification is retried up to NOTIFY_RETRY_MAX times.
+
+    :param settings: Config file
+    '''
+    def __init__(self, settings):
+        self.settings = settings
+        self.backlogs = {}
+        self.in_flight = {}
+        self.latency = {}
+        for channel in settings.KNOWN_NOTIFICATIONS:
+            self.backlogs[channel] = ChannelBacklog(settings, channel)
+            self.in_flight[channel] = 0
+            self.latency[channel] = {'sent': 0, 'failed': 0, 'total_time': 0.0, 'max_time': 0.0}
+        self.retries = set()
+        self.workers = []
+
+    def channels(self, notification):
+        '''
+        :param dict notification: Message and notification information
+        :return: The channels the recipient and the admin have both enabled
+        :rtype: list
+        '''
+        settings = self.settings
+        recipients = notification['server']['notifications']
+        channels = []
+        for i in settings.KNOWN_NOTIFICATIONS:
+            allowed = None
+            allowed_global = None
+            if i in recipients.keys():
+                # Check if the individual recipient enabled a given notification type
+                allowed = recipients.get(str(i)).get('notify_' + str(i))
+                # Check if the admin has enabled a given notification type
+                allowed_global = getattr(settings, f"SEND_{i.upper()}", None)
+
+            if allowed is True and allowed_global is True:
+                if globals().get("send_" + str(i)):
+                    logging.info("Preparing to send notification via '%s'", i)
+                    channels.append(i)
+                else:
+                    logging.warning(
+                        "Error locating the function for notification method: '%s'. "
+                        "To send notification: '%s'.", i, notification
+                    )
             else:
-                logging.warning(
-                    "Error locating the function for notification method: '%s'. "
-                    "To send notification: '%s'.", i, notification
+                logging.info(
+                    "Skipping notification to: '%s' as notification type: '%s' is not enabled.",
+                    recipients, i
                 )
+        return channels
+
+    async def enqueue(self, notification):
+        '''
+        Add a notification to the backlog of each channel it will be sent through. Each
+        channel gets its own copy, so coalescing or tracing in one channel doesn't change
+        another's.
+
+        :param dict notification: Message and notification information
+        '''
+        for channel in self.channels(notification):
+            copy = dict(notification)
+            if 'trace' in notification:
+                copy['trace'] = dict(notification['trace'])
+            await self.backlogs[channel].put(copy)
+
+    def record_outcome(self, channel, notification, sent):
+        '''
+        Count a notification as sent or failed through a channel.
+
+        :param str channel: Notification channel name (e.g., 'discord')
+        :param dict notification: Message and notification information
+        :param bool sent: Whether the channel sent the notification
+        '''
+        if sent:
+            self.latency[channel]['sent'] += 1
         else:
-            logging.info(
-                "Skipping notification to: '%s' as notification type: '%s' is not enabled.",
-                recipients, i
+            self.latency[channel]['failed'] += 1
+            metrics.inc('monitor_notification_failures_total', (channel,))
+        tracing.record_delivery(self.settings, notification, channel, sent)
+
+    def record_deferred(self, channel, notification, future):
+        '''
+        Done callback for channels that send later (e.g., SMTP digests).
+
+        :param str channel: Notification channel name (e.g., 'smtp')
+        :param dict notification: Message and notification information
+        :param asyncio.Future future: Resolves to whether the channel sent the notification
+        '''
+        sent = not future.cancelled() and future.exception() is None and future.result() is True
+        self.record_outcome(channel, notification, sent)
+
+    async def retry(self, channel, notification, delay):
+        '''
+        Wait, then put a notification back into its channel's backlog.
+
+        :param str channel: Notification channel name (e.g., 'mattermost')
+        :param dict notification: Message and notification information, with 'retries' set
+        :param float delay: Seconds to wait
+        '''
+        logging.error(
+            "Error sending notification via: '%s'. Retry count: '%d'. Retrying in: '%.1f' "
+            "seconds.", channel, notification['retries'], delay
+        )
+        await asyncio.sleep(delay)
+        await self.backlogs[channel].put(notification)
+
+    def schedule_retry(self, channel, notification, sent, retry):
+        '''
+        Retry the destinations a notifier asked to retry, unless NOTIFY_RETRY_MAX is reached.
+
+        :param str channel: Notification channel name (e.g., 'mattermost')
+        :param dict notification: Message and notification information
+        :param bool sent: Whether every other destination accepted the notification
+        :param tuple retry: Notification holding the destinations to retry, and the delay
+        :return: True if a retry was scheduled
+        :rtype: bool
+        '''
+        retries = notification.get('retries', 0)
+        if retries >= int(self.settings.NOTIFY_RETRY_MAX):
+            return False
+        retry_notification, delay = retry
+        if delay is None:
+            delay = float(self.settings.NOTIFY_RETRY_SLEEP_TIME) * 2 ** retries
+        retry_notification = dict(
+            retry_notification, retries=retries + 1,
+            # Remember destinations that failed without being retried
+            delivery_failed=notification.get('delivery_failed', False) or not sent,
+        )
+        task = asyncio.create_task(self.retry(channel, retry_notification, delay))
+        self.retries.add(task)
+        task.add_done_callback(self.retries.discard)
+        return True
+
+    async def send(self, channel, method, notification):
+        '''
+        Send a notification through a single channel. Notifiers return whether the notification
+        was sent, and what to retry (see delivery.py).
+
+        :param str channel: Notification channel name (e.g., 'discord')
+        :param method: Function that sends via the channel
+        :param dict notification: Message and notification information
+        '''
+        self.in_flight[channel] += 1
+        start = time.monotonic()
+        try:
+            sent, retry = await method(self.settings, notification)
+            if isinstance(sent, asyncio.Future):
+                sent.add_done_callback(
+                    lambda future: self.record_deferred(channel, notification, future)
+                )
+            elif retry is None or not self.schedule_retry(channel, notification, sent, retry):
+                sent = sent is True and retry is None \
+                        and not notification.get('delivery_failed', False)
+                self.record_outcome(channel, notification, sent)
+        except Exception as error:
+            self.record_outcome(channel, notification, False)
+            logging.error("Error sending notification via: '%s': '%s'.", channel, error)
+        finally:
+            elapsed = time.monotonic() - start
+            self.in_flight[channel] -= 1
+            self.latency[channel]['total_time'] += elapsed
+            self.latency[channel]['max_time'] = max(
+                self.latency[channel]['max_time'], elapsed
+            )
+            metrics.observe('monitor_notification_seconds', elapsed, (channel,))
+
+    async def worker(self, channel):
+        '''
+        Send notifications from a channel's backlog, one at a time.
+
+        :param str channel: Notification channel name (e.g., 'discord')
+        '''
+        method = globals().get("send_" + str(channel))
+        backlog = self.backlogs[channel]
+        while True:
+            try:
+                notification = await backlog.get()
+                tracing.stamp(notification, 'dispatched')
+                tracing.record_dispatch(notification)
+                await self.send(channel, method, notification)
+            except (asyncio.CancelledError, KeyboardInterrupt):
+                break
+            except Exception as error:
+                logging.critical(
+                    "A notification worker for: '%s' had an otherwise uncaught exception: '%s'.",
+                    channel, error
+                )
+
+    def start(self):
+        '''
+        Start NOTIFY_CHANNEL_CONCURRENCY workers for each channel.
+        '''
+        for channel in self.backlogs:
+            limit = int(self.settings.NOTIFY_CHANNEL_CONCURRENCY.get(channel, 1))
+            self.workers.extend(
+                asyncio.create_task(self.worker(channel)) for _ in range(limit)
             )
-    if tasks:
+
+    async def stop(self):
+        '''
+        Cancel the workers and pending retries.
+        '''
+        tasks = self.workers + list(self.retries)
+        for task in tasks:
+            task.cancel()
         await asyncio.gather(*tasks, return_exceptions=True)
-        logging.debug("Finished notification task list")
+        self.workers = []
+
+    def stats(self):
+        '''
+        Summarize the backlogs and per-channel send statistics.
+
+        :rtype: dict
+        '''
+        channels = {}
+        for channel, latency in self.latency.items():
+            attempts = latency['sent'] + latency['failed']
+            backlog = self.backlogs[channel]
+            channels[channel] = {
+                'backlog': len(backlog),
+                'dropped': backlog.dropped,
+                'coalesced': backlog.coalesced,
+                'spilled': backlog.spilled,
+                'in_flight': self.in_flight[channel],
+                'sent': latency['sent'],
+                'failed': latency['failed'],
+                'mean_time': round(latency['total_time'] / attempts, 3) if attempts else 0.0,
+                'max_time': round(latency['max_time'], 3),
+            }
+        return {
+            'backlog': sum(len(backlog) for backlog in self.backlogs.values()),
+            'retrying': len(self.retries),
+            'channels': channels,
+        }
+
+    async def log_stats(self):
+        '''
+        Periodically write dispatcher statistics to the log.
+        '''
+        while True:
+            try:
+                await asyncio.sleep(int(self.settings.NOTIFY_METRICS_INTERVAL))
+                logging.info("Notification dispatcher stats: '%s'.", self.stats())
+            except (asyncio.CancelledError, KeyboardInterrupt):
+                break
 
 async def notifications(args_d):
     '''
@@ -67,13 +414,27 @@ async def notifications(args_d):
     :param dict args_d: Default settings and queues.
     '''
     logging.info("Notification watcher is running.")
+    settings = args_d['settings']
     notification_queue = args_d['notification_queue']
+    await open_session(settings)
+
+    dispatcher = NotificationDispatcher(settings)
+    dispatcher.start()
+    workers = [asyncio.create_task(dispatcher.log_stats())]
+    if args_d.get('metrics_queue') is not None:
+        metrics.enable()
+        metrics.register_gauge('monitor_notification_queue_depth', notification_queue.qsize)
+        for channel, backlog in dispatcher.backlogs.items():
+            metrics.register_gauge('monitor_notification_backlog', backlog.__len__, (channel,))
+        workers.append(asyncio.create_task(
+            metrics.publish_forever(args_d['metrics_queue'], settings.METRICS_INTERVAL)
+        ))
     while True:
         try:
             logging.debug("Preparing to listen to notification queue.")
             notification = await asyncio.to_thread(notification_queue.get)
-            #await dispatch_notification(args_d['settings'], notification)
-            asyncio.create_task(dispatch_notification(args_d['settings'], notification))
+            tracing.stamp(notification, 'dequeued')
+            await dispatcher.enqueue(notification)
 
         except (asyncio.CancelledError, KeyboardInterrupt):
             logging.critical("Keyboard interrupt detected. Stopping notification watcher.")
@@ -82,11 +443,16 @@ async def notifications(args_d):
             logging.critical(
                 "The notification watcher had an otherwise uncaught exception: '%s'.", error
             )
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    await dispatcher.stop()
 
 def start_notifications(args_d):
     '''
     Start the asyncio loop.
     '''
+    log_setup.start_log_thread(args_d['settings'])
     loop = asyncio.new_event_loop()
     monitor_tasks = []
 
@@ -102,3 +468,9 @@ def start_notifications(args_d):
         for task in monitor_tasks:
             task.cancel()
         logging.critical("Closed notification asyncio loops.")
+    finally:
+        loop.run_until_complete(asyncio.gather(*monitor_tasks, return_exceptions=True))
+        loop.run_until_complete(close_session())
+        loop.run_until_complete(close_sender())
+        loop.close()
+        log_setup.stop_log_thread()
@@ -9,12 +9,18 @@ import asyncio
 
 import aiohttp
 
+from misc import tracing
+from .delivery import limit_destinations
+from .http_session import get_session
+
 async def discord_post(settings, notification):
     '''
     Use aiohttp to POST message to Discord webhook.
 
     :param settings: Config file
     :param dict notification: Recipient information and message keys.
+    :return: Each Discord server, and its response (None if the request failed)
+    :rtype: list
     '''
     discord_settings = notification.get('server').get('notifications').get('discord')
     message = {'content': str(notification.get('message'))}
@@ -27,46 +33,56 @@ async def discord_post(settings, notification):
             logging.info("Preparing to send Discord message: '%s'.", message)
 
             try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(
-                        discord_url,
-                        headers={'Content-Type': 'application/json'},
-                        json=message,
-                    ) as response:
-                        responses.append(response)
+                session = await get_session(settings)
+                async with session.post(
+                    discord_url,
+                    headers={'Content-Type': 'application/json'},
+                    json=message,
+                ) as response:
+                    tracing.stamp(notification, 'discord')
+                    responses.append((server, response))
             except (
                 ValueError,
                 OSError,
                 socket.gaierror,
+                aiohttp.ClientError,
+                asyncio.TimeoutError,
             ) as error:
                 logging.error(
                     "Error sending Discord message: '%s'.", error
                 )
+                responses.append((server, None))
                 # It probably makes sense to retry sending the message here.
 
     return responses
 
-async def rate_limit(settings, notification, response):
+async def rate_limit(response):
     '''
     Deal with Discord rate limiting.
+
+    :return: Seconds to wait before retrying
+    :rtype: float
     '''
     logging.warning("Exceeded Discord's rate limit: '%s'.", response)
-    await asyncio.sleep(float(response.headers.get('retry-after')) + 0.25)
-    await discord_post(settings, notification)
+    return float(response.headers.get('retry-after', 1)) + 0.25
 
-async def discord_response(settings, notification, response):
+async def discord_response(response):
     '''
     Ensure discord messages are posted successfully.
+
+    :return: True if the message was posted
+    :rtype: bool
     '''
+    if response is None:
+        return False
     if int(response.status) in [200, 204]:
         logging.info("Discord message posted successfully.")
-    elif int(response.status) == 429:
-        await rate_limit(settings, notification, response)
-    else:
-        logging.warning(
-            "Error code encountered when sending to  Discord: '%s'.", response
-        )
-        # Call a function to deal with other error codes
+        return True
+    logging.warning(
+        "Error code encountered when sending to  Discord: '%s'.", response
+    )
+    # Call a function to deal with other error codes
+    return False
 
 async def send_discord(settings, notification):
     '''
@@ -75,7 +91,22 @@ async def send_discord(settings, notification):
 
     :param settings: Config file
     :param dict notification: Recipient information and message keys
+    :return: Whether the message was posted to every Discord server that didn't rate limit
+        it, and those that did to retry (see delivery.py)
+    :rtype: (bool, tuple)
     '''
-    server_responses = await discord_post(settings, notification)
-    for response in server_responses:
-        await discord_response(settings, notification, response)
+    sent = True
+    rate_limited = []
+    retry_after = 0.0
+    for server, response in await discord_post(settings, notification):
+        if response is not None and int(response.status) == 429:
+            rate_limited.append(server)
+            retry_after = max(retry_after, await rate_limit(response))
+        elif not await discord_response(response):
+            sent = False
+    if rate_limited:
+        return sent, (
+            limit_destinations(notification, 'discord', 'discord_servers', rate_limited),
+            retry_after,
+        )
+    return sent, None
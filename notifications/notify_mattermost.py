@@ -8,56 +8,47 @@ import copy
 import asyncio
 import aiohttp
 
-async def post_to_mattermost(settings, mm_url, message, retry_counter=0, retry_sleep_time=None):
+from misc import tracing
+from .delivery import limit_destinations
+from .http_session import get_session
+
+async def post_to_mattermost(settings, mm_url, message, notification=None):
     '''
     Send a POST request to a specified MatterMost server.
-    '''
-    retry = None
-
-    if retry_sleep_time is None:
-        retry_sleep_time = int(settings.NOTIFY_RETRY_SLEEP_TIME)
 
-    if retry_counter <= int(settings.NOTIFY_RETRY_MAX):
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    mm_url,
-                    headers={'Content-Type': 'application/json'},
-                    json=message,
-                ) as response:
-                    if int(response.status) not in [200, 204]:
-                        logging.error(
-                            "Error code: '%i' returned when sending to Mattermost URL: '%s'.",
-                            int(response.status), mm_url
-                        )
-                        retry = True
-                    else:
-                        retry = False
-        except ValueError as error:
-            logging.error(
-                "'ValueError' when sending HTTP POST to MatterMost server: '%s'. "
-                "Resending will not be reattempted.", error
-            )
-            retry = False
-        except (
-            OSError,
-            socket.gaierror,
-            aiohttp.ClientError,
-            asyncio.TimeoutError,
-        ) as error:
-            logging.error("Error sending Mattermost message: '%s'.", error)
-            retry = True
-
-    if retry is True:
+    :return: Whether the message was posted, and whether it should be retried
+    :rtype: (bool, bool)
+    '''
+    try:
+        session = await get_session(settings)
+        async with session.post(
+            mm_url,
+            headers={'Content-Type': 'application/json'},
+            json=message,
+        ) as response:
+            if notification is not None:
+                tracing.stamp(notification, 'mattermost')
+            if int(response.status) not in [200, 204]:
+                logging.error(
+                    "Error code: '%i' returned when sending to Mattermost URL: '%s'.",
+                    int(response.status), mm_url
+                )
+                return False, True
+            return True, False
+    except ValueError as error:
         logging.error(
-            "Error sending MatterMost notification to: %s. "
-            "Retry count: %d. Sleeping for: '%d' seconds.",
-            mm_url, retry_counter, retry_sleep_time
+            "'ValueError' when sending HTTP POST to MatterMost server: '%s'. "
+            "Resending will not be reattempted.", error
         )
-        await asyncio.sleep(retry_sleep_time)
-        retry_counter +=1
-        retry_sleep_time = retry_sleep_time * 2
-        await post_to_mattermost(settings, mm_url, message, retry_counter, retry_sleep_time)
+        return False, False
+    except (
+        OSError,
+        socket.gaierror,
+        aiohttp.ClientError,
+        asyncio.TimeoutError,
+    ) as error:
+        logging.error("Error sending Mattermost message: '%s'.", error)
+        return False, True
 
 async def send_mattermost(settings, notification):
     '''
@@ -66,7 +57,11 @@ async def send_mattermost(settings, notification):
 
     :param settings: Config file
     :param dict notification: recipient information and message text
+    :return: Whether the message was posted to every Mattermost server that isn't being
+        retried, and those to retry (see delivery.py)
+    :rtype: (bool, tuple)
     '''
+    servers = []
     tasks = []
     mm_settings = notification.get('server').get('notifications').get('mattermost')
     message = {'text': str(notification.get('message'))}
@@ -81,9 +76,12 @@ async def send_mattermost(settings, notification):
                 # If channel is not specified, messages go into a default channel.
                 if server.get('mattermost_channel'):
                     message['channel'] = server['mattermost_channel']
+                servers.append(server)
                 tasks.append(
                     asyncio.create_task(
-                        post_to_mattermost(settings, "".join(mm_url), copy.deepcopy(message))
+                        post_to_mattermost(
+                            settings, "".join(mm_url), copy.deepcopy(message), notification
+                        )
                     )
                 )
             else:
@@ -91,8 +89,27 @@ async def send_mattermost(settings, notification):
                     "MatterMost message ignored as server URL and API Key are not specified. \
                     Message:\n%s\nServer:\n%s", message, server
                 )
-    if tasks:
-        try:
-            await asyncio.gather(*tasks, return_exceptions=True)
-        except KeyboardInterrupt:
-            pass
+    if not tasks:
+        return True, None
+    try:
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+    except KeyboardInterrupt:
+        return False, None
+    sent = True
+    retry_servers = []
+    for server, result in zip(servers, results):
+        if isinstance(result, BaseException):
+            sent = False
+        elif result[1]:
+            retry_servers.append(server)
+        elif not result[0]:
+            sent = False
+    if retry_servers:
+        logging.error(
+            "Error sending MatterMost notification to: '%d' servers.", len(retry_servers)
+        )
+        return sent, (
+            limit_destinations(notification, 'mattermost', 'mattermost_servers', retry_servers),
+            None,
+        )
+    return sent, None
@@ -13,8 +13,11 @@ async def send_slack(settings, notification):
 
     :param settings: Config file
     :param dict notification: recipient information and message text
+    :return: Whether the message was sent, and nothing to retry (see delivery.py)
+    :rtype: (bool, None)
     '''
     if settings.SEND_SLACK is True:
         logging.warning("Simulating sending Slack message: '%s'.", notification.get('message'))
-    else:
-        logging.info("Slack notifications disabled in settings. Ignoring: '%s'.", notification)
+        return True, None
+    logging.info("Slack notifications disabled in settings. Ignoring: '%s'.", notification)
+    return False, None
@@ -1,26 +1,200 @@
 '''
 Send messages via Email.
 '''
+import asyncio
 import logging
+import time
 from email.message import EmailMessage
-from aiosmtplib import send
 
-async def send_message(settings, email_message):
+import aiosmtplib
+
+from misc import tracing
+
+SENDER = None
+
+class SMTPSender:
     '''
-    Send the SMTP notification.
+    Keep one authenticated SMTP connection open and send notifications over it.
+
+    Notifications to the same recipient that arrive within SMTP_DIGEST_WINDOW seconds
+    are merged into a single digest email. Each submitted notification gets a future that
+    resolves to whether the email holding it was sent.
+
+    :param settings: Config file
     '''
-    try:
-        status, response = await send(
-                email_message,
-                hostname=settings.SMTP_SERVER,
-                port=int(settings.SMTP_SUBMISSION_PORT),
-                start_tls=settings.SMTP_START_TLS,
-                username=settings.SMTP_USERNAME,
-                password=settings.SMTP_PASSWORD,
-                )
-        return status, response
-    except Exception as e:
-        return None, f"Python3 error sending mail: {e}"
+    def __init__(self, settings):
+        self.settings = settings
+        self.client = None
+        self.last_used = 0
+        self.lock = asyncio.Lock()
+        self.pending = {} # (recipient, subject): (message bodies, notifications, future)
+        self.flush_tasks = set()
+
+    async def connect(self):
+        '''
+        Connect, STARTTLS, and authenticate, unless a usable connection is already open.
+        Connections that sat idle longer than SMTP_IDLE_TIMEOUT are replaced, as most servers
+        will have closed them.
+        '''
+        idle = time.monotonic() - self.last_used > int(self.settings.SMTP_IDLE_TIMEOUT)
+        if self.client is not None and self.client.is_connected and not idle:
+            return
+        await self.disconnect()
+        self.client = aiosmtplib.SMTP(
+            hostname=self.settings.SMTP_SERVER,
+            port=int(self.settings.SMTP_SUBMISSION_PORT),
+            start_tls=self.settings.SMTP_START_TLS,
+            username=self.settings.SMTP_USERNAME,
+            password=self.settings.SMTP_PASSWORD,
+        )
+        await self.client.connect()
+        self.last_used = time.monotonic()
+        logging.info("Connected to SMTP server: '%s'.", self.settings.SMTP_SERVER)
+
+    async def disconnect(self):
+        '''
+        Close the SMTP connection, if one is open.
+        '''
+        if self.client is not None and self.client.is_connected:
+            try:
+                await self.client.quit()
+            except aiosmtplib.SMTPException as error:
+                logging.info("Error closing SMTP connection: '%s'.", error)
+                self.client.close()
+        self.client = None
+
+    async def send_message(self, email_message):
+        '''
+        Send an email over the shared connection, reconnecting once if the server
+        dropped the connection.
+
+        :param email.message.EmailMessage email_message: Email to send
+        :return: SMTP response code and message
+        :rtype: (int, str)
+        '''
+        async with self.lock:
+            for attempt in range(2):
+                try:
+                    await self.connect()
+                    errors, response = await self.client.send_message(email_message)
+                    self.last_used = time.monotonic()
+                    if errors:
+                        return 550, f"Recipients refused: {errors}"
+                    return 250, response
+                except aiosmtplib.SMTPServerDisconnected as error:
+                    logging.info(
+                        "SMTP connection dropped. Attempt: '%d'. Error: '%s'.", attempt, error
+                    )
+                    self.client = None
+                    error_message = str(error)
+                except aiosmtplib.SMTPResponseException as error:
+                    return error.code, error.message
+                except Exception as error:
+                    await self.disconnect()
+                    return None, f"Python3 error sending mail: {error}"
+        return None, f"Python3 error sending mail: {error_message}"
+
+    async def submit(self, recipient, message_body, notification=None):
+        '''
+        Send a notification now, or hold it to be merged into a digest.
+
+        :param dict recipient: 'smtp_to' and 'smtp_subject'
+        :param str message_body: Notification text
+        :param dict notification: Notification to stamp with the time the email was sent
+        :return: Future resolving to True if the email holding the notification was sent
+        :rtype: asyncio.Future
+        '''
+        notifications = [notification] if notification is not None else []
+        if float(self.settings.SMTP_DIGEST_WINDOW) <= 0:
+            future = asyncio.get_running_loop().create_future()
+            future.set_result(await self.deliver(recipient, [message_body], notifications))
+            return future
+
+        key = (recipient['smtp_to'], recipient['smtp_subject'])
+        if key in self.pending:
+            self.pending[key][0].append(message_body)
+            self.pending[key][1].extend(notifications)
+        else:
+            self.pending[key] = (
+                [message_body], notifications, asyncio.get_running_loop().create_future()
+            )
+            task = asyncio.create_task(self.flush_digest(recipient, key))
+            self.flush_tasks.add(task)
+            task.add_done_callback(self.flush_tasks.discard)
+        return self.pending[key][2]
+
+    async def flush_digest(self, recipient, key):
+        '''
+        Wait for the digest window to close, then send everything collected for the recipient.
+
+        :param dict recipient: 'smtp_to' and 'smtp_subject'
+        :param tuple key: Recipient and subject the digest is collected under
+        '''
+        await asyncio.sleep(float(self.settings.SMTP_DIGEST_WINDOW))
+        message_bodies, notifications, future = self.pending.pop(key)
+        try:
+            future.set_result(await self.deliver(recipient, message_bodies, notifications))
+        except asyncio.CancelledError:
+            future.set_result(False)
+            raise
+
+    async def deliver(self, recipient, message_bodies, notifications=()):
+        '''
+        Compile and send one email containing one or more notifications.
+
+        :param dict recipient: 'smtp_to' and 'smtp_subject'
+        :param list message_bodies: Notification text
+        :param list notifications: Notifications to stamp with the time of the SMTP response
+        :return: True if the email was sent
+        :rtype: bool
+        '''
+        if len(message_bodies) > 1:
+            recipient = dict(
+                recipient,
+                smtp_subject=f"{recipient['smtp_subject']} ({len(message_bodies)} notifications)",
+            )
+        email_message = await compile_email(
+            self.settings, "\n\n".join(message_bodies), recipient
+        )
+        code, response = await self.send_message(email_message)
+        for notification in notifications:
+            tracing.stamp(notification, 'smtp')
+        return await process_response(recipient, code, response)
+
+    async def close(self):
+        '''
+        Send any pending digests and close the connection.
+        '''
+        for task in list(self.flush_tasks):
+            task.cancel()
+        for key, (message_bodies, notifications, future) in list(self.pending.items()):
+            future.set_result(await self.deliver(
+                {'smtp_to': key[0], 'smtp_subject': key[1]}, message_bodies, notifications
+            ))
+        self.pending = {}
+        await self.disconnect()
+
+async def get_sender(settings):
+    '''
+    Return the SMTP sender for this process, creating it if needed.
+
+    :param settings: Config file
+    :rtype: SMTPSender
+    '''
+    global SENDER
+    if SENDER is None:
+        SENDER = SMTPSender(settings)
+    return SENDER
+
+async def close_sender():
+    '''
+    Flush and close the SMTP sender for this process.
+    '''
+    global SENDER
+    if SENDER is not None:
+        await SENDER.close()
+        logging.warning("Closed SMTP connection for notifications.")
+    SENDER = None
 
 async def compile_email(settings, message_body, recipient):
     '''
@@ -34,43 +208,60 @@ async def compile_email(settings, message_body, recipient):
 
     return email_message
 
+async def all_sent(futures):
+    '''
+    :param list futures: Futures from SMTPSender.submit
+    :return: True if every email was sent
+    :rtype: bool
+    '''
+    results = await asyncio.gather(*futures, return_exceptions=True)
+    return all(result is True for result in results)
+
 async def send_email(settings, notification):
     '''
     Prepare and send notification emails.
+
+    :return: True if every email was sent, or a future resolving to that once digests are sent
     '''
     email_settings = notification.get('server').get('notifications').get('smtp')
     message_body = notification.get('message')
-    smtp_responses = []
 
+    futures = []
     if email_settings and message_body:
+        sender = await get_sender(settings)
         for recipient in email_settings.get('smtp_recipients'):
             logging.info(
                 "Preparing to send SMTP message to: '%s'. Message:\n '%s'\n\n",
                 recipient, message_body
             )
-            email_message = await compile_email(settings, message_body, recipient)
-            status, response = await send_message(settings, email_message)
-            smtp_responses.append({'status': status, 'response': response})
-    return smtp_responses
+            futures.append(await sender.submit(recipient, message_body, notification))
+    if all(future.done() for future in futures):
+        return all(future.result() for future in futures)
+    return asyncio.ensure_future(all_sent(futures))
 
-async def process_response(settings, notification, response):
+async def process_response(recipient, code, response):
     '''
     Error handling.
+
+    :return: True if the email was sent
+    :rtype: bool
     '''
-    if response.get('status')[0] == 2:
-        logging.info("Successfully sent SMTP notification: %s %s", notification, response)
-    elif response.get('status')[0] == 5:
+    if code and str(code)[0] == '2':
+        logging.info("Successfully sent SMTP notification to: '%s'. %s", recipient, response)
+        return True
+    if code and str(code)[0] == '5':
         # Do not attempt to resend SMTP messages after a 5xx response code is received.
         logging.warning(
             "Error sending SMTP notification. \
             Resending will not be attempted due to 5xx error code. \
-            Notification: '%s' Response: '%s'", notification, response
+            Recipient: '%s' Response: '%s %s'", recipient, code, response
         )
     else:
         logging.warning(
             "Error sending SMTP notification. Resending should be attempted. \
-            Notification: '%s' Response: '%s'", notification, response
+            Recipient: '%s' Response: '%s %s'", recipient, code, response
         )
+    return False
 
 async def send_smtp(settings, notification):
     '''
@@ -79,11 +270,10 @@ async def send_smtp(settings, notification):
 
     :param settings: Config file
     :param dict notification: Notification message and contact information.
+    :return: Whether every email was sent (or a future resolving to that once digests are
+        sent), and nothing to retry (see delivery.py)
     '''
     logging.info(
         "Sending Email message: '%s'.", notification.get('message')
     )
-    # Add response error handling
-    smtp_responses = await send_email(settings, notification)
-    #for response in smtp_responses:
-    #    await process_response(settings, notification, response)
+    return await send_email(settings, notification), None
@@ -4,9 +4,12 @@ Send notifications via SMS using the Twillio API.
 import os
 import logging
 import socket
+import asyncio
 
 import aiohttp
 
+from misc import tracing
+from .http_session import get_session
 
 async def get_account_info(settings):
     '''
@@ -29,34 +32,42 @@ async def get_account_info(settings):
 
     return sid, auth_token
 
-async def send_message(sid, auth_token, phone_from, phone_to, message_body):
+async def send_message(settings, sid, auth_token, phone_from, phone_to, message_body):
     '''
     Use the prepared information to send the message.
 
+    :param settings: Config file
     :parm str sid: Twilio client ID
     :param str auth_token: Twilio authentication token
     :param str phone_from: Number to send from
     :param str phone_to: Recipient's SMS number
     :param str message_body: Message content
+    :return: The response, or None if the request failed
     '''
     try:
-        async with aiohttp.ClientSession(auth=aiohttp.BasicAuth(
-            login=sid, password=auth_token)) as session:
-            return await session.post(
-                # This URL prob shouldn't be hard coded
-                f'https://api.twilio.com/2010-04-01/Accounts/{sid}/Messages.json',
-                data={'From': phone_from, 'To': phone_to, 'Body': message_body}
-            )
+        session = await get_session(settings)
+        async with session.post(
+            # This URL prob shouldn't be hard coded
+            f'https://api.twilio.com/2010-04-01/Accounts/{sid}/Messages.json',
+            data={'From': phone_from, 'To': phone_to, 'Body': message_body},
+            auth=aiohttp.BasicAuth(login=sid, password=auth_token),
+        ) as response:
+            # Read the body so the connection is returned to the pool
+            await response.read()
+            return response
 
     except (
         OSError,
         socket.gaierror,
+        aiohttp.ClientError,
+        asyncio.TimeoutError,
     ) as error:
         # Double check these exceptions
         # Retry SMS messages that throw exceptions, if appropriate
         logging.critical(
             "Error sending Twilio SMS: '%s'.", error
         )
+    return None
 
 async def clean_number(number):
     '''
@@ -76,9 +87,12 @@ async def send_twilio(settings, notification):
 
     :param settings: Config file
     :param dict notification: phone_from, phone_to, and message keys
+    :return: Whether every SMS message was accepted, and nothing to retry (see delivery.py)
+    :rtype: (bool, None)
     '''
     sid, auth_token = await get_account_info(settings)
 
+    sent = True
     twilio_settings = notification['server']['notifications']['twilio']
     for i in twilio_settings.get('phone_numbers'):
         phone_from = await clean_number(i['phone_from'])
@@ -86,9 +100,21 @@ async def send_twilio(settings, notification):
 
         logging.info("Preparing to send SMS message: '%s'.", notification)
         sms_response = await send_message(
-            sid, auth_token, phone_from, phone_to, notification['message']
-        )
-        logging.info(
-            "Successfully sent SMS message: %s. Received response %s.",
-            notification.get('message'), sms_response
+            settings, sid, auth_token, phone_from, phone_to, notification['message']
         )
+        if sms_response is None:
+            sent = False
+            continue
+        tracing.stamp(notification, 'twilio')
+        if int(sms_response.status) >= 300:
+            logging.error(
+                "Error code: '%i' returned when sending Twilio SMS to: '%s'.",
+                int(sms_response.status), phone_to
+            )
+            sent = False
+        else:
+            logging.info(
+                "Successfully sent SMS message: %s. Received response %s.",
+                notification.get('message'), sms_response
+            )
+    return sent, None
@@ -0,0 +1,79 @@
+'''
+Track amendment votes as bitsets, so amendment tallies don't rescan each validator's
+amendments list.
+'''
+import logging
+
+
+class AmendmentIndex:
+    '''
+    Each amendment ID maps to a bit, and each validator's latest votes are held as an integer
+    bitset. Votes are updated when validations that carry amendments (flag ledger validations)
+    are processed. Amendments that validators vote for but that are not listed in
+    AMENDMENTS are added to the index as they are seen.
+
+    :param list amendments: Known amendments ('id' and 'name')
+    '''
+    def __init__(self, amendments):
+        self.bits = {} # Amendment ID: bit
+        self.amendments = [] # Bit: {'id', 'name'}
+        self.votes = {} # id(validator): bitset
+        for amendment in amendments:
+            self.register(amendment['id'], amendment['name'])
+
+    def register(self, amendment_id, name=None):
+        '''
+        :param str amendment_id: Amendment ID
+        :param str name: Amendment name
+        :return: The amendment's bit
+        :rtype: int
+        '''
+        bit = self.bits.get(amendment_id)
+        if bit is None:
+            bit = self.bits[amendment_id] = len(self.amendments)
+            if name is None:
+                name = f"Unknown {amendment_id[:12]}"
+                logging.warning("Vote seen for unknown amendment: '%s'.", amendment_id)
+            self.amendments.append({'id': amendment_id, 'name': name})
+        return bit
+
+    def update(self, validator):
+        '''
+        Replace a validator's votes with the amendments in its latest flag ledger validation.
+
+        :param dict validator: Validator row
+        '''
+        bitset = 0
+        if isinstance(validator['amendments'], list):
+            for amendment_id in validator['amendments']:
+                bitset |= 1 << self.register(amendment_id)
+        self.votes[id(validator)] = bitset
+
+    def rebuild(self, table):
+        '''
+        Drop votes from validators that are no longer tracked.
+
+        :param list table: Validator rows
+        '''
+        self.votes = {
+            id(validator): self.votes[id(validator)]
+            for validator in table if id(validator) in self.votes
+        }
+
+    def tally(self, table):
+        '''
+        :param list table: Validator rows
+        :return: Each amendment's 'id', 'name', and 'supporters' (validator names)
+        :rtype: list
+        '''
+        supporters = [[] for _ in self.amendments]
+        for validator in table:
+            bitset = self.votes.get(id(validator), 0)
+            while bitset:
+                lowest = bitset & -bitset
+                supporters[lowest.bit_length() - 1].append(validator['server_name'])
+                bitset ^= lowest
+        return [
+            dict(amendment, supporters=names)
+            for amendment, names in zip(self.amendments, supporters)
+        ]
@@ -2,72 +2,68 @@
 Functions used across response processor.
 '''
 import logging
-from copy import deepcopy
+from functools import lru_cache
 
+VERSION_CACHE_SIZE = 256 # Distinct server_version values to keep decoded
 
-async def copy_stock(table_stock):
-    '''
-    Copy a list of dictionaries describing the stock servers being tracked while
-    excluding websocket connection objects.
+# Implementation ID (the top 16 bits of a version integer): name
+IMPLEMENTATIONS = {
+    0x183B: 'rippled',
+}
+
+RELEASE_TYPES = {
+    0b10: 'RC',
+    0b01: 'beta',
+}
 
-    :param list table_stock: Stock servers being monitored
+
+def add_implementations(implementations):
     '''
-    table_stock_new = []
+    Name additional server implementations (e.g., Xahau) by their implementation IDs.
 
-    for server in table_stock:
-        table_stock_new.append(
-            {x: deepcopy(server[x]) for x in server if x != 'ws_connection_task'}
-        )
-    return table_stock_new
+    :param dict implementations: Implementation IDs (hex strings) mapped to names
+    '''
+    for implementation_id, name in implementations.items():
+        IMPLEMENTATIONS[int(implementation_id, 16)] = name
+    decode_version.cache_clear()
 
-async def decode_version(version):
+@lru_cache(maxsize=VERSION_CACHE_SIZE)
+def decode_version(version):
     '''
     Decode XRP Ledger version numbers.
     This is basically a Python3 translation of the XRPScan XRPL-Server-Version
     repo: https://github.com/xrpscan/xrpl-server-version/blob/main/index.js
 
+    Decoded versions are cached, so the returned dict is shared and must not be modified.
+
     :param int version: Version integer from a XRP Ledger server
 
     :param returns: Human readable version information
     :param rtype: dict
     '''
-    implementations = {
-        '183b': 'rippled',
-    }
-
-    release_types = {
-        '10': 'RC',
-        '01': 'beta',
-    }
-
+    version = int(version)
     decoded_version = {}
 
-    # Convert from integer to a string binary with 0 padding on the left
-    version_bin = format(int(version), '064b')
-
     # Decode Implementation ID
-    imp_bin = version_bin[0:16]
-    imp_hex = format(int(imp_bin, 2), 'x')
-
-    if imp_hex in implementations:
-        decoded_version['implementation'] = implementations[imp_hex]
+    implementation_id = version >> 48 & 0xFFFF
+    if implementation_id in IMPLEMENTATIONS:
+        decoded_version['implementation'] = IMPLEMENTATIONS[implementation_id]
     else:
         decoded_version['implementation'] = 'unknown'
+        logging.warning(
+            "Unknown server implementation ID: '%04x' in version: '%d'.", implementation_id, version
+        )
 
-    # Decode Major Version
-    decoded_version['major'] = int(version_bin[16:24], 2)
-
-    # Decode Minor Version
-    decoded_version['minor'] = int(version_bin[24:32], 2)
-
-    # Decoded Patch Version
-    decoded_version['patch'] = int(version_bin[32:40], 2)
+    # Decode Major, Minor, and Patch Versions
+    decoded_version['major'] = version >> 40 & 0xFF
+    decoded_version['minor'] = version >> 32 & 0xFF
+    decoded_version['patch'] = version >> 24 & 0xFF
 
     # Decode Release Type and number (if not a major release)
-    release_type_bin = version_bin[40:42]
-    if release_type_bin in release_types:
-        decoded_version['release_type'] = release_types[release_type_bin]
-        decoded_version['release_number'] = int(version_bin[42:48], 2)
+    release_type = version >> 22 & 0b11
+    if release_type in RELEASE_TYPES:
+        decoded_version['release_type'] = RELEASE_TYPES[release_type]
+        decoded_version['release_number'] = version >> 16 & 0x3F
     else:
         decoded_version['release_type'] = ''
         decoded_version['release_number'] = ''
@@ -87,3 +83,13 @@ async def decode_version(version):
     decoded_version['version'] = version_final.strip()
 
     return decoded_version
+
+def format_version(server_version):
+    '''
+    :param server_version: 'server_version' from a validation
+    :return: The human readable version, or server_version if it isn't a version integer
+    '''
+    if isinstance(server_version, int) \
+       or (isinstance(server_version, str) and server_version.isdigit()):
+        return decode_version(server_version).get('version')
+    return server_version
@@ -1,252 +1,389 @@
 '''
 Make pretty console output.
+
+The response processor takes snapshots of the tracking tables and hands them to a
+ConsoleRenderer, which formats and draws them in its own thread, so printing never holds up
+message processing. Formatted rows are cached by their values, and only the console lines that
+changed since the last refresh are redrawn (using ANSI cursor movement).
 '''
 import logging
+import queue
+import re
+import shutil
+import sys
 import textwrap
-from copy import deepcopy
+import threading
+import time
+from operator import attrgetter
+
+from misc import metrics
+
+COLOR_RESET = "\033[0;0m"
+GREEN = "\033[0;32m"
+RED = "\033[1;31m"
+ANSI_ESCAPE = re.compile(r"\033\[[0-9;]*[A-Za-z]")
+
+# Row fields copied into snapshots, in the order format functions receive them
+SERVER_FIELDS = (
+    'server_name', 'server_status', 'load_factor_fee_escalation', 'load_factor_fee_queue',
+    'load_factor', 'load_base', 'fee_base', 'ledger_hash', 'validated_ledgers', 'txn_count',
+    'forked', 'time_updated',
+)
+VALIDATOR_FIELDS = (
+    'server_name', 'master_key', 'validation_public_key', 'version', 'base_fee',
+    'load_fee', 'ledger_hash', 'ledger_index', 'full', 'forked', 'time_updated',
+)
+SERVER_HEADER = (
+    "Server Name", "State", "O.L. Fee", "Queue Fee", "Load Multiplier",
+    "LL Hash", "History", "LL # Tx", "Forked?", "Last Updated",
+)
+VALIDATOR_HEADER = (
+    "Validator Name", "Master Key", "Eph Key", "Version", "Base Fee", "Local LL Fee",
+    "LL Hash", "LL Index", "Full?", "Forked?", "Last Updated",
+)
+AMENDMENT_HEADER = ("Amendment", "Yea Votes", "Nay Votes", "% Support", "Supporters")
 
-from prettytable import PrettyTable, ALL
+get_server_fields = attrgetter(*SERVER_FIELDS)
+get_validator_fields = attrgetter(*VALIDATOR_FIELDS)
 
-from .common import decode_version
-from .common import copy_stock
 
+def take_snapshot(table_stock, table_validator, amendment_index=None):
+    '''
+    Copy the values the console displays from the tracking tables.
+
+    :param list table_stock: Stock servers being tracked
+    :param list table_validator: Validators being tracked
+    :param AmendmentIndex amendment_index: Amendment votes (None to skip the amendments table)
+    :return: Table names mapped to a tuple of values for each row
+    :rtype: dict
+    '''
+    snapshot = {'server': [get_server_fields(server) for server in table_stock]}
+    if table_validator:
+        snapshot['validator'] = [get_validator_fields(validator) for validator in table_validator]
+        if amendment_index is not None:
+            validator_count = len(table_validator)
+            snapshot['amendment'] = [
+                (amendment['name'], tuple(amendment['supporters']), validator_count)
+                for amendment in amendment_index.tally(table_validator)
+            ]
+    return snapshot
 
 # Validator table output
-async def format_table_validation(table):
-    '''
-    Format output for the validation table, so it's human friendly.
-
-    :param list table: Dictionaries for each validator being tracked.
-    '''
-    color_reset = "\033[0;0m"
-    green = "\033[0;32m"
-    red = "\033[1;31m"
-    for validator in table:
-        # Shorten keys and hashes
-        if isinstance(validator['master_key'], str):
-            validator['master_key'] = validator['master_key'][:5]
-        if isinstance(validator['validation_public_key'], str):
-            validator['validation_public_key'] = validator['validation_public_key'][:5]
-        if isinstance(validator['ledger_hash'], str):
-            validator['ledger_hash'] = validator['ledger_hash'][:5]
-        if isinstance(validator['validated_hash'], str):
-            validator['validated_hash'] = validator['validated_hash'][:5]
-        # Green if not forked
-        if validator['forked'] is False:
-            validator['forked'] = green + str(validator['forked']) + color_reset
-        else:
-            validator['forked'] = red + str(validator['forked']) + color_reset
-            validator['server_name'] = red + validator['server_name'] + color_reset
-        # Green if validations are full
-        if validator['full']:
-            validator['full'] = green + str(validator['full']) + color_reset
-        else:
-            validator['full'] = red + str(validator['full']) + color_reset
-            validator['server_name'] = red + validator['server_name'] + color_reset
-        # Calculate server version
-        if isinstance(validator['server_version'], str):
-            if validator['server_version'][0:].isdigit():
-                server_version = await decode_version(validator['server_version'])
-                validator['server_version'] = server_version.get('version')
-    return table
-
-async def print_table_validation(table):
-    '''
-    Print the validation table.
-
-    :param list table: Dictionaries for each validator being tracked.
-    '''
-    logging.info("Preparing to print updated validations table.")
-    pretty_table = PrettyTable()
-    pretty_table.field_names = [
-        "Validator Name", "Master Key", "Eph Key", "Version", "Base Fee", "Local LL Fee",
-        "LL Hash", "LL Index", "Full?", "Forked?", "Last Updated",
-    ]
+def format_validator(values):
+    '''
+    Format a validator's values, so they're human friendly.
+
+    :param tuple values: Values for VALIDATOR_FIELDS
+    :return: Cells for the validator table
+    :rtype: list
+    '''
+    validator = dict(zip(VALIDATOR_FIELDS, values))
+    # Shorten keys and hashes
+    for key in ['master_key', 'validation_public_key', 'ledger_hash']:
+        if isinstance(validator[key], str):
+            validator[key] = validator[key][:5]
+    # Green if not forked
+    if validator['forked'] is False:
+        validator['forked'] = GREEN + str(validator['forked']) + COLOR_RESET
+    else:
+        validator['forked'] = RED + str(validator['forked']) + COLOR_RESET
+        validator['server_name'] = RED + validator['server_name'] + COLOR_RESET
+    # Green if validations are full
+    if validator['full']:
+        validator['full'] = GREEN + str(validator['full']) + COLOR_RESET
+    else:
+        validator['full'] = RED + str(validator['full']) + COLOR_RESET
+        validator['server_name'] = RED + validator['server_name'] + COLOR_RESET
+    validator['server_name'] = validator['server_name'].lower()
+    return [validator[field] for field in VALIDATOR_FIELDS]
 
-    table_new = await format_table_validation(deepcopy(table))
-
-    for validator in table_new:
-        pretty_table.add_row([
-            validator['server_name'].lower(),
-            validator['master_key'],
-            validator['validation_public_key'],
-            validator['server_version'],
-            validator['base_fee'],
-            validator['load_fee'],
-            validator['ledger_hash'],
-            validator['ledger_index'],
-            validator['full'],
-            validator['forked'],
-            validator['time_updated'],
-        ])
-
-    pretty_table.sortby = "Validator Name"
-    print(pretty_table)
-    logging.info("Successfully printed updated validations table.")
+def sort_validator(values):
+    return values[0].lower()
 
 #Server table console output.
-async def fee_calc(fee, base_fee, multiple):
+def fee_calc(fee, base_fee, multiple):
     '''
     Calculate a fee and apply color if it's elevated.
     '''
-    color_reset = "\033[0;0m"
-    green = "\033[0;32m"
-    red = "\033[1;31m"
     if isinstance(fee, int) and isinstance(base_fee, int) and isinstance(multiple, int):
         calc_fee = round(fee / multiple * base_fee, 1)
         if calc_fee > base_fee:
-            calc_fee = red + str(calc_fee) + color_reset
+            calc_fee = RED + str(calc_fee) + COLOR_RESET
         elif calc_fee == base_fee:
-            calc_fee = green + str(calc_fee) + color_reset
+            calc_fee = GREEN + str(calc_fee) + COLOR_RESET
         else:
             calc_fee = fee
     elif isinstance(base_fee, int):
-        calc_fee = green + str(base_fee) + color_reset
+        calc_fee = GREEN + str(base_fee) + COLOR_RESET
     else:
         calc_fee = fee
     return calc_fee
 
-async def format_table_server(table):
+def format_server(values):
     '''
-    Format values to human readable.
+    Format a server's values to human readable.
 
-    :param list table: Dictionary for each server being tracked
+    :param tuple values: Values for SERVER_FIELDS
+    :return: Cells for the server table
     :rtype: list
     '''
-    color_reset = "\033[0;0m"
-    green = "\033[0;32m"
-    red = "\033[1;31m"
-    for server in table:
-        # Shorten ledger hashes
-        if isinstance(server['ledger_hash'], str):
-            server['ledger_hash'] = server['ledger_hash'][:5]
-        # Full servers in green
-        if isinstance(server['server_status'], str):
-            if server['server_status'] == "full":
-                server['server_status'] = green + server['server_status'] + color_reset
-            else:
-                server['server_status'] = red + server['server_status'] + color_reset
-                server['server_name'] = red + str(server['server_name']) + color_reset
-        # Forked Servers in Red
-        if server['forked'] is False:
-            server['forked'] = green + str(server['forked']) + color_reset
+    server = dict(zip(SERVER_FIELDS, values))
+    # Shorten ledger hashes
+    if isinstance(server['ledger_hash'], str):
+        server['ledger_hash'] = server['ledger_hash'][:5]
+    # Full servers in green
+    if isinstance(server['server_status'], str):
+        if server['server_status'] == "full":
+            server['server_status'] = GREEN + server['server_status'] + COLOR_RESET
         else:
-            server['forked'] = red + str(server['forked']) + color_reset
-            server['server_name'] = red + str(server['server_name']) + color_reset
-        # Base load factor in green
-        if isinstance(server['load_factor'], int) and isinstance(server['load_base'], int):
-            if server['load_factor'] == server['load_base']:
-                server['load_factor'] = round(server['load_factor'] / server['load_base'], 1)
-                server['load_factor'] = green + str(server['load_factor']) + color_reset
-            else:
-                server['load_factor'] = round(server['load_factor'] / server['load_base'], 1)
-                server['load_factor'] = red + str(server['load_factor']) + color_reset
+            server['server_status'] = RED + server['server_status'] + COLOR_RESET
+            server['server_name'] = RED + str(server['server_name']) + COLOR_RESET
+    # Forked Servers in Red
+    if server['forked'] is False:
+        server['forked'] = GREEN + str(server['forked']) + COLOR_RESET
+    else:
+        server['forked'] = RED + str(server['forked']) + COLOR_RESET
+        server['server_name'] = RED + str(server['server_name']) + COLOR_RESET
+    # Base load factor in green
+    if isinstance(server['load_factor'], int) and isinstance(server['load_base'], int):
+        color = GREEN if server['load_factor'] == server['load_base'] else RED
+        server['load_factor'] = round(server['load_factor'] / server['load_base'], 1)
+        server['load_factor'] = color + str(server['load_factor']) + COLOR_RESET
+    return [
+        server['server_name'],
+        server['server_status'],
         # Calculate Open Ledger Fee
-        server['load_factor_fee_escalation'] = await fee_calc(
-            server['load_factor_fee_escalation'], server['fee_base'], server['load_base']
-        )
+        fee_calc(server['load_factor_fee_escalation'], server['fee_base'], server['load_base']),
         # Calculate Queue Fee
-        server['load_factor_fee_queue'] = await fee_calc(
-            server['load_factor_fee_queue'], server['fee_base'], server['load_base']
-        )
-    return table
+        fee_calc(server['load_factor_fee_queue'], server['fee_base'], server['load_base']),
+        server['load_factor'],
+        server['ledger_hash'],
+        server['validated_ledgers'],
+        server['txn_count'],
+        server['forked'],
+        server['time_updated'],
+    ]
+
+def sort_server(values):
+    return str(values[0])
 
-async def print_table_server(table):
+# Amendment table output
+def format_amendment(values):
     '''
-    Print a pretty table to the console.
+    Color and other fun things!
 
-    :param list table: Dictionary for each server being tracked
+    :param tuple values: Amendment name, supporters, and the number of validators
+    :return: Cells for the amendment table
+    :rtype: list
     '''
-    logging.info("Preparing to print updated server table.")
-    pretty_table = PrettyTable()
-    pretty_table.field_names = [
-        "Server Name", "State", "O.L. Fee", "Queue Fee", "Load Multiplier",
-        "LL Hash", "History", "LL # Tx", "Forked?", "Last Updated",
+    name, supporters, validator_count = values
+    supporters = sorted(supporters, key=str.lower)
+
+    support_percent = round(len(supporters) / validator_count * 100, 1)
+    if support_percent > 80:
+        name = GREEN + str(name) + COLOR_RESET
+        support_percent = GREEN + str(support_percent) + COLOR_RESET
+    return [
+        name,
+        len(supporters),
+        validator_count - len(supporters),
+        support_percent,
+        textwrap.fill(''.join(supporter + ', ' for supporter in supporters), width=180),
     ]
-    table_new = await format_table_server(await copy_stock(table))
-
-    for server in table_new:
-        pretty_table.add_row([
-            server['server_name'],
-            server['server_status'],
-            server['load_factor_fee_escalation'],
-            server['load_factor_fee_queue'],
-            server['load_factor'],
-            server['ledger_hash'],
-            server['validated_ledgers'],
-            server['txn_count'],
-            server['forked'],
-            server['time_updated'],
-            ])
-    pretty_table.sortby = "Server Name"
-    print(pretty_table)
-    logging.info("Successfully printed updated server table.")
-
-async def sort_amendments(table_validator, amendments):
-    '''
-    Aggregate amendment votes.
-
-    :param dict table_validator: Validator tracking table.
-    :param dict amendments: Known amendment IDs mapped to their names.
-    '''
-    for amendment in amendments:
-        amendment['supporters'] = []
-        for validator in table_validator:
-            if isinstance(validator['amendments'], list):
-                if amendment['id'] in validator['amendments']:
-                    amendment['supporters'].append(validator['server_name'])
-
-    return amendments
-
-async def format_amendment(amendment, table_validator):
+
+def sort_amendment(values):
+    return -len(values[1])
+
+
+def visible_width(text):
     '''
-    Color and other fun things!
+    :return: Width of text on the console, excluding ANSI escape codes
+    :rtype: int
     '''
-    color_reset = "\033[0;0m"
-    green = "\033[0;32m"
+    if "\033" in text:
+        text = ANSI_ESCAPE.sub('', text)
+    return len(text)
 
-    amendment['supporters'].sort(key=str.lower)
+def draw_row(cells, widths):
+    '''
+    Draw a row, with each cell centered in its column.
+
+    :param list cells: Lines of text in each cell
+    :param tuple widths: Column widths
+    :return: Console lines
+    :rtype: list
+    '''
+    lines = []
+    for number in range(max(len(cell) for cell in cells)):
+        line = []
+        for cell, width in zip(cells, widths):
+            text = cell[number] if number < len(cell) else ''
+            padding = width - visible_width(text)
+            line.append(' ' * (padding // 2 + 1) + text + ' ' * (padding - padding // 2 + 1))
+        lines.append('|' + '|'.join(line) + '|')
+    return lines
 
-    support_percent = round(len(amendment['supporters']) / len(table_validator) * 100, 1)
-    if support_percent > 80:
-        amendment['name'] = green + str(amendment['name']) + color_reset
-        amendment['support_percent'] = green + str(support_percent) + color_reset
-    else:
-        amendment['support_percent'] = str(support_percent)
-    return amendment
 
-async def print_table_amendments(table_validator, amendments):
+class TableView:
     '''
-    Print information on amendment voting.
+    Draw a table in the same style as PrettyTable. Each distinct set of row values is formatted
+    once, and redrawn only when the column widths change.
 
-    :param dict table_validator: Validator tracking table.
-    :param dict amendments: Known amendment IDs mapped to their names.
+    :param tuple header: Column names
+    :param format_row: Function that returns a row's cells from its values
+    :param sort_key: Function that returns a row's sort key from its values
+    :param bool hrules: Draw a line between each row
     '''
-    logging.info("Preparing to print updated amendments table.")
-    pretty_table=PrettyTable()
-    pretty_table.field_names = [
-        "Amendment",
-        "Yea Votes",
-        "Nay Votes",
-        "% Support",
-        "Supporters",
-    ]
+    def __init__(self, header, format_row, sort_key, hrules=False):
+        self.header = [[name] for name in header]
+        self.format_row = format_row
+        self.sort_key = sort_key
+        self.hrules = hrules
+        self.rows = {} # Row values: [cells, cell widths, column widths, lines]
+        self.width = 0
+
+    def render(self, snapshot):
+        '''
+        :param list snapshot: Values for each row
+        :return: Console lines
+        :rtype: list
+        '''
+        snapshot = sorted(snapshot, key=self.sort_key)
+        rows = {}
+        for values in snapshot:
+            row = self.rows.get(values) or rows.get(values)
+            if row is None:
+                cells = [str(cell).split('\n') for cell in self.format_row(values)]
+                row = [cells, [max(map(visible_width, cell)) for cell in cells], None, None]
+            rows[values] = row
+        # Only keep rows that are still displayed
+        self.rows = rows
+
+        widths = [len(name[0]) for name in self.header]
+        for row in rows.values():
+            widths = list(map(max, widths, row[1]))
+        widths = tuple(widths)
+        rule = '+' + '+'.join('-' * (width + 2) for width in widths) + '+'
+        self.width = len(rule)
 
-    amendment_votes = await sort_amendments(table_validator, deepcopy(amendments))
-    for amendment in amendment_votes:
-        amendment = await format_amendment(amendment, table_validator)
-        supporters = ''
-        for supporter in amendment['supporters']:
-            supporters = supporters + supporter + ', '
-        pretty_table.add_row([
-            amendment['name'],
-            len(amendment['supporters']),
-            len(table_validator) - len(amendment['supporters']),
-            amendment['support_percent'],
-            textwrap.fill(supporters, width=180),
-        ])
-    pretty_table.hrules=ALL
-    pretty_table.sortby = "Yea Votes"
-    pretty_table.reversesort = True
-    print(pretty_table)
-    logging.info("Successfully printed the amendments table.")
+        lines = [rule] + draw_row(self.header, widths) + [rule]
+        for values in snapshot:
+            row = rows[values]
+            if row[2] != widths:
+                row[2] = widths
+                row[3] = draw_row(row[0], widths)
+            lines.extend(row[3])
+            if self.hrules:
+                lines.append(rule)
+        if snapshot and not self.hrules:
+            lines.append(rule)
+        return lines
+
+
+class ConsoleRenderer:
+    '''
+    Draw the console tables in a separate thread. Snapshots that arrive before the previous
+    one was drawn replace it, so a slow console never builds a backlog.
+
+    :param stream: Text stream to draw on (defaults to stdout)
+    '''
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+        self.snapshots = queue.Queue(maxsize=1)
+        self.tables = {
+            'server': TableView(SERVER_HEADER, format_server, sort_server),
+            'validator': TableView(VALIDATOR_HEADER, format_validator, sort_validator),
+            'amendment': TableView(
+                AMENDMENT_HEADER, format_amendment, sort_amendment, hrules=True
+            ),
+        }
+        self.frame = []
+        self.frame_width = 0
+        self.terminal_size = None
+        self.thread = None
+
+    def start(self):
+        '''
+        Start the drawing thread.
+        '''
+        self.thread = threading.Thread(target=self.run, name='ConsoleRenderer', daemon=True)
+        self.thread.start()
+        logging.warning("Console renderer started.")
+
+    def stop(self, timeout=1):
+        '''
+        Stop the drawing thread.
+
+        :param int timeout: Seconds to wait for the thread
+        '''
+        self.submit(None)
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def submit(self, snapshot):
+        '''
+        Queue a snapshot to draw, replacing one that hasn't been drawn yet.
+
+        :param dict snapshot: Snapshot from take_snapshot (None stops the thread)
+        '''
+        try:
+            self.snapshots.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            self.snapshots.put_nowait(snapshot)
+        except queue.Full:
+            logging.info("Console renderer is busy. Skipped a refresh.")
+
+    def run(self):
+        '''
+        Draw snapshots as they arrive.
+        '''
+        while True:
+            snapshot = self.snapshots.get()
+            if snapshot is None:
+                logging.warning("Console renderer stopped.")
+                break
+            try:
+                start = time.perf_counter()
+                self.draw(self.render(snapshot))
+                metrics.observe('monitor_console_render_seconds', time.perf_counter() - start)
+            except Exception as error:
+                logging.critical("Otherwise uncaught exception in console renderer: '%s'.", error)
+
+    def render(self, snapshot):
+        '''
+        :param dict snapshot: Snapshot from take_snapshot
+        :return: Console lines for every table in the snapshot
+        :rtype: list
+        '''
+        frame = []
+        self.frame_width = 0
+        for table, rows in snapshot.items():
+            frame.extend(self.tables[table].render(rows))
+            self.frame_width = max(self.frame_width, self.tables[table].width)
+        return frame
+
+    def draw(self, frame):
+        '''
+        Write the lines that changed since the last frame. The whole frame is drawn if the
+        terminal was resized, or if the frame doesn't fit (lines that scroll or wrap can't be
+        redrawn in place).
+
+        :param list frame: Console lines
+        '''
+        size = shutil.get_terminal_size()
+        if size != self.terminal_size or len(frame) >= size.lines \
+           or self.frame_width > size.columns:
+            output = ["\033[H\033[2J\033[3J", '\n'.join(frame), '\n']
+        else:
+            output = [
+                f"\033[{number};1H{line}\033[K"
+                for number, line in enumerate(frame, 1)
+                if number > len(self.frame) or self.frame[number - 1] != line
+            ]
+            output.append(f"\033[{len(frame) + 1};1H\033[J")
+        self.stream.write(''.join(output))
+        self.stream.flush()
+        self.frame = frame
+        self.terminal_size = size
@@ -0,0 +1,129 @@
+'''
+Keep a running count of the last ledger index reported by each monitored server.
+'''
+from bisect import bisect_left, bisect_right, insort
+
+
+class LedgerHistogram:
+    '''
+    Ledger index counts across stock servers and validators, updated as each server reports
+    a new ledger, so the consensus mode never needs to be recalculated from the full tables.
+
+    Servers are grouped by ledger index, ledger indexes are grouped by how many servers
+    reported them, and the distinct ledger indexes are kept sorted. This allows the mode(s) and
+    the servers furthest from the mode to be found without looking at every server.
+    '''
+    def __init__(self):
+        self.members = {} # Ledger index: {id(server): server}
+        self.buckets = {} # Number of servers: Ledger indexes reported by that many servers
+        self.indexes = [] # Sorted distinct ledger indexes
+        self.servers = {} # id(server): Ledger index
+        self.top = 0
+
+    def update(self, server):
+        '''
+        Move a server's count to the ledger index it most recently reported.
+
+        :param dict server: Stock server or validator dictionary
+        '''
+        index = server.get('ledger_index')
+        index = int(index) if index else None
+        previous = self.servers.get(id(server))
+        if previous == index:
+            return
+        if previous is not None:
+            self.remove(server, previous)
+        if index is not None:
+            self.add(server, index)
+
+    def add(self, server, index):
+        '''
+        :param dict server: Stock server or validator dictionary
+        :param int index: Ledger index the server reported
+        '''
+        members = self.members.get(index)
+        if members is None:
+            members = self.members[index] = {}
+            insort(self.indexes, index)
+        else:
+            self.leave_bucket(index, len(members))
+        # Members hold a reference to the server, so its id() is not reused while it's counted
+        members[id(server)] = server
+        self.servers[id(server)] = index
+        self.buckets.setdefault(len(members), set()).add(index)
+        self.top = max(self.top, len(members))
+
+    def remove(self, server, index):
+        '''
+        :param dict server: Stock server or validator dictionary
+        :param int index: Ledger index the server was counted at
+        '''
+        members = self.members[index]
+        self.leave_bucket(index, len(members))
+        del members[id(server)]
+        del self.servers[id(server)]
+        if members:
+            self.buckets.setdefault(len(members), set()).add(index)
+        else:
+            del self.members[index]
+            del self.indexes[bisect_left(self.indexes, index)]
+
+    def leave_bucket(self, index, count):
+        '''
+        :param int index: Ledger index whose count is about to change
+        :param int count: The ledger index's current count
+        '''
+        self.buckets[count].discard(index)
+        if not self.buckets[count]:
+            del self.buckets[count]
+            if count == self.top:
+                self.top -= 1
+
+    def discard(self, server):
+        '''
+        Stop counting a server.
+
+        :param dict server: Stock server or validator dictionary
+        '''
+        index = self.servers.get(id(server))
+        if index is not None:
+            self.remove(server, index)
+
+    def rebuild(self, table):
+        '''
+        Count only the servers in the table (e.g., after duplicate validators are removed).
+
+        :param list table: Stock server and validator dictionaries
+        '''
+        self.members = {}
+        self.buckets = {}
+        self.indexes = []
+        self.servers = {}
+        self.top = 0
+        for server in table:
+            self.update(server)
+
+    def modes(self):
+        '''
+        :return: Most common ledger index(es), or None if no ledgers were reported
+        :rtype: list
+        '''
+        if not self.top:
+            return None
+        return sorted(self.buckets[self.top])
+
+    def outliers(self, mode, distance):
+        '''
+        Find servers whose ledger index is more than 'distance' from the mode.
+
+        :param int mode: Consensus ledger index
+        :param int distance: Number of ledgers ahead or behind the mode to tolerate
+
+        :rtype: list
+        '''
+        low = bisect_left(self.indexes, int(mode) - int(distance))
+        high = bisect_right(self.indexes, int(mode) + int(distance))
+        servers = []
+        for index in self.indexes[:low] + self.indexes[high:]:
+            servers.extend(self.members[index].values())
+        return servers
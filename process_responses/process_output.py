@@ -1,15 +1,22 @@
 '''
 Process messages from the asyncio queue.
 '''
-import os
 import logging
 import time
 import asyncio
 
+from misc import log_setup, metrics
+from misc.tracing import TracedQueue
 from . import console_output
-from .check_forked import fork_checker
+from .check_forked import fork_checker, ForkTracker
 from . import process_stock_output
 from . import process_validation_output
+from .validation_cache import ValidationCache
+from .amendment_index import AmendmentIndex
+from .common import add_implementations
+from .history_store import create_history_store
+
+QUEUE_POLL_TIMEOUT = 1 # Seconds to wait for new messages before checking for cancellation
 
 class ResponseProcessor:
     '''
@@ -23,42 +30,47 @@ class ResponseProcessor:
         self.table_validator = args_d['table_validator']
         self.forks = []
         self.ll_modes = []
-        self.val_keys = []
-        self.processed_validations = []
+        self.val_index = {}
+        self.url_index = {}
+        self.processed_validations = ValidationCache(self.settings.PROCESSED_VAL_MAX)
         self.message_queue = args_d['message_queue']
-        self.notification_queue = args_d['notification_queue']
-        self.time_last_output = 0
-        self.time_fork_check = 0
-        self.last_heartbeat = time.time()
-
+        self.notification_queue = TracedQueue(args_d['notification_queue'])
+        self.fork_tracker = ForkTracker(self.settings, self.notification_queue)
+        self.amendment_index = AmendmentIndex(self.settings.AMENDMENTS)
+        add_implementations(self.settings.SERVER_IMPLEMENTATIONS)
+        self.history = create_history_store(self.settings)
+        self.console = None
+        if self.settings.CONSOLE_OUT is True:
+            self.console = console_output.ConsoleRenderer()
 
     async def process_console_output(self):
         '''
-        Call functions to print messages to the console, depending on settings.
+        Hand a snapshot of the tables to the console renderer, depending on settings.
+        '''
+        if self.console is not None:
+            self.console.submit(console_output.take_snapshot(
+                self.table_stock,
+                self.table_validator,
+                self.amendment_index if self.settings.PRINT_AMENDMENTS else None,
+            ))
 
-        :param settings: Config file
+    async def record_history(self):
+        '''
+        Sample the tables into the history store, if enabled.
         '''
-        if self.settings.CONSOLE_OUT is True \
-           and time.time() - self.time_last_output >= int(self.settings.CONSOLE_REFRESH_TIME):
-            os.system('clear')
-            await console_output.print_table_server(self.table_stock)
-            if self.table_validator:
-                await console_output.print_table_validation(self.table_validator)
-                if self.settings.PRINT_AMENDMENTS:
-                    await console_output.print_table_amendments(
-                        self.table_validator, self.settings.AMENDMENTS
-                    )
-            self.time_last_output = time.time()
+        if self.history is not None:
+            self.history.record(self.table_stock, self.table_validator)
 
     async def evaluate_forks(self):
         '''
         Call functions to check for forked servers.
         '''
-        if time.time() - self.time_fork_check > int(self.settings.FORK_CHECK_FREQ):
-            self.ll_modes, self.table_stock, self.table_validator = await fork_checker(
-                self.settings, self.table_stock, self.table_validator, self.notification_queue
-            )
-            self.time_fork_check = time.time()
+        start = time.monotonic()
+        self.notification_queue.begin('fork_check', start)
+        self.ll_modes = await fork_checker(
+            self.settings, self.fork_tracker, self.notification_queue
+        )
+        metrics.observe('monitor_fork_check_seconds', time.monotonic() - start)
 
     async def sort_new_messages(self, message):
         '''
@@ -68,58 +80,67 @@ class ResponseProcessor:
         '''
         # Check for server subscription messages
         if message['data'].get('type') == 'serverStatus' or message['data'].get('result'):
-            self.table_stock = \
-                    await process_stock_output.update_table_server(
-                        self.table_stock, self.notification_queue, message
-                    )
+            await process_stock_output.update_table_server(
+                self.url_index, self.notification_queue, self.fork_tracker, message
+            )
 
         # Check for ledger subscription messages
         elif message['data'].get('type') == 'ledgerClosed':
-            self.table_stock = \
-                    await process_stock_output.update_table_ledger(
-                        self.table_stock, message
-                    )
+            await process_stock_output.update_table_ledger(
+                self.url_index, self.fork_tracker, message
+            )
 
         # Check for validation messages
         elif message['data'].get('type') == 'validationReceived':
-            self.val_keys, self.table_validator, self.processed_validations = \
+            table_validator = self.table_validator
+            self.val_index, self.table_validator, self.processed_validations = \
                     await process_validation_output.check_validations(
                         self.settings,
-                        self.val_keys,
+                        self.val_index,
                         self.table_validator,
                         self.processed_validations,
+                        self.fork_tracker,
+                        self.amendment_index,
                         message
             )
+            # Stop counting ledgers from validators that were removed as duplicates
+            if self.table_validator is not table_validator:
+                self.fork_tracker.rebuild(self.table_stock + self.table_validator)
+                self.amendment_index.rebuild(self.table_validator)
 
         else:
             logging.warning("Message received that couldn't be sorted: '%s'.", message)
 
     async def generate_val_keys(self):
         '''
-        Create a list of all potential keys for validators we are monitoring.
+        Index all potential keys for validators we are monitoring.
         '''
-        val_keys = list(i.get('master_key') for i in self.table_validator) \
-                + list(i.get('validation_public_key') for i in self.table_validator)
+        self.val_index = await process_validation_output.build_val_index(self.table_validator)
+        logging.warning(
+            "Created initial validation key index with: '%d' items.", len(self.val_index)
+        )
 
-        for i in val_keys:
-            if i:
-                self.val_keys.append(i)
+    async def generate_url_index(self):
+        '''
+        Index the stock servers we are monitoring by URL.
+        '''
+        self.url_index = await process_stock_output.build_url_index(self.table_stock)
         logging.warning(
-            "Created initial validation key tracking list with: '%d' items.", len(self.val_keys)
+            "Created initial server URL index with: '%d' items.", len(self.url_index)
         )
 
     async def heartbeat_message(self):
         '''
         Send an SMS message periodically.
         '''
-        if self.settings.ADMIN_HEARTBEAT \
-           and time.time() - self.last_heartbeat >= int(self.settings.HEARTBEAT_INTERVAL):
+        if self.settings.ADMIN_HEARTBEAT:
             now = time.strftime("%m-%d %H:%M:%S", time.gmtime())
             message = "Livenet Monitoring Bot heartbeat. "
-            message = message + str(f"LL mode: '{self.ll_modes[0]}'. ")
+            message = message + str(f"LL mode: '{self.ll_modes[0] if self.ll_modes else None}'. ")
             message = message + str(f"Server time (UTC): '{now}'.")
             logging.info(message)
 
+            self.notification_queue.begin('heartbeat', time.monotonic())
             for admin in self.settings.ADMIN_NOTIFICATIONS:
                 self.notification_queue.put(
                     {
@@ -128,26 +149,68 @@ class ResponseProcessor:
                     }
                 )
 
-            self.last_heartbeat = time.time()
+    async def run_periodically(self, function, interval):
+        '''
+        Call a function on a fixed cadence, regardless of how often messages arrive.
+
+        :param function: Coroutine function to call
+        :param int interval: Seconds to wait between calls
+        '''
+        while True:
+            try:
+                await asyncio.sleep(int(interval))
+                await function()
+            except (asyncio.CancelledError, KeyboardInterrupt):
+                logging.critical("Keyboard interrupt detected. Stopping: '%s'.", function.__name__)
+                break
+            except Exception as error:
+                logging.critical(
+                    "Otherwise uncaught exception in: '%s': '%s'.", function.__name__, error
+                )
+
+    async def process_message(self, message):
+        '''
+        Process a single message without letting a malformed message stop the processor.
+
+        :param dict message: Incoming subscription response
+        '''
+        start = time.monotonic()
+        received = message.get('received')
+        if received is not None:
+            metrics.observe('monitor_message_ingest_seconds', start - received)
+        self.notification_queue.begin('message', start, received)
+        if log_setup.DEBUG and log_setup.sample():
+            logging.debug("Tracing message: '%s'.", message)
+        try:
+            await self.sort_new_messages(message)
+            metrics.observe(
+                'monitor_process_seconds', time.monotonic() - start,
+                (message['data'].get('type', 'response'),)
+            )
+        except KeyError as error :
+            logging.warning(
+                "Error: '%s'. Received an unexpected message: '%s'.", error, message
+            )
+        except Exception as error:
+            logging.critical("Otherwise uncaught exception in response processor: '%s'.", error)
 
     async def process_messages(self):
         '''
         Listen for incoming messages and execute functions accordingly.
 
+        Messages are read in batches from a worker thread, so waiting for the queue doesn't
+        block the event loop (and the timer tasks running on it).
         '''
         await self.generate_val_keys()
+        await self.generate_url_index()
 
         while True:
             try:
-                message = self.message_queue.get()
-                await self.sort_new_messages(message)
-                await self.evaluate_forks()
-                await self.process_console_output()
-                await self.heartbeat_message()
-            except KeyError as error :
-                logging.warning(
-                    "Error: '%s'. Received an unexpected message: '%s'.", error, message
+                messages = await asyncio.to_thread(
+                    self.message_queue.get_messages, QUEUE_POLL_TIMEOUT
                 )
+                for message in messages:
+                    await self.process_message(message)
             except (asyncio.CancelledError, KeyboardInterrupt):
                 logging.critical("Keyboard interrupt detected. Response processor stopped.")
                 break
@@ -160,13 +223,41 @@ def start_output_processing(args_d):
 
     :param dict args_d: Default settings, queues, and tables.
     '''
+    log_setup.start_log_thread(args_d['settings'])
     loop = asyncio.new_event_loop()
     monitor_tasks = []
 
     try:
-        monitor_tasks.append(
-            loop.create_task(ResponseProcessor(args_d).process_messages())
-        )
+        processor = ResponseProcessor(args_d)
+        settings = processor.settings
+        if processor.console is not None:
+            processor.console.start()
+        if processor.history is not None:
+            processor.history.start()
+        monitor_tasks.append(loop.create_task(processor.process_messages()))
+        monitor_tasks.append(loop.create_task(
+            processor.run_periodically(processor.evaluate_forks, settings.FORK_CHECK_FREQ)
+        ))
+        monitor_tasks.append(loop.create_task(
+            processor.run_periodically(
+                processor.process_console_output, settings.CONSOLE_REFRESH_TIME
+            )
+        ))
+        monitor_tasks.append(loop.create_task(
+            processor.run_periodically(processor.heartbeat_message, settings.HEARTBEAT_INTERVAL)
+        ))
+        monitor_tasks.append(loop.create_task(
+            processor.run_periodically(processor.record_history, settings.HISTORY_SAMPLE_INTERVAL)
+        ))
+        if args_d.get('metrics_queue') is not None:
+            metrics.enable()
+            if not processor.message_queue.raw_frames:
+                metrics.register_gauge(
+                    'monitor_message_queue_depth', processor.message_queue.depth
+                )
+            monitor_tasks.append(loop.create_task(
+                metrics.publish_forever(args_d['metrics_queue'], settings.METRICS_INTERVAL)
+            ))
 
         logging.warning("Response processor loop started.")
         loop.run_forever()
@@ -174,4 +265,10 @@ def start_output_processing(args_d):
     except KeyboardInterrupt:
         for task in monitor_tasks:
             task.cancel()
+        if processor.console is not None:
+            processor.console.stop()
+        if processor.history is not None:
+            processor.history.stop()
         logging.critical("Closed response processor asyncio loops.")
+    finally:
+        log_setup.stop_log_thread()
@@ -5,30 +5,44 @@ This output is not relevant for monitoring validations.
 import logging
 import time
 
+from misc import log_setup
+from . import history_store
+from . import projections
 
-async def update_table_ledger(table, message):
+
+async def build_url_index(table):
     '''
-    Add information from ledger closed messages into the table.
+    Map each server URL to the servers being tracked at that URL.
 
     :param list table: Dictionary for each server being tracked
-    :param dict message: Incoming ledger close message
 
-    :rtype: list
+    :return: URLs mapped to a list of server dictionaries
+    :rtype: dict
     '''
-
+    url_index = {}
     for server in table:
-        if server['url'] == message['server_url']:
-            for key in server.keys():
-                if key in message['data'].keys():
-                    server[key] = message['data'][key]
-            server['time_updated'] = time.strftime("%y-%m-%d %H:%M:%S", time.gmtime())
-            logging.info(
+        url_index.setdefault(server['url'], []).append(server)
+    return url_index
+
+async def update_table_ledger(url_index, fork_tracker, message):
+    '''
+    Add information from ledger closed messages into the table.
+
+    :param dict url_index: URLs mapped to the servers being tracked
+    :param ForkTracker fork_tracker: Ledger index counts for all monitored servers
+    :param dict message: Incoming ledger close message
+    '''
+
+    for server in url_index.get(message['server_url'], []):
+        projections.LEDGER_CLOSED.apply(server, message['data'])
+        server['time_updated'] = time.strftime("%y-%m-%d %H:%M:%S", time.gmtime())
+        await fork_tracker.observe(server)
+        if log_setup.SAMPLED:
+            logging.debug(
                 "Successfully updated the table with ledger closed message from: '%s'.",
                 server.get('url')
             )
 
-    return table
-
 async def check_state_change(server, message, notification_queue):
     '''
     Check if the server's state changed from the last known state.
@@ -54,32 +68,35 @@ async def check_state_change(server, message, notification_queue):
                 'server': server,
             }
         )
+        history_store.record_event(
+            server, 'server_status', server.get('server_status'), message.get('server_status')
+        )
 
-async def update_table_server(table, notification_queue, message):
+async def update_table_server(url_index, notification_queue, fork_tracker, message):
     '''
     Add info contained in new messages to the table.
 
-    :param settings: Config file
-    :param list table: Dictionary for each server being tracked
+    :param dict url_index: URLs mapped to the servers being tracked
     :param asyncio.queues.Queue notification_queue: Message queue to send via SMS
+    :param ForkTracker fork_tracker: Ledger index counts for all monitored servers
     :param dict message: New server subscription message
     '''
-    logging.info(
-        "Server status message received '%s'. Preparing to update the table.", message
-    )
+    if log_setup.SAMPLED:
+        logging.debug(
+            "Server status message received '%s'. Preparing to update the table.", message
+        )
     if message['data'].get('result'):
         message_result = message['data']['result']
+        projection = projections.SERVER_RESULT
     elif message['data'].get('type') == 'serverStatus':
         message_result = message['data']
+        projection = projections.SERVER_STATUS
 
-    for server in table:
-        if server['url'] == message['server_url']:
-            await check_state_change(server, message_result, notification_queue)
-            for key in message_result.keys():
-                if key in server.keys():
-                    server[key] = message_result[key]
-            server['time_updated'] = time.strftime("%y-%m-%d %H:%M:%S", time.localtime())
-
-            logging.info("Successfully updated the server status table.")
+    for server in url_index.get(message['server_url'], []):
+        await check_state_change(server, message_result, notification_queue)
+        projection.apply(server, message_result)
+        server['time_updated'] = time.strftime("%y-%m-%d %H:%M:%S", time.localtime())
+        await fork_tracker.observe(server)
 
-    return table
+        if log_setup.SAMPLED:
+            logging.debug("Successfully updated the server status table.")
@@ -4,20 +4,91 @@ Process validation stream messages.
 import logging
 import time
 
+from misc import log_setup
+from . import history_store
+from . import projections
+from .common import format_version
+
+async def build_val_index(table):
+    '''
+    Map each master and ephemeral validation key to the validators tracking it.
+
+    :param list table: Dictionaries for each validator being tracked
+
+    :return: Validation keys mapped to a list of validator dictionaries
+    :rtype: dict
+    '''
+    val_index = {}
+    for validator in table:
+        for key_type in ['master_key', 'validation_public_key']:
+            key = validator.get(key_type)
+            if key:
+                val_index.setdefault(key, [])
+                if not any(validator is i for i in val_index[key]):
+                    val_index[key].append(validator)
+    return val_index
+
+async def get_validators(val_index, message):
+    '''
+    Find the validators a validation message belongs to.
+
+    :param dict val_index: Validation keys mapped to validator dictionaries
+    :param dict message: Data from a validation message
+
+    :rtype: list
+    '''
+    validators = list(val_index.get(message.get('master_key'), []))
+    for validator in val_index.get(message.get('validation_public_key'), []):
+        if not any(validator is i for i in validators):
+            validators.append(validator)
+    return validators
+
+async def reindex_validator(val_index, validator, old_keys):
+    '''
+    Keep the index current when a validator's keys change (e.g., when the master key is
+    learned from a validation or the ephemeral key is rotated).
+
+    :param dict val_index: Validation keys mapped to validator dictionaries
+    :param dict validator: An individual validator's dictionary
+    :param dict old_keys: 'master_key' and 'validation_public_key' before the update
+    '''
+    for key_type, old_key in old_keys.items():
+        new_key = validator.get(key_type)
+        if new_key == old_key:
+            continue
+        if old_key in val_index:
+            val_index[old_key] = [i for i in val_index[old_key] if i is not validator]
+            if not val_index[old_key]:
+                del val_index[old_key]
+        if new_key:
+            val_index.setdefault(new_key, [])
+            if not any(validator is i for i in val_index[new_key]):
+                val_index[new_key].append(validator)
+        if old_key:
+            logging.warning(
+                "Validator: '%s' '%s' changed from: '%s' to: '%s'.",
+                validator.get('server_name'), key_type, old_key, new_key
+            )
+        else:
+            logging.info(
+                "Validator: '%s' '%s' learned: '%s'.",
+                validator.get('server_name'), key_type, new_key
+            )
+
 async def del_dup_validators(table):
     '''
-    Remove duplicate entries from the val_keys list.
+    Remove duplicate validators from the table, then rebuild the validator index.
 
     :param list table: Dictionaries for each validator being tracked
 
-    :rtype: (list, list)
+    :rtype: (dict, list)
     '''
-    val_keys = []
+    master_keys = set()
     table_new = []
 
     for validator in table:
-        if validator.get('master_key') not in val_keys:
-            val_keys.append(validator.get('master_key'))
+        if validator.get('master_key') not in master_keys:
+            master_keys.add(validator.get('master_key'))
             table_new.append(validator)
         else:
             logging.warning("Removed duplicate validator: '%s'.", validator)
@@ -27,101 +98,108 @@ async def del_dup_validators(table):
         New table has: '%d' items.",
         len(table), len(table_new)
     )
-    return val_keys, table_new
+    return await build_val_index(table_new), table_new
 
-async def clean_validations(settings, val_keys, table, processed_validations):
+async def clean_validations(settings, val_index, table, processed_validations):
     '''
-    Ensure the processed_validations list doesn't go on forever.
+    Ensure the processed_validations cache doesn't go on forever.
 
     If set, ensure the same validator isn't monitored twice.
 
     :param settings: Config file
-    :param list val_keys: Master or ephemeral validation keys we are monitoring for
+    :param dict val_index: Validation keys mapped to the validators we are monitoring
     :param list table: Dictionaries for each validator being tracked
-    :param list processed_validations: Prune this
+    :param ValidationCache processed_validations: Prune this
     '''
-    settings.PROCESSED_VAL_MAX = int(settings.PROCESSED_VAL_MAX)
-    if len(processed_validations) >= settings.PROCESSED_VAL_MAX:
-        half_list = settings.PROCESSED_VAL_MAX // 2
+    if processed_validations.is_full():
+        half_list = processed_validations.max_size // 2
         logging.info(
-            "Processed validation list >= '%d'. Deleting: '%d' items.",
-            settings.PROCESSED_VAL_MAX, half_list
+            "Processed validation cache >= '%d'. Deleting: '%d' items.",
+            processed_validations.max_size, half_list
         )
-        del processed_validations[0:half_list]
+        processed_validations.prune(half_list)
+        processed_validations.log_stats()
 
         if settings.REMOVE_DUP_VALIDATORS:
-            val_keys, table = await del_dup_validators(table)
-    return val_keys, table, processed_validations
+            val_index, table = await del_dup_validators(table)
+    return val_index, table, processed_validations
 
-async def reset_potentially_omitted_values(validator):
-    '''
-    Don't assume that potentially omitted values persist.
-    For example, an amendment may be supported by a validator
-    then the validator operator drops support, resulting in a flag ledger
-    with the 'amendment' key/value missing. Without this function, it would appear
-    that the operator still supports the amendment, despite dropping support.
-
-    :param dict validator: An individual validator's dictionary
+async def update_table_validator(validators, val_index, fork_tracker, amendment_index, message):
     '''
-    message_keys = ['amendments', 'base_fee', 'load_fee', 'reserve_base', 'reserve_inc', 'server_version']
-    for i in message_keys:
-        validator[i] = None
+    Update the validators a received validation message belongs to.
 
-async def update_table_validator(table, message):
-    '''
-    Update the table based on a received validation message.
-
-    :param list table: Dictionaries for each validator being tracked
+    :param list validators: Dictionaries for the validators that sent the message
+    :param dict val_index: Validation keys mapped to validator dictionaries
+    :param ForkTracker fork_tracker: Ledger index counts for all monitored servers
+    :param AmendmentIndex amendment_index: Amendment votes for each validator
     :param dict message: JSON decoded message to add to the table
     '''
     message = message['data']
 
     # Consider notifying if the ephemeral/master key or cookie changes for a server
 
-    for validator in table:
-        if message.get('master_key') and message.get('master_key') == validator['master_key'] \
-           or message.get('validation_public_key') == validator['validation_public_key']:
-            # Check if this is a flag ledger.
-            if (int(message['ledger_index']) + 1) % 256 == 0:
-                await reset_potentially_omitted_values(validator)
-            for key in validator.keys():
-                if key in message.keys():
-                    validator[key] = message[key]
-            validator['time_updated'] = time.strftime("%y-%m-%d %H:%M:%S", time.localtime())
-    logging.info("Successfully updated validator table.")
-
-    return table
-
-async def process_validations(settings, val_keys, table_validator, processed_validations, message):
+    # Don't assume that potentially omitted values persist. For example, an amendment may be
+    # supported by a validator then the validator operator drops support, resulting in a flag
+    # ledger with the 'amendments' key/value missing. Without clearing omitted values on flag
+    # ledgers, it would appear that the operator still supports the amendment.
+    if (int(message['ledger_index']) + 1) % 256 == 0:
+        projection = projections.VALIDATION_FLAG_LEDGER
+    else:
+        projection = projections.VALIDATION
+
+    for validator in validators:
+        old_keys = {
+            'master_key': validator['master_key'],
+            'validation_public_key': validator['validation_public_key'],
+        }
+        full = validator['full']
+        projection.apply(validator, message)
+        if validator['full'] != full:
+            history_store.record_event(validator, 'full', full, validator['full'])
+        if projection is projections.VALIDATION_FLAG_LEDGER or 'amendments' in message:
+            amendment_index.update(validator)
+        if projection is projections.VALIDATION_FLAG_LEDGER or 'server_version' in message:
+            validator['version'] = format_version(validator['server_version'])
+        validator['time_updated'] = time.strftime("%y-%m-%d %H:%M:%S", time.localtime())
+        await fork_tracker.observe(validator)
+        if validator['master_key'] != old_keys['master_key'] \
+           or validator['validation_public_key'] != old_keys['validation_public_key']:
+            await reindex_validator(val_index, validator, old_keys)
+    if log_setup.SAMPLED:
+        logging.debug("Successfully updated validator table.")
+
+async def process_validations(
+        settings, val_index, table_validator, processed_validations, fork_tracker,
+        amendment_index, validators, message
+):
     '''
     Process unique validation messages.
     :param settings: Configuration file
-    :param list val_keys: master and ephemeral validation keys to monitor for
+    :param dict val_index: Validation keys mapped to the validators we are monitoring
     :param list table_validator: Dictionaries for each validator being tracked
-    :param list processed_validations: Validation messages we already processed (avoid
-    processing duplicate messages)
+    :param ValidationCache processed_validations: Validation messages we already processed
+    (avoid processing duplicate messages)
+    :param ForkTracker fork_tracker: Ledger index counts for all monitored servers
+    :param AmendmentIndex amendment_index: Amendment votes for each validator
+    :param list validators: Dictionaries for the validators that sent the message
     :param dict message: JSON decoded message to process
     '''
     # Update the table
-    logging.info(
-        "Preparing to update validator table based on message from '%s'.", message.get('server_url')
-    )
-    table_validator = await update_table_validator(table_validator, message)
-    logging.info("Updated validator table based on message from '%s'.", message.get('server_url'))
+    await update_table_validator(validators, val_index, fork_tracker, amendment_index, message)
     # Add the message so we don't process duplicates
-    processed_validations.append(message['data']['signature'])
-    logging.info(
-        "Appended validation from '%s' to received tracking queue.", message.get('server_url')
-    )
+    processed_validations.add(message['data']['signature'])
     # Prune received message queue and remove duplicate validators from tracking
     # (depending on settings)
-    logging.info("Checking to see if we need to clean things")
-    val_keys, table_validator, processed_validations = await clean_validations(
-        settings, val_keys, table_validator, processed_validations
+    val_index, table_validator, processed_validations = await clean_validations(
+        settings, val_index, table_validator, processed_validations
     )
 
-    logging.info("Done processing validation message.")
-    return val_keys, table_validator, processed_validations
+    if log_setup.SAMPLED:
+        logging.debug(
+            "Done processing validation message from: '%s' for: '%d' validators.",
+            message.get('server_url'), len(validators)
+        )
+    return val_index, table_validator, processed_validations
 
 async def log_validations(settings, message):
     '''
@@ -130,26 +208,33 @@ async def log_validations(settings, message):
     if message['data'].get('master_key') in settings.LOG_VALIDATIONS_FROM:
         logging.critical("Logged validation: '%s'.", message)
 
-async def check_validations(settings, val_keys, table_validator, processed_validations, message):
+async def check_validations(
+        settings, val_index, table_validator, processed_validations, fork_tracker,
+        amendment_index, message
+):
     '''
     Check to see if we should continue processing validation messages.
 
     :param settings: Configuration file
-    :param list val_keys: master and ephemeral validation keys to monitor for
+    :param dict val_index: Validation keys mapped to the validators we are monitoring
     :param list table_validator: Dictionaries for each validator being tracked
-    :param list processed_validations: Validation messages we already processed (avoid
-    processing duplicate messages)
+    :param ValidationCache processed_validations: Validation messages we already processed
+    (avoid processing duplicate messages)
+    :param ForkTracker fork_tracker: Ledger index counts for all monitored servers
+    :param AmendmentIndex amendment_index: Amendment votes for each validator
     :param dict message: JSON decoded message to process
     '''
-    logging.debug("New validation message from '%s'.", message.get('server_url'))
-    if message['data'].get('master_key') in val_keys or message['data'].get('validation_public_key') in val_keys \
-       and message['data'].get('validation_public_key'):
-        if message['data']['signature'] not in processed_validations:
-            val_keys, table_validator, processed_validations = await process_validations(
-                settings, val_keys, table_validator, processed_validations, message
+    if log_setup.SAMPLED:
+        logging.debug("New validation message from '%s'.", message.get('server_url'))
+    validators = await get_validators(val_index, message['data'])
+    if validators:
+        if not processed_validations.seen(message['data']['signature']):
+            val_index, table_validator, processed_validations = await process_validations(
+                settings, val_index, table_validator, processed_validations, fork_tracker,
+                amendment_index, validators, message
             )
             await log_validations(settings, message)
-    else:
+    elif log_setup.SAMPLED:
         logging.debug("Ignored validation message from: '%s'.", message.get('server_url'))
 
-    return val_keys, table_validator, processed_validations
+    return val_index, table_validator, processed_validations
@@ -0,0 +1,74 @@
+'''
+Per message type projections of subscription messages onto table rows.
+
+Each projection is compiled once from the row schema: the fields a message type can update,
+less the fields the monitor maintains itself. Applying a projection is then a single loop over
+those fields, writing straight to the row's slots.
+'''
+from misc.table_rows import StockRow, ValidatorRow
+
+# Fields set by the monitor, never copied from messages
+MONITOR_FIELDS = frozenset([
+    'server_id', 'server_name', 'url', 'ssl_verify', 'command', 'ws_retry_count', 'ws_failures',
+    'ws_circuit', 'ws_connected', 'ws_connected_time', 'ws_connection_task', 'notifications',
+    'forked', 'time_forked', 'time_updated', 'version',
+])
+
+# Fields each stream's messages can contain (None: any field in the row schema)
+SERVER_STATUS_FIELDS = frozenset([
+    'base_fee', 'hostid', 'load_base', 'load_factor', 'load_factor_fee_escalation',
+    'load_factor_fee_queue', 'load_factor_fee_reference', 'load_factor_server', 'pubkey_node',
+    'reserve_base', 'reserve_inc', 'server_status',
+])
+LEDGER_CLOSED_FIELDS = frozenset([
+    'fee_base', 'fee_ref', 'ledger_hash', 'ledger_index', 'ledger_time', 'reserve_base',
+    'reserve_inc', 'txn_count', 'validated_ledgers',
+])
+# Validations only include these fields on flag ledgers, so they are cleared on flag ledgers
+# rather than left holding values from the last flag ledger.
+FLAG_LEDGER_FIELDS = (
+    'amendments', 'base_fee', 'load_fee', 'reserve_base', 'reserve_inc', 'server_version',
+)
+
+MISSING = object()
+
+
+class Projection:
+    '''
+    Copy the fields a message type can update from a message into a row.
+
+    :param row_class: TableRow subclass the projection applies to
+    :param message_fields: Fields the message type can contain (None for any row field)
+    :param tuple reset_fields: Fields set to None when they are absent from the message
+    '''
+    def __init__(self, row_class, message_fields=None, reset_fields=()):
+        for field in reset_fields:
+            if field not in row_class.FIELD_SET:
+                raise ValueError(f"'{field}' is not a field of {row_class.__name__}")
+        self.reset_fields = tuple(reset_fields)
+        self.fields = tuple(
+            field for field in row_class.FIELDS
+            if field not in MONITOR_FIELDS
+            and field not in self.reset_fields
+            and (message_fields is None or field in message_fields)
+        )
+
+    def apply(self, row, data):
+        '''
+        :param TableRow row: Row to update
+        :param dict data: Decoded message
+        '''
+        get = data.get
+        for field in self.fields:
+            value = get(field, MISSING)
+            if value is not MISSING:
+                setattr(row, field, value)
+        for field in self.reset_fields:
+            setattr(row, field, get(field))
+
+
+SERVER_STATUS = Projection(StockRow, SERVER_STATUS_FIELDS)
+SERVER_RESULT = Projection(StockRow)
+LEDGER_CLOSED = Projection(StockRow, LEDGER_CLOSED_FIELDS)
+VALIDATION = Projection(ValidatorRow)
+VALIDATION_FLAG_LEDGER = Projection(ValidatorRow, reset_fields=FLAG_LEDGER_FIELDS)
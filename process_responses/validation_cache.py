@@ -0,0 +1,95 @@
+'''
+Track validation signatures that were already processed, so duplicate validations
+received from multiple validation streams are only handled once.
+'''
+import logging
+from collections import deque
+
+
+class ValidationCache:
+    '''
+    Bounded cache of validation signatures with constant time lookups and inserts.
+
+    Signatures are evicted oldest first. When the cache is pruned, the oldest half is
+    dropped, which mirrors how the previous list based tracking behaved.
+
+    :param int max_size: Number of signatures to hold before the cache should be pruned
+    '''
+    def __init__(self, max_size):
+        self.max_size = int(max_size)
+        self.signatures = set()
+        self.order = deque()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.order)
+
+    def __contains__(self, signature):
+        return signature in self.signatures
+
+    def seen(self, signature):
+        '''
+        Check if a signature was already processed and record the lookup.
+
+        :param str signature: Validation signature
+        :rtype: bool
+        '''
+        if signature in self.signatures:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def add(self, signature):
+        '''
+        Record a processed signature.
+
+        :param str signature: Validation signature
+        '''
+        if signature not in self.signatures:
+            self.signatures.add(signature)
+            self.order.append(signature)
+
+    def is_full(self):
+        '''
+        :return: True if the cache reached its maximum size
+        :rtype: bool
+        '''
+        return len(self.order) >= self.max_size
+
+    def prune(self, count):
+        '''
+        Evict the oldest signatures.
+
+        :param int count: Number of signatures to evict
+        :return: Number of signatures evicted
+        :rtype: int
+        '''
+        count = min(int(count), len(self.order))
+        for _ in range(count):
+            self.signatures.discard(self.order.popleft())
+        self.evictions += count
+        return count
+
+    def stats(self):
+        '''
+        Summarize how effective the cache is.
+
+        :rtype: dict
+        '''
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.order),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            'evictions': self.evictions,
+        }
+
+    def log_stats(self):
+        '''
+        Write cache statistics to the log.
+        '''
+        logging.info("Processed validation cache stats: '%s'.", self.stats())
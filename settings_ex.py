@@ -6,16 +6,39 @@ import logging
 #### Logging ####
 LOG_FILE = "monitor.log" # Where should the log file live?
 LOG_LEVEL = logging.WARNING # How verbose should logs be ("INFO", "WARNING", "ERROR", "CRITICAL")?
+LOG_SAMPLE_RATE = 1000 # With LOG_LEVEL at DEBUG, trace one in this many messages through the response processor (1 traces every message)
 ASYNCIO_DEBUG = False # Verbose logging from asyncio
+SHUTDOWN_TIMEOUT = 10 # Seconds to wait for each process to exit after a keyboard interrupt before terminating it
 
 #### Websocket ####
-WS_RETRY = 20 # number of seconds to wait between dropped WS connection checks
+WS_RETRY = 20 # Max number of seconds to wait before retrying a dropped WS connection
+WS_RETRY_BASE = 1 # Seconds to wait before the first retry. This doubles (with jitter) after each failed retry. Connections that drop within this many seconds count as failed.
+WS_CIRCUIT_THRESHOLD = 10 # Consecutive failed retries before a server's retries are paused
+WS_CIRCUIT_RESET = 300 # Seconds to pause retries for once the threshold is reached
 MAX_CONNECT_ATTEMPTS = 999999 # Max number of connection retries
-
-PROCESSED_VAL_MAX = 10000 # Maximum number of validation messages to store to avoid duplicates
-# when this number is reached, half of the validation message tracking list will be deleted.
+WS_SHARDS = 1 # Number of websocket processes to split servers between. Increase if one CPU core is saturated.
+WS_SHARD_METHOD = "weighted" # "weighted" keeps validation streams on one shard (so duplicate validations are dropped before IPC) and balances the rest. "hash" uses consistent hashing on server URLs, which splits validation streams between shards, so duplicates from different shards all reach the response processor.
+WS_SHARD_VAL_WEIGHT = 10 # "weighted" only: a validation stream connection counts as this many other connections
+WS_CAPTURE_FILE = None # Record every received websocket frame to this gzip file for replay (e.g., 'capture.gz'). Each shard writes its own file ('capture.0.gz', etc.). None disables capture.
+WS_CAPTURE_FLUSH = 1 # Seconds between writes to the capture file
+
+PROCESSED_VAL_MAX = 10000 # Maximum number of validation signatures to store to avoid duplicates
+# when this number is reached, the oldest half of the validation tracking cache will be deleted.
+
+MESSAGE_TRANSPORT = "queue" # How websocket messages reach the response processor ("queue" or "pipe").
+# "queue" decodes each message in the websocket process and passes it through a multiprocessing queue.
+# "pipe" passes raw messages in batches and decodes them in the response processor, which is
+# faster when many validation streams are subscribed to.
+TRANSPORT_BATCH_SIZE = 100 # Number of messages to send ("pipe") or read ("queue" and "pipe") per batch
+TRANSPORT_FLUSH_MS = 50 # "pipe" only: max milliseconds to hold messages before sending a partial batch
+JSON_DECODER = "auto" # "orjson", "msgspec", "json" (standard library), or "auto" to use the fastest one installed
+JSON_TYPED_STRUCTS = False # msgspec only: decode known message types into typed structs, skipping unused fields
 
 MAX_VAL_STREAMS = 5 # Max validations streams to subscribe to. These produce a lot of messages.
+FANIN_LEDGER_WINDOW = 5 # Number of recent ledgers to remember validation signatures for when dropping duplicate validations
+FANIN_REBALANCE_INTERVAL = 60 # Seconds between moving validation streams to the fastest, most reliable servers
+FANIN_REBALANCE_MARGIN = 0.5 # Seconds a server's score must beat a validation stream server's score by to take over its stream
+FANIN_DROP_PENALTY = 1 # Seconds added to a server's score for each dropped connection
 # Client too slow WS disconnects, seemingly forked servers, and other unexpected behavior
 # can result from excessive validation stream subscriptions. Too few streams can result in
 # false missed validation messages.
@@ -29,6 +52,21 @@ LL_FORK_CUTOFF = 25 # Number ledgers ahead or behind mode of monitored servers t
 CONSOLE_OUT = True # Print a fancy table to the console
 CONSOLE_REFRESH_TIME = 5 # Time in seconds to wait before refreshing console output.
 PRINT_AMENDMENTS = True # Print output summarizing amendment voting.
+SERVER_IMPLEMENTATIONS = {} # Implementation IDs (hex, the first 16 bits of 'server_version') mapped to names, e.g., for Xahau nodes. rippled ('183b') is built in. Unknown IDs are logged.
+
+#### History ####
+HISTORY_DB = None # Path to a SQLite database for recording server and validator metrics over time (e.g., 'history.db'). None disables recording.
+HISTORY_SAMPLE_INTERVAL = 4 # Seconds between samples of servers and validators. Only servers and validators that changed are recorded.
+HISTORY_RAW_RETENTION = 86400 # Seconds to keep every sample before downsampling
+HISTORY_ROLLUP_PERIOD = 60 # Seconds of samples summarized in each downsampled row
+HISTORY_RETENTION = 7776000 # Seconds to keep downsampled rows and events (fork and state changes)
+HISTORY_MAINTENANCE_INTERVAL = 3600 # Seconds between downsampling and deletion passes
+
+#### Metrics ####
+METRICS_PORT = None # Serve Prometheus metrics (queue depths, per-stage timings, reconnects, etc.) from the main process on this port (e.g., 9100). None disables metrics.
+METRICS_HOST = "127.0.0.1" # Address to serve metrics on. Use "0.0.0.0" to allow remote scrapes.
+METRICS_INTERVAL = 5 # Seconds between each process sending its metrics to the main process
+ALERT_TRACE = False # Log each notification's timestamps, from receiving the websocket frame that raised it to each notification channel sending it
 
 #### Random ####
 REMOVE_DUP_VALIDATORS = True # Allow the same validator master/eph keys to be tracked more than once
@@ -81,16 +119,45 @@ SMTP_PASSWORD = "secret"
 SMTP_SERVER = "mail.example.com"
 SMTP_SUBMISSION_PORT = 587 # integer
 SMTP_START_TLS = True # Boolean
+SMTP_IDLE_TIMEOUT = 60 # Seconds an open SMTP connection can sit unused before reconnecting
+SMTP_DIGEST_WINDOW = 0 # Seconds to collect notifications to the same recipient into a single email.
+# Set to 0 to send each notification as soon as it arrives.
+
+#### HTTP Notification Settings ####
+# Webhook and Twilio notifications share a pool of keep-alive HTTP connections.
+HTTP_MAX_CONNECTIONS = 100 # Max simultaneous connections across all notification hosts
+HTTP_MAX_CONNECTIONS_PER_HOST = 10 # Max simultaneous connections to a single host (e.g., discord.com)
+HTTP_DNS_CACHE_TIME = 300 # Seconds to cache DNS lookups
+HTTP_KEEPALIVE_TIME = 60 # Seconds to keep idle connections open for reuse
+HTTP_TIMEOUT = 30 # Seconds to wait for a notification request to complete
 
 #### General Notification Settings ####
 KNOWN_NOTIFICATIONS = ['twilio', 'discord', 'mattermost', 'slack', 'smtp']
 
 # Notification retries will back off by increasing time exponentially.
 # If 'NOTIFY_RETRY_TIME = 10', the notification will be retried after 10 sec,
-# 20 sec, 40 sec, etc. until 'NOTIFY_RETRY_MAX' is reached.
+# 20 sec, 40 sec, etc. until 'NOTIFY_RETRY_MAX' is reached. Failed Mattermost posts are retried,
+# and Discord messages that were rate limited are retried after the delay Discord asks for.
 NOTIFY_RETRY_MAX = 25 # Number of times to retry sending failed notification messages
 NOTIFY_RETRY_SLEEP_TIME = 10 # Seconds to initially wait before retrying a failed notification
 
+# Each notification method has its own bounded backlog and workers, so one method being down doesn't hold up the others.
+NOTIFY_CHANNEL_CONCURRENCY = { # Number of workers (max messages to send at the same time) for each notification method
+    'twilio': 2,
+    'discord': 2,
+    'mattermost': 5,
+    'slack': 5,
+    'smtp': 1,
+}
+NOTIFY_BACKLOG_MAX = 1000 # Number of notifications to hold for each notification method while waiting to be dispatched
+# What to do with new notifications when the backlog is full:
+# "drop_oldest" - Discard the oldest notification in the backlog.
+# "coalesce" - Merge the new notification into one already waiting for the same recipient(s).
+# "spill" - Write the new notification to NOTIFY_SPILL_FILE and send it once the backlog clears.
+NOTIFY_OVERFLOW_POLICY = "drop_oldest"
+NOTIFY_SPILL_FILE = "notification_spill.jsonl" # The method name is added for each method's file (e.g., "notification_spill.discord.jsonl")
+NOTIFY_METRICS_INTERVAL = 300 # Seconds between logging backlog and per-method send statistics
+
 # Specify which notification methods will be enabled.
 # Messages will be dropped if not enabled here, even if individual clients enable them.
 SEND_TWILIO = False
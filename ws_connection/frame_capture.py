@@ -0,0 +1,148 @@
+'''
+Capture raw websocket frames to a compressed log, and read captures back.
+
+With WS_CAPTURE_FILE set, each websocket shard appends every frame it receives to its own
+capture file ('capture.gz' becomes 'capture.0.gz', 'capture.1.gz', etc.). A capture is a gzip
+stream of records, each a header (record kind, receive time, server ID, payload length)
+followed by the payload. The first time a server is seen, a server record (JSON 'url' and
+'server_name') assigns it an ID. Frame records hold the raw frame.
+
+Captures can be served to the monitor with benchmarks/replay_server.py.
+'''
+import asyncio
+import gzip
+import json
+import logging
+import os
+import struct
+import time
+
+RECORD_HEADER = struct.Struct('!BdHI')
+SERVER_RECORD = 0
+FRAME_RECORD = 1
+COMPRESS_LEVEL = 6
+
+
+def capture_path(path, shard):
+    '''
+    :param str path: WS_CAPTURE_FILE
+    :param int shard: Websocket shard number
+    :return: The capture file for a shard
+    :rtype: str
+    '''
+    root, extension = os.path.splitext(path)
+    return f"{root}.{shard}{extension}"
+
+
+class FrameRecorder:
+    '''
+    Buffer received frames in memory, and append them to a capture file in batches. If a write
+    fails, capturing stops and later frames aren't buffered.
+
+    :param str path: Capture file
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.file = gzip.open(path, 'ab', compresslevel=COMPRESS_LEVEL)
+        self.buffer = []
+        self.server_ids = {} # URL: server ID
+        self.failed = False
+
+    def record(self, server, frame, received=None):
+        '''
+        :param dict server: The server the frame was received from
+        :param frame: Websocket frame (str or bytes)
+        :param float received: Receive time (defaults to now)
+        '''
+        if self.failed:
+            return
+        if received is None:
+            received = time.time()
+        server_id = self.server_ids.get(server['url'])
+        if server_id is None:
+            server_id = self.server_ids[server['url']] = len(self.server_ids)
+            declaration = json.dumps(
+                {'url': server['url'], 'server_name': server.get('server_name')}
+            ).encode()
+            self.buffer.append(
+                RECORD_HEADER.pack(SERVER_RECORD, received, server_id, len(declaration))
+            )
+            self.buffer.append(declaration)
+        if isinstance(frame, str):
+            frame = frame.encode()
+        self.buffer.append(RECORD_HEADER.pack(FRAME_RECORD, received, server_id, len(frame)))
+        self.buffer.append(frame)
+
+    def write(self, records):
+        '''
+        Compress and write records to the capture file.
+
+        :param list records: Encoded records
+        '''
+        self.file.write(b''.join(records))
+        self.file.flush()
+
+    def flush(self):
+        '''
+        Write every buffered frame.
+        '''
+        records, self.buffer = self.buffer, []
+        if records:
+            self.write(records)
+
+    def close(self):
+        '''
+        Write every buffered frame and close the capture file.
+        '''
+        self.flush()
+        self.file.close()
+
+    async def flush_forever(self, interval):
+        '''
+        Write buffered frames from a worker thread every interval, so compression and disk
+        writes don't block the websocket event loop.
+
+        :param float interval: Seconds between writes
+        '''
+        logging.warning("Capturing websocket frames to: '%s'.", self.path)
+        try:
+            while True:
+                await asyncio.sleep(float(interval))
+                records, self.buffer = self.buffer, []
+                if records:
+                    await asyncio.to_thread(self.write, records)
+        except (asyncio.CancelledError, KeyboardInterrupt):
+            self.close()
+            logging.warning("Closed websocket capture: '%s'.", self.path)
+        except Exception as error:
+            self.failed = True
+            self.buffer = []
+            logging.critical("Stopped capturing websocket frames: '%s'.", error)
+
+
+def read_capture(path):
+    '''
+    Read a capture file. A capture that ends in an incomplete record (e.g., because the
+    monitor was killed) is read up to that record.
+
+    :param str path: Capture file
+    :return: Receive time, server ('url' and 'server_name'), and frame for each frame
+    :rtype: generator
+    '''
+    servers = {}
+    with gzip.open(path, 'rb') as capture:
+        try:
+            while True:
+                header = capture.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                kind, received, server_id, length = RECORD_HEADER.unpack(header)
+                payload = capture.read(length)
+                if len(payload) < length:
+                    break
+                if kind == SERVER_RECORD:
+                    servers[server_id] = json.loads(payload)
+                else:
+                    yield received, servers[server_id], payload
+        except EOFError:
+            logging.warning("Capture: '%s' ended with an incomplete record.", path)
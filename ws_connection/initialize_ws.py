@@ -5,61 +5,86 @@ into a queue for processing.
 import logging
 import asyncio
 
-from .ws_listen import websocket_subscribe
-from .ws_minder import mind_connections
+from misc import log_setup, metrics
+from .ws_minder import ReconnectScheduler
+from .validation_fanin import ValidationFanIn, subscribe_command
+from .frame_capture import FrameRecorder, capture_path
 
 
 def get_command(settings, val_stream_count):
     '''
-    Only subscribe to the validation stream if necessary.
+    Only subscribe to the validation stream if necessary. These initial slots are
+    moved to better performing servers by the validation fan in once it has measurements.
     '''
-    if not settings.VALIDATORS:
-        command = {"command": "subscribe", "streams": ["server", "ledger"], "ledger_index": "current"}
-    elif val_stream_count >= int(settings.MAX_VAL_STREAMS):
-        command = {"command": "subscribe", "streams": ["server", "ledger"], "ledger_index": "current"}
+    if not settings.VALIDATORS or val_stream_count >= int(settings.MAX_VAL_STREAMS):
+        command = subscribe_command(False)
     else:
-        command = {"command": "subscribe", "streams": ["server", "ledger", "validations"], "ledger_index": "current"}
+        command = subscribe_command(True)
         val_stream_count += 1
 
     return command, val_stream_count
 
-def start_websocket_loop(args_d):
+def assign_commands(settings, table_stock):
+    '''
+    Set each server's subscription command. This is done before servers are split between
+    shards, so MAX_VAL_STREAMS applies across all shards.
+
+    :param settings: Config file
+    :param list table_stock: Stock servers
+    '''
+    val_stream_count = 0
+    for server in table_stock:
+        server['command'], val_stream_count = get_command(settings, val_stream_count)
+
+def start_websocket_loop(args_d, shard=0):
     '''
     Create an asyncio event loop then subscribe to websocket connections and pass the connections to the reconnection minder.
 
-    :param dict args_d: Settings, etc.
+    :param dict args_d: Settings, etc. 'table_stock' contains only this shard's servers.
+    :param int shard: Websocket shard number
     '''
+    log_setup.start_log_thread(args_d['settings'])
     loop = asyncio.new_event_loop()
-    val_stream_count = 0
     monitor_tasks = []
+    args_d['message_queue'].select_shard(shard)
+    fan_in = ValidationFanIn(args_d['settings'], args_d['table_stock'])
+    recorder = None
+    if args_d['settings'].WS_CAPTURE_FILE:
+        recorder = FrameRecorder(capture_path(args_d['settings'].WS_CAPTURE_FILE, shard))
+    minder = ReconnectScheduler(
+        args_d['settings'], args_d['message_queue'], fan_in, loop, recorder
+    )
 
     if args_d['settings'].ASYNCIO_DEBUG is True:
         loop.set_debug(True)
         logging.info("asyncio debugging enabled.")
 
-    logging.info("Adding server subscriptions to the event loop.")
+    logging.info("Adding server subscriptions for shard: '%s' to the event loop.", shard)
     for server in args_d['table_stock']:
-        server['command'], val_stream_count = get_command(args_d['settings'], val_stream_count)
         server['ws_retry_count'] = 0
-        server['ws_connection_task'] = loop.create_task(
-            websocket_subscribe(server, args_d['message_queue'])
-        )
+        minder.connect(server)
 
-    monitor_tasks.append(
-        loop.create_task(
-            mind_connections(
-                args_d['settings'],
-                args_d['table_stock'],
-                args_d['message_queue']
-            )
-        )
-    )
+    monitor_tasks.append(loop.create_task(args_d['message_queue'].flush_forever()))
+    monitor_tasks.append(loop.create_task(fan_in.rebalance_forever()))
+    if recorder is not None:
+        monitor_tasks.append(loop.create_task(
+            recorder.flush_forever(args_d['settings'].WS_CAPTURE_FLUSH)
+        ))
+    if args_d.get('metrics_queue') is not None:
+        metrics.enable()
+        if args_d['message_queue'].raw_frames:
+            # Frames wait in each shard until they're written to its pipe
+            metrics.register_gauge('monitor_message_queue_depth', args_d['message_queue'].depth)
+        monitor_tasks.append(loop.create_task(
+            metrics.publish_forever(args_d['metrics_queue'], args_d['settings'].METRICS_INTERVAL)
+        ))
 
-    logging.warning("Initial websocket asyncio task list is running.")
+    logging.warning("Initial websocket asyncio task list for shard: '%s' is running.", shard)
     try:
         loop.run_forever()
     except KeyboardInterrupt:
         logging.critical("Keyboard interrupt detected, exiting.")
+        minder.stop()
         for server in args_d['table_stock']:
             server['ws_connection_task'].cancel()
         for task in monitor_tasks:
@@ -69,4 +94,6 @@ def start_websocket_loop(args_d):
         loop.run_until_complete(asyncio.gather(*asyncio.all_tasks(loop), return_exceptions=True))
         loop.run_until_complete(loop.shutdown_asyncgens())
         loop.close()
-        logging.critical("All websocket asyncio loops have been closed.")
+        args_d['message_queue'].close()
+        logging.critical("All websocket asyncio loops for shard: '%s' have been closed.", shard)
+        log_setup.stop_log_thread()
@@ -0,0 +1,95 @@
+'''
+Partition stock servers between websocket ingestion processes (shards).
+'''
+import bisect
+import hashlib
+import logging
+
+RING_REPLICAS = 100 # Points on the hash ring per shard
+
+def hash_key(key):
+    '''
+    :param str key: Value to place on the hash ring
+    :rtype: int
+    '''
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+def server_weight(settings, server):
+    '''
+    Estimate the load a server's connection adds to a shard.
+
+    :param settings: Config file
+    :param dict server: Stock server, with its subscription command
+    :rtype: int
+    '''
+    if "validations" in (server.get('command') or {}).get('streams', []):
+        return int(settings.WS_SHARD_VAL_WEIGHT)
+    return 1
+
+def partition_hash(servers, shards):
+    '''
+    Consistent hashing on the server URL, so changing the number of shards only
+    moves a fraction of the servers.
+
+    :param list servers: Stock servers
+    :param int shards: Number of shards
+    :rtype: list
+    '''
+    ring = sorted(
+        (hash_key(f"shard-{shard}-{replica}"), shard)
+        for shard in range(shards) for replica in range(RING_REPLICAS)
+    )
+    points = [point for point, _ in ring]
+    partitions = [[] for _ in range(shards)]
+    for server in servers:
+        position = bisect.bisect(points, hash_key(server['url'])) % len(ring)
+        partitions[ring[position][1]].append(server)
+    return partitions
+
+def partition_weighted(settings, servers, shards):
+    '''
+    Keep every validation stream connection on the first shard, so its ValidationFanIn
+    drops duplicate validations across all streams before they're sent to the response
+    processor. Each validation stream also gets a spare server on the first shard, for the
+    fan-in to move a stream to. Other servers then fill each shard up to an even total weight.
+
+    :param settings: Config file
+    :param list servers: Stock servers
+    :param int shards: Number of shards
+    :rtype: list
+    '''
+    validation = [server for server in servers if server_weight(settings, server) > 1]
+    others = [server for server in servers if server_weight(settings, server) == 1]
+    partitions = [validation + others[:len(validation)]] + [[] for _ in range(shards - 1)]
+    loads = [sum(server_weight(settings, server) for server in partitions[0])] + [0] * (shards - 1)
+    for server in others[len(validation):]:
+        shard = loads.index(min(loads))
+        partitions[shard].append(server)
+        loads[shard] += 1
+    return partitions
+
+def partition_servers(settings, table_stock):
+    '''
+    Split stock servers between WS_SHARDS websocket processes.
+    Servers' subscription commands should be assigned first.
+
+    :param settings: Config file
+    :param list table_stock: Stock servers
+    :return: One list of servers per shard
+    :rtype: list
+    '''
+    shards = max(1, int(settings.WS_SHARDS))
+    if settings.WS_SHARD_METHOD == 'hash':
+        partitions = partition_hash(table_stock, shards)
+    else:
+        if settings.WS_SHARD_METHOD != 'weighted':
+            logging.error(
+                "Unknown WS_SHARD_METHOD: '%s'. Using 'weighted'.", settings.WS_SHARD_METHOD
+            )
+        partitions = partition_weighted(settings, table_stock, shards)
+    for shard, servers in enumerate(partitions):
+        logging.warning(
+            "Websocket shard: '%s' has: '%s' servers with weight: '%s'.",
+            shard, len(servers), sum(server_weight(settings, i) for i in servers)
+        )
+    return partitions
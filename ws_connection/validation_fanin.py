@@ -0,0 +1,313 @@
+'''
+Share validation stream subscriptions across websocket connections.
+
+Every subscribed validation stream delivers a copy of the same validation, so duplicates are
+dropped here (before they are passed to the response processor). Validation stream slots
+are moved to the connections that deliver ledgers the fastest and drop the least, and a
+slot is handed to another connection when the connection holding it drops.
+'''
+import asyncio
+import json
+import logging
+import re
+import time
+
+FANIN_ID = "validation_fanin"
+
+VALIDATION_RE = re.compile(r'"type"\s*:\s*"validationReceived"')
+LEDGER_CLOSED_RE = re.compile(r'"type"\s*:\s*"ledgerClosed"')
+SIGNATURE_RE = re.compile(r'"signature"\s*:\s*"([0-9A-Fa-f]+)"')
+LEDGER_INDEX_RE = re.compile(r'"ledger_index"\s*:\s*"?(\d+)')
+FANIN_RESPONSE_RE = re.compile(r'"id"\s*:\s*"' + FANIN_ID + '"')
+
+def compile_bytes(pattern):
+    '''
+    Compile a bytes version of a regex, so raw frames don't need to be decoded.
+    '''
+    return re.compile(pattern.pattern.encode())
+
+PATTERNS = {
+    str: (VALIDATION_RE, LEDGER_CLOSED_RE, SIGNATURE_RE, LEDGER_INDEX_RE, FANIN_RESPONSE_RE),
+    bytes: tuple(
+        compile_bytes(i) for i in
+        (VALIDATION_RE, LEDGER_CLOSED_RE, SIGNATURE_RE, LEDGER_INDEX_RE, FANIN_RESPONSE_RE)
+    ),
+}
+
+def subscribe_command(validations):
+    '''
+    Create the command used when (re)connecting to a server.
+
+    :param bool validations: Include the validation stream
+    :rtype: dict
+    '''
+    streams = ["server", "ledger"]
+    if validations:
+        streams.append("validations")
+    return {"command": "subscribe", "streams": streams, "ledger_index": "current"}
+
+
+class ValidationFanIn:
+    '''
+    Drop duplicate validations and manage which connections carry the validation stream.
+
+    :param settings: Config file
+    :param list table_stock: Servers handled by this websocket shard, with their initial commands
+    '''
+    def __init__(self, settings, table_stock):
+        self.settings = settings
+        self.enabled = bool(settings.VALIDATORS)
+        self.servers = table_stock
+        # The shard keeps the number of validation streams it was initially assigned
+        self.slots = sum(self.carries_validations(server) for server in table_stock)
+        self.window = int(settings.FANIN_LEDGER_WINDOW)
+        self.seen = {} # Ledger index: {signature: time first received}
+        self.ledger_arrivals = {} # Ledger index: time first received
+        self.connections = {} # id(server): (server, websocket)
+        self.stats = {} # id(server): latency and reliability measurements
+        self.frames = 0
+        self.duplicates = 0
+
+    def server_stats(self, server):
+        '''
+        :param dict server: Stock server
+        :return: Measurements for the server
+        :rtype: dict
+        '''
+        return self.stats.setdefault(
+            id(server), {'server': server, 'lag': None, 'drops': 0}
+        )
+
+    def score(self, server):
+        '''
+        Lower is better: average ledger lag (seconds) behind the fastest server, plus a
+        penalty for each dropped connection.
+
+        :param dict server: Stock server
+        :rtype: float
+        '''
+        stats = self.server_stats(server)
+        if stats['lag'] is None:
+            return float('inf')
+        return stats['lag'] + stats['drops'] * float(self.settings.FANIN_DROP_PENALTY)
+
+    def record_lag(self, server, arrivals, index, now):
+        '''
+        Update a server's average lag behind the first server to deliver a ledger.
+
+        :param dict server: Stock server
+        :param dict arrivals: Ledger index mapped to first arrival time
+        :param int index: Ledger index
+        :param float now: Time the ledger was received from this server
+        '''
+        first = arrivals.setdefault(index, now)
+        stats = self.server_stats(server)
+        lag = now - first
+        if stats['lag'] is None:
+            stats['lag'] = lag
+        else:
+            stats['lag'] = stats['lag'] * 0.9 + lag * 0.1
+
+    def prune(self, table, newest):
+        '''
+        Forget ledgers that fell outside of the window.
+
+        :param dict table: Ledger index keyed dictionary
+        :param int newest: Newest ledger index
+        '''
+        for index in [i for i in table if i <= newest - self.window]:
+            del table[index]
+
+    def accept(self, server, frame):
+        '''
+        Check if a frame should be passed to the response processor.
+
+        :param dict server: Stock server the frame was received from
+        :param frame: Raw websocket frame (str or bytes)
+        :return: False for duplicate validations and responses to fan in (un)subscribe commands
+        :rtype: bool
+        '''
+        if not self.enabled:
+            return True
+        validation_re, ledger_closed_re, signature_re, ledger_index_re, response_re = \
+                PATTERNS[type(frame)]
+        self.frames += 1
+        now = time.monotonic()
+
+        if validation_re.search(frame):
+            signature = signature_re.search(frame)
+            index = ledger_index_re.search(frame)
+            if not signature or not index:
+                return True
+            index = int(index.group(1))
+            signatures = self.seen.get(index)
+            if signatures is None:
+                signatures = self.seen[index] = {}
+                self.prune(self.seen, index)
+            if signature.group(1) in signatures:
+                self.duplicates += 1
+                return False
+            signatures[signature.group(1)] = now
+            return True
+
+        if ledger_closed_re.search(frame):
+            index = ledger_index_re.search(frame)
+            if index:
+                index = int(index.group(1))
+                if index not in self.ledger_arrivals:
+                    self.prune(self.ledger_arrivals, index)
+                self.record_lag(server, self.ledger_arrivals, index, now)
+            return True
+
+        return not response_re.search(frame)
+
+    def carries_validations(self, server):
+        '''
+        :param dict server: Stock server
+        :rtype: bool
+        '''
+        return "validations" in (server.get('command') or {}).get('streams', [])
+
+    def slot_holders(self):
+        '''
+        :return: Connected servers that carry the validation stream
+        :rtype: list
+        '''
+        return [
+            server for server, _ in self.connections.values() if self.carries_validations(server)
+        ]
+
+    def candidates(self):
+        '''
+        :return: Connected servers that don't carry the validation stream, best first
+        :rtype: list
+        '''
+        servers = [
+            server for server, _ in self.connections.values()
+            if not self.carries_validations(server)
+        ]
+        return sorted(servers, key=self.score)
+
+    async def set_validation_stream(self, server, enabled):
+        '''
+        Subscribe or unsubscribe a live connection to the validation stream, and
+        update the command used when it reconnects.
+
+        :param dict server: Stock server
+        :param bool enabled: Subscribe if True, unsubscribe if False
+        '''
+        server['command'] = subscribe_command(enabled)
+        connection = self.connections.get(id(server))
+        if connection is None:
+            return
+        command = {
+            "id": FANIN_ID,
+            "command": "subscribe" if enabled else "unsubscribe",
+            "streams": ["validations"],
+        }
+        try:
+            await connection[1].send(json.dumps(command))
+            logging.warning(
+                "Validation stream %s for: '%s'.",
+                "added" if enabled else "removed", server.get('server_name')
+            )
+        except Exception as error:
+            logging.warning(
+                "Unable to change validation stream for: '%s'. Error: '%s'.",
+                server.get('server_name'), error
+            )
+
+    async def fill_slots(self):
+        '''
+        Give free validation stream slots to the best connected servers. Servers that aren't
+        connected (e.g., initial slot holders that haven't connected yet) give up their
+        slots first, so they can't add a stream when they connect.
+        '''
+        for server in self.servers:
+            if id(server) not in self.connections and self.carries_validations(server):
+                server['command'] = subscribe_command(False)
+                logging.warning(
+                    "Validation stream slot taken from: '%s', which isn't connected.",
+                    server.get('server_name')
+                )
+        free = self.slots - len(self.slot_holders())
+        for server in self.candidates()[:max(free, 0)]:
+            await self.set_validation_stream(server, True)
+
+    async def connected(self, server, websocket, command=None):
+        '''
+        Call after subscribing to a server. If the server subscribed to the validation
+        stream but its slot was taken while it was connecting (or every slot is held by
+        connected servers), the stream is removed.
+
+        :param dict server: Stock server
+        :param websocket: Open websocket connection
+        :param dict command: The subscription command sent (defaults to the server's command)
+        '''
+        if not self.enabled:
+            return
+        self.connections[id(server)] = (server, websocket)
+        self.server_stats(server)
+        subscribed = "validations" in (command or server.get('command') or {}).get('streams', [])
+        if subscribed and (
+                not self.carries_validations(server) or len(self.slot_holders()) > self.slots
+        ):
+            await self.set_validation_stream(server, False)
+
+    async def disconnected(self, server):
+        '''
+        Call when a connection closes. If it carried the validation stream, the slot
+        is given to the best connected server.
+
+        :param dict server: Stock server
+        '''
+        if not self.enabled or self.connections.pop(id(server), None) is None:
+            return
+        self.server_stats(server)['drops'] += 1
+        if self.carries_validations(server):
+            server['command'] = subscribe_command(False)
+            logging.warning(
+                "Validation stream connection to: '%s' dropped. Reassigning the stream.",
+                server.get('server_name')
+            )
+            await self.fill_slots()
+
+    async def rebalance(self):
+        '''
+        Fill free slots, then move a slot from the worst slot holder to the best
+        candidate if the candidate is clearly better.
+        '''
+        await self.fill_slots()
+        holders = sorted(self.slot_holders(), key=self.score)
+        candidates = self.candidates()
+        if not holders or not candidates:
+            return
+        worst, best = holders[-1], candidates[0]
+        margin = float(self.settings.FANIN_REBALANCE_MARGIN)
+        if self.score(best) + margin < self.score(worst):
+            logging.warning(
+                "Moving validation stream from: '%s' (score: '%s') to: '%s' (score: '%s').",
+                worst.get('server_name'), self.score(worst),
+                best.get('server_name'), self.score(best)
+            )
+            await self.set_validation_stream(best, True)
+            await self.set_validation_stream(worst, False)
+
+    async def rebalance_forever(self):
+        '''
+        Periodically rebalance validation stream slots and log dedup statistics.
+        '''
+        while self.enabled:
+            try:
+                await asyncio.sleep(int(self.settings.FANIN_REBALANCE_INTERVAL))
+                await self.rebalance()
+                logging.info(
+                    "Validation fan in: '%d' frames, '%d' duplicate validations dropped.",
+                    self.frames, self.duplicates
+                )
+            except (asyncio.CancelledError, KeyboardInterrupt):
+                break
+            except Exception as error:
+                logging.critical(
+                    "Otherwise uncaught exception rebalancing validation streams: '%s'.", error
+                )
@@ -6,9 +6,12 @@ import json
 import logging
 import socket
 import ssl
+import time
 
 import websockets
 
+from misc import metrics
+
 async def create_ws_object(server):
     '''
     Check if SSL certificate verification is enabled, then create a ws accordingly.
@@ -27,14 +30,16 @@ async def create_ws_object(server):
         connection = None
     return connection
 
-async def websocket_subscribe(server, message_queue):
+async def websocket_subscribe(server, message_queue, fan_in, recorder=None):
     '''
     Connect to a websocket address using TLS settings specified in 'url'.
     Keep the socket open, and add unique response messages from the remote server to
     the queue.
 
     :param dict server: URL SSL certificate, and subscription command
-    :param asyncio.queues.Queue message_queue: Queue for incoming websocket messages
+    :param message_queue: Transport for incoming websocket messages
+    :param ValidationFanIn fan_in: Validation dedup and stream slot manager
+    :param FrameRecorder recorder: Capture every received frame (None to disable)
     '''
 
     try:
@@ -42,24 +47,27 @@ async def websocket_subscribe(server, message_queue):
         # Establish a connection object
         logging.info("Attempting to connect to: '%s'.", server.get('server_name'))
         async with await create_ws_object(server) as ws:
-            await ws.send(json.dumps(server['command']))
+            command = server['command']
+            await ws.send(json.dumps(command))
             logging.warning(
-                "Subscribed to: '%s' with command: '%s'.",
-                server.get('server_name'), server.get('command')
+                "Subscribed to: '%s' with command: '%s'.", server.get('server_name'), command
             )
+            server['ws_connected'] = True
+            server['ws_connected_time'] = time.monotonic()
+            await fan_in.connected(server, ws, command)
             while True:
                 # Listen for response messages
                 try:
-                    data = await ws.recv()
-                    data = json.loads(data)
-                    message_queue.put(
-                        {"server_url": server.get('url'), "data": data}
-                    )
-                except (json.JSONDecodeError,) as error:
-                    logging.warning(
-                        "Server: '%s'. Unable to decode JSON: '%s'. Error: '%s'.",
-                        server.get('server_name'), data, error
-                    )
+                    if message_queue.raw_frames:
+                        data = await ws.recv(decode=False)
+                    else:
+                        data = await ws.recv()
+                    received = time.monotonic()
+                    metrics.inc('monitor_frames_total', (server['url'],))
+                    if recorder is not None:
+                        recorder.record(server, data)
+                    if fan_in.accept(server, data):
+                        await message_queue.put_frame(server, data, received)
                 except (asyncio.CancelledError, KeyboardInterrupt):
                     logging.warning(
                         "Keyboard Interrupt detected. Closing websocket connection to: '%s'.", server
@@ -92,3 +100,5 @@ async def websocket_subscribe(server, message_queue):
         logging.critical(
             "Unable to connect to server: '%s' due to an invalid URI: '%s'.", server, error
         )
+    finally:
+        await fan_in.disconnected(server)
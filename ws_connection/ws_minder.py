@@ -3,7 +3,10 @@ Monitor multiple websocket connections and attempt to reconnect when a websocket
 '''
 import asyncio
 import logging
+import random
+import time
 
+from misc import metrics
 from .ws_listen import websocket_subscribe
 
 async def queue_state_change(server, message_queue):
@@ -11,17 +14,15 @@ async def queue_state_change(server, message_queue):
     Place a message into the queue to inform that a server is disconnected.
 
     :param dict server: Info on the server that the reconnection attempt will be made to
-    :param asyncio.queues.Queue message_queue: Queue for incoming websocket messages
+    :param message_queue: Transport for incoming websocket messages
     '''
-    message_queue.put(
+    await message_queue.put_message(
+        server,
         {
-            'server_url': server.get('url'),
-            'data': {
-                'result': {
-                    'server_status': 'disconnected from monitoring',
-                },
+            'result': {
+                'server_status': 'disconnected from monitoring',
             },
-        }
+        },
     )
 
     logging.info(
@@ -29,63 +30,146 @@ async def queue_state_change(server, message_queue):
         server.get('server_name')
     )
 
-async def resubscribe_client(server, message_queue):
+def retry_delay(settings, server):
     '''
-    Attempt to reconnect dropped websocket connections to remote servers.
+    Calculate how long to wait before the next connection attempt: exponential backoff with
+    jitter, from WS_RETRY_BASE up to WS_RETRY, or WS_CIRCUIT_RESET once the circuit breaker
+    is open.
 
+    :param settings: The settings file
     :param dict server: The server that the reconnection attempt will be made to
-    :param asyncio.queues.Queue message_queue: Queue for incoming websocket messages
-    :return: The server object with a new websocket connection
-    :rtype: dict
+    :rtype: float
     '''
-    logging.info(
-        "WS connection to '%s' closed. Attempting to reconnect. Retry counter: '%s'.",
-        server.get('server_name'), server.get('ws_retry_count')
-    )
-    # Pass a message to the queue indicating the server is disconnected
-    await queue_state_change(server, message_queue)
-    # Delete the disconnected server's task
-    del server['ws_connection_task']
-    server['ws_connection_task'] = None
-    server['ws_retry_count'] = server['ws_retry_count'] + 1
-    # Open the new connection
-    loop = asyncio.get_event_loop()
-    server['ws_connection_task'] = loop.create_task(websocket_subscribe(server, message_queue))
-    logging.warning(
-        "It appears we reconnected to '%s'. Retry counter: '%s'.",
-        server.get('server_name'), server.get('ws_retry_count')
+    if server['ws_circuit'] == 'open':
+        return float(settings.WS_CIRCUIT_RESET)
+    delay = min(
+        float(settings.WS_RETRY),
+        float(settings.WS_RETRY_BASE) * 2 ** max(0, server['ws_failures'] - 1)
     )
-    return server
+    # Spread retries out so many servers dropped at once don't reconnect in lock-step
+    return random.uniform(delay / 2, delay)
 
-async def mind_connections(settings, ws_servers, message_queue):
+class ReconnectScheduler:
     '''
-    Check task loop & restart websocket clients if needed.
+    Reconnect dropped websocket connections as soon as their task finishes, rather than polling.
+
+    Each server keeps a count of consecutive failed connection attempts. A connection that
+    drops within WS_RETRY_BASE seconds of subscribing counts as failed, so servers that accept
+    connections then drop them right away are backed off too. Retries back off exponentially
+    with jitter. After WS_CIRCUIT_THRESHOLD failures in a row the server's circuit breaker
+    opens and retries pause for WS_CIRCUIT_RESET seconds, then one 'half-open' attempt is
+    made. A connection that stays up closes the circuit.
+
+    Servers are updated in place, so table_stock keeps its order.
 
     :param settings: The settings file
-    :param list ws_servers: Connections to websocket servers
-    :param asyncio.queues.Queue message_queue: Incoming websocket messages
+    :param message_queue: Transport for incoming websocket messages
+    :param ValidationFanIn fan_in: Validation dedup and stream slot manager
+    :param loop: Websocket asyncio event loop
+    :param FrameRecorder recorder: Capture every received frame (None to disable)
     '''
-    while True:
-        ws_servers_del = []
-        ws_servers_add = []
+    def __init__(self, settings, message_queue, fan_in, loop, recorder=None):
+        self.loop = loop
+        self.recorder = recorder
+        self.settings = settings
+        self.message_queue = message_queue
+        self.fan_in = fan_in
+        self.retries = {} # id(server): pending reconnection task
+        self.stopping = False
+
+    def connect(self, server):
+        '''
+        Open a websocket connection and watch for it to close.
+
+        :param dict server: The server to connect to
+        '''
+        server['ws_connected'] = False
+        server['ws_connection_task'] = self.loop.create_task(
+            websocket_subscribe(server, self.message_queue, self.fan_in, self.recorder)
+        )
+        server['ws_connection_task'].add_done_callback(
+            lambda task: self.connection_closed(server)
+        )
+
+    def update_circuit(self, server):
+        '''
+        Record the outcome of the connection that just closed.
+
+        :param dict server: The server whose connection closed
+        '''
+        if server['ws_connected'] and time.monotonic() - server['ws_connected_time'] \
+                >= float(self.settings.WS_RETRY_BASE):
+            server['ws_failures'] = 0
+            if server['ws_circuit'] != 'closed':
+                logging.warning(
+                    "Reconnection circuit closed for: '%s'.", server.get('server_name')
+                )
+            server['ws_circuit'] = 'closed'
+            return
+        server['ws_failures'] += 1
+        if server['ws_circuit'] == 'half-open' \
+                or server['ws_failures'] >= int(self.settings.WS_CIRCUIT_THRESHOLD):
+            if server['ws_circuit'] != 'open':
+                logging.warning(
+                    "Reconnection circuit opened for: '%s' after '%s' failed attempts.",
+                    server.get('server_name'), server['ws_failures']
+                )
+            server['ws_circuit'] = 'open'
+
+    def connection_closed(self, server):
+        '''
+        Done callback for websocket connection tasks.
+
+        :param dict server: The server whose connection closed
+        '''
+        if self.stopping:
+            return
+        self.update_circuit(server)
+        if server['ws_retry_count'] >= int(self.settings.MAX_CONNECT_ATTEMPTS):
+            logging.critical(
+                "Not reconnecting to: '%s'. Max connection attempts reached.",
+                server.get('server_name')
+            )
+            return
+        self.retries[id(server)] = self.loop.create_task(
+            self.reconnect(server, retry_delay(self.settings, server))
+        )
+
+    async def reconnect(self, server, delay):
+        '''
+        Report the server as disconnected, wait, then reconnect.
+
+        :param dict server: The server that the reconnection attempt will be made to
+        :param float delay: Seconds to wait before reconnecting
+        '''
         try:
-            await asyncio.sleep(int(settings.WS_RETRY))
-            for server in ws_servers:
-                if server['ws_connection_task'].done()\
-                        and server['ws_retry_count'] <= int(settings.MAX_CONNECT_ATTEMPTS):
-                    ws_add = await resubscribe_client(server, message_queue)
-                    ws_servers_del.append(server)
-                    ws_servers_add.append(ws_add)
-            for server in ws_servers_del:
-                ws_servers.remove(server)
-                logging.info("Removed disconnected server from task loop: '%s'.", server)
-            for server in ws_servers_add:
-                ws_servers.append(server)
-                logging.info("Added new connection to the task loop: '%s'.", server)
+            await queue_state_change(server, self.message_queue)
+            logging.info(
+                "WS connection to '%s' closed. Reconnecting in '%.1f' seconds. "
+                "Retry counter: '%s'. Circuit: '%s'.",
+                server.get('server_name'), delay, server.get('ws_retry_count'),
+                server.get('ws_circuit')
+            )
+            await asyncio.sleep(delay)
+            if server['ws_circuit'] == 'open':
+                server['ws_circuit'] = 'half-open'
+            server['ws_retry_count'] += 1
+            metrics.inc('monitor_reconnects_total', (server['url'],))
+            self.connect(server)
         except (asyncio.CancelledError, KeyboardInterrupt):
-            logging.critical("Keyboard interrupt detected. Stopping ws_minder.")
-            break
+            pass
         except Exception as error:
             logging.critical(
-                "An otherwise uncaught exception occurred in the ws_minder: '%s'.", error
+                "An otherwise uncaught exception occurred reconnecting to: '%s': '%s'.",
+                server.get('server_name'), error
             )
+        finally:
+            self.retries.pop(id(server), None)
+
+    def stop(self):
+        '''
+        Stop reconnecting, and cancel pending reconnections. Call before cancelling connections.
+        '''
+        self.stopping = True
+        for task in list(self.retries.values()):
+            task.cancel()